@@ -0,0 +1,60 @@
+"""Connection density: the memory held by idle connections, and the cost of
+reads on many connections with an idle timeout.
+"""
+import gc
+import tracemalloc
+
+from twisted.internet import task
+
+from txHL7.mllp import MLLPFactory
+
+from .bench_protocol import AckReceiver, connect
+
+
+class TimeoutReceiver(AckReceiver):
+    def getTimeout(self):
+        return 60
+
+
+class ConnectionDensitySuite(object):
+    """Many open connections with a 60 second idle timeout"""
+    params = [1000, 20000]
+    param_names = ['connections']
+
+    def setup(self, connections):
+        self.factory = MLLPFactory(TimeoutReceiver('ascii'), clock=task.Clock())
+        self.protocols = [connect(self.factory) for i in range(connections)]
+
+    def track_memory_per_idle_connection(self, connections):
+        """Bytes allocated by the server for each open, idle connection"""
+        factory = MLLPFactory(TimeoutReceiver('ascii'), clock=task.Clock())
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            protocols = [connect(factory) for i in range(connections)]
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        # the in-memory transports are not part of the server's footprint
+        transports = sum(p.transport.__sizeof__() + p.transport.__dict__.__sizeof__()
+                         for p in protocols)
+        return (used - transports) / float(connections)
+    track_memory_per_idle_connection.unit = 'bytes'
+
+    def time_partial_reads(self, connections):
+        """One read of a partial frame on every connection, resetting its
+        idle timeout
+        """
+        for protocol in self.protocols:
+            protocol.dataReceived(b'\x0bMSH|')
+            protocol.scanner.reset()
+
+    def time_sweep(self, connections):
+        """Checking every connection for expiry"""
+        idle = self.factory.idle
+        idle.clock.advance(30)
+        for protocol in self.protocols:
+            idle.touch(protocol)
+        idle.clock.advance(31)
@@ -0,0 +1,97 @@
+import tracemalloc
+
+from txHL7.ack import ACKBuilder
+from txHL7.receiver import HL7MessageContainer, LazyHL7MessageContainer
+
+from .common import build_message
+
+
+def _traced_peak(func, *args):
+    tracemalloc.start()
+    try:
+        result = func(*args)  # noqa: F841 keep the result alive while measuring
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class MessageContainerSuite(object):
+    """Parse cost of the eager python-hl7 container against the lazy view,
+    for a receiver that only reads MSH-9 and PID-3.
+    """
+    params = [1024, 100 * 1024, 1024 * 1024]
+    param_names = ['message_size']
+
+    def setup(self, message_size):
+        self.raw_message = build_message(message_size)
+
+    def _read_header(self, container_cls):
+        container = container_cls(self.raw_message)
+        if container_cls is HL7MessageContainer:
+            message = container.message
+            return str(message.segment('MSH')(9)), str(message.segment('PID')(3))
+        view = container.view
+        return view.field('MSH', 9), view.field('PID', 3)
+
+    def time_hl7(self, message_size):
+        self._read_header(HL7MessageContainer)
+
+    def time_lazy(self, message_size):
+        self._read_header(LazyHL7MessageContainer)
+
+    def time_lazy_materialize(self, message_size):
+        LazyHL7MessageContainer(self.raw_message).message
+
+    def track_memory_hl7(self, message_size):
+        return _traced_peak(HL7MessageContainer, self.raw_message)
+    track_memory_hl7.unit = 'bytes'
+
+    def track_memory_lazy(self, message_size):
+        return _traced_peak(LazyHL7MessageContainer, self.raw_message)
+    track_memory_lazy.unit = 'bytes'
+
+
+class ACKSuite(object):
+    """ACK construction through python-hl7 against :py:class:`txHL7.ack.ACKBuilder`"""
+    params = [1024, 100 * 1024]
+    param_names = ['message_size']
+
+    def setup(self, message_size):
+        self.raw_message = build_message(message_size)
+        self.encoded = self.raw_message.encode('ascii')
+        self.container = HL7MessageContainer(self.raw_message)
+        self.builder = ACKBuilder('ascii')
+
+    def time_create_ack(self, message_size):
+        str(self.container.message.create_ack('AA')).encode('ascii')
+
+    def time_parse_create_ack(self, message_size):
+        str(HL7MessageContainer(self.raw_message).message.create_ack('AA')).encode('ascii')
+
+    def time_builder_text(self, message_size):
+        self.builder.frame(self.raw_message)
+
+    def time_builder_bytes(self, message_size):
+        self.builder.frame(self.encoded)
+
+
+class LazyViewSuite(object):
+    """HL7MessageView indexing and field access up to 10 MB, where parsing
+    with python-hl7 takes too long to benchmark repeatedly
+    """
+    params = [1024, 1024 * 1024, 10 * 1024 * 1024]
+    param_names = ['message_size']
+
+    def setup(self, message_size):
+        self.raw_message = build_message(message_size)
+
+    def time_index(self, message_size):
+        LazyHL7MessageContainer(self.raw_message)
+
+    def time_last_segment(self, message_size):
+        view = LazyHL7MessageContainer(self.raw_message).view
+        view[len(view) - 1].field(5)
+
+    def track_memory(self, message_size):
+        return _traced_peak(LazyHL7MessageContainer, self.raw_message)
+    track_memory.unit = 'bytes'
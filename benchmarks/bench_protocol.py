@@ -0,0 +1,94 @@
+"""Hot paths of the MLLP server: framing, the protocol's ``dataReceived``,
+and the factory's codec.
+"""
+from twisted.internet import defer
+
+from txHL7.framing import MLLPFrameScanner
+from txHL7.mllp import MLLPFactory
+from txHL7.receiver import AbstractReceiver, LazyHL7MessageContainer
+
+from .common import FakeTransport, build_message, chunked, frame
+
+KB = 1024
+MB = 1024 * KB
+
+
+class AckReceiver(AbstractReceiver):
+    """Acknowledges without any further work"""
+    message_cls = LazyHL7MessageContainer
+
+    def __init__(self, codec=None):
+        self.codec = codec
+
+    def getCodec(self):
+        return self.codec, 'strict'
+
+    def handleMessage(self, message_container):
+        return defer.succeed(message_container.ack())
+
+
+def connect(factory):
+    protocol = factory.buildProtocol(None)
+    protocol.makeConnection(FakeTransport())
+    return protocol
+
+
+class FramingSuite(object):
+    """MLLPFrameScanner splitting one message arriving in chunks"""
+    params = ([1 * KB, 100 * KB, 1 * MB, 10 * MB], [4 * KB, 64 * KB])
+    param_names = ['message_size', 'chunk_size']
+
+    def setup(self, message_size, chunk_size):
+        self.chunks = chunked(frame(build_message(message_size)), chunk_size)
+
+    def time_feed(self, message_size, chunk_size):
+        scanner = MLLPFrameScanner()
+        for chunk in self.chunks:
+            scanner.feed(chunk)
+
+
+class DataReceivedSuite(object):
+    """MinimalLowerLayerProtocol.dataReceived through decode, lazy parse and
+    ACK, for one message arriving in chunks
+    """
+    params = ([1 * KB, 100 * KB, 1 * MB, 10 * MB], [4 * KB, 64 * KB])
+    param_names = ['message_size', 'chunk_size']
+
+    def setup(self, message_size, chunk_size):
+        self.factory = MLLPFactory(AckReceiver('ascii'))
+        self.chunks = chunked(frame(build_message(message_size)), chunk_size)
+
+    def time_dataReceived(self, message_size, chunk_size):
+        protocol = connect(self.factory)
+        for chunk in self.chunks:
+            protocol.dataReceived(chunk)
+
+
+class PipelinedSuite(object):
+    """Many small messages arriving in a single read"""
+    params = [1, 10, 100]
+    param_names = ['messages_per_chunk']
+
+    def setup(self, messages_per_chunk):
+        self.factory = MLLPFactory(AckReceiver('ascii'))
+        self.chunk = frame(build_message(1 * KB)) * messages_per_chunk
+
+    def time_dataReceived(self, messages_per_chunk):
+        connect(self.factory).dataReceived(self.chunk)
+
+
+class CodecSuite(object):
+    """MLLPFactory.decode and encode with the common HL7 codecs"""
+    params = (['ascii', 'utf-8', 'cp1252', 'latin-1'], [1 * KB, 1 * MB])
+    param_names = ['codec', 'message_size']
+
+    def setup(self, codec, message_size):
+        self.factory = MLLPFactory(AckReceiver(codec))
+        self.text = build_message(message_size)
+        self.encoded = self.text.encode(codec)
+
+    def time_decode(self, codec, message_size):
+        self.factory.decode(self.encoded)
+
+    def time_encode(self, codec, message_size):
+        self.factory.encode(self.text)
@@ -0,0 +1,57 @@
+"""Sample messages shared by the benchmarks"""
+
+HEADER = (
+    u'MSH|^~\\&|GHH LAB|ELAB-3|GHH OE|BLDG4|200202150930||ORU^R01|CNTRL-3456|P|2.4\r'
+    u'PID|||555-44-4444||EVERYWOMAN^EVE^E^^^^L|JONES|196203520|F|||153 FERNWOOD DR.^^STATESVILLE^OH^35292||(206)3345232|(206)752-121||||AC555444444||67-A4335^OH^20030520\r'
+    u'OBR|1|845439^GHH OE|1045813^GHH LAB|1554-5^GLUCOSE|||200202150730||||||||555-55-5555^PRIMARY^PATRICIA P^^^^MD^^LEVEL SEVEN HEALTHCARE, INC.|||||||||F||||||444-44-4444^HIPPOCRATES^HOWARD H^^^^MD\r'
+)
+OBX = u'OBX|{0}|SN|1554-5^GLUCOSE^POST 12H CFST:MCNC:PT:SER/PLAS:QN||^182|mg/dl|70_105|H|||F\r'
+
+
+def build_message(size):
+    """Return an ORU of roughly ``size`` characters, padded with OBX segments"""
+    segments = [HEADER]
+    length = len(HEADER)
+    number = 1
+    while length < size:
+        obx = OBX.format(number)
+        segments.append(obx)
+        length += len(obx)
+        number += 1
+    return u''.join(segments)
+
+
+class FakeTransport(object):
+    """Transport that counts written bytes, so benchmarks measure the
+    protocol rather than a mock library
+    """
+    def __init__(self):
+        self.written = 0
+        self.writes = 0
+
+    def write(self, data):
+        self.written += len(data)
+        self.writes += 1
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+def frame(message, encoding='ascii'):
+    return b'\x0b' + message.encode(encoding) + b'\x1c\x0d'
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
@@ -0,0 +1,54 @@
+from twisted.trial.unittest import TestCase
+import hl7
+
+from txHL7.ack import ACKBuilder
+from txHL7.framing import FramedMessage
+
+from .utils import HL7_MESSAGE
+
+TIMESTAMP = '20200101120000'
+
+
+class ACKBuilderTest(TestCase):
+    def setUp(self):
+        self.builder = ACKBuilder('cp1252')
+        self.raw = HL7_MESSAGE.decode('cp1252')
+        self.message = hl7.parse(self.raw)
+
+    def expected(self, ack_code='AA', **kwargs):
+        ack = self.message.create_ack(ack_code, message_id='ACK-1', **kwargs)
+        # create_ack always uses the current time, so substitute ours
+        ack.segment('MSH')[7] = TIMESTAMP
+        return str(ack)
+
+    def testMatchesCreateAck(self):
+        for ack_code in ('AA', 'AE', 'AR'):
+            self.assertEqual(
+                self.builder.text(self.raw, ack_code, message_id='ACK-1', timestamp=TIMESTAMP),
+                self.expected(ack_code),
+            )
+
+    def testApplicationFacility(self):
+        self.assertEqual(
+            self.builder.text(self.raw, message_id='ACK-1', timestamp=TIMESTAMP,
+                              application='APP', facility='FAC'),
+            self.expected(application='APP', facility='FAC'),
+        )
+
+    def testFrameFromBytes(self):
+        ack = self.builder.frame(HL7_MESSAGE.replace(b'BLDG4', b'x\x82y'),
+                                 message_id='ACK-1', timestamp=TIMESTAMP)
+        self.assertTrue(isinstance(ack, FramedMessage))
+        self.message = hl7.parse(self.raw.replace('BLDG4', u'x‚y'))
+        self.assertEqual(ack, b'\x0b' + self.expected().encode('cp1252') + b'\x1c\x0d')
+
+    def testFrameFromText(self):
+        self.assertEqual(
+            self.builder.frame(self.raw, message_id='ACK-1', timestamp=TIMESTAMP),
+            b'\x0b' + self.expected().encode('cp1252') + b'\x1c\x0d',
+        )
+
+    def testGeneratedDefaults(self):
+        fields = self.builder.fields(self.raw)
+        self.assertEqual(len(fields[0][5]), 14)
+        self.assertEqual(len(fields[0][8]), 20)
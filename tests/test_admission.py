@@ -0,0 +1,163 @@
+from mock import Mock
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txHL7.admission import AdmissionControl, AdmissionEndpoint, parse_priority
+from txHL7.mllp import MLLPFactory
+
+from .utils import HL7_MESSAGE, PendingReceiver
+
+FRAME = b'\x0b' + HL7_MESSAGE + b'\x1c\x0d'
+
+
+class ParsePriorityTest(TestCase):
+    def testParse(self):
+        network, tier = parse_priority('10.1.0.0/16=1')
+        self.assertEqual((str(network), tier), ('10.1.0.0/16', 1))
+        network, tier = parse_priority('::1=0')
+        self.assertEqual((str(network), tier), ('::1/128', 0))
+
+    def testInvalid(self):
+        for spec in ('10.0.0.1', '10.0.0.1=x', 'host=1', '10.0.0.1=-1'):
+            self.assertRaises(ValueError, parse_priority, spec)
+
+
+class AdmissionControlTest(TestCase):
+    def setUp(self):
+        self.receiver = PendingReceiver()
+
+    def connect(self, factory, host='192.0.2.1'):
+        transport = StringTransport(peerAddress=IPv4Address('TCP', host, 50000))
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(transport)
+        return protocol
+
+    def testTiers(self):
+        admission = AdmissionControl(priorities=[parse_priority('10.0.0.0/8=0')])
+        self.assertEqual(admission.tierFor('10.1.2.3'), 0)
+        self.assertEqual(admission.tierFor('192.0.2.1'), 1)
+        self.assertEqual(admission.tierFor('::1'), 1)
+        self.assertEqual(admission.tierFor(None), 1)
+        for tier, threshold in enumerate([1.0, 0.8, 0.6, 0.4, 0.2, 0.2]):
+            self.assertAlmostEqual(admission.threshold(tier), threshold)
+
+    def testInFlightBudget(self):
+        admission = AdmissionControl(max_in_flight=5)
+        factory = MLLPFactory(self.receiver, admission=admission)
+        first, second = self.connect(factory), self.connect(factory)
+        first.dataReceived(FRAME * 3)
+        self.assertEqual(admission.in_flight, 3)
+        self.assertEqual(second.transport.producerState, 'producing')
+
+        second.dataReceived(FRAME * 2)
+        # the budget is reached, so every connection stops reading
+        self.assertEqual(admission.held, 2)
+        self.assertEqual(first.transport.producerState, 'paused')
+        self.assertEqual(second.transport.producerState, 'paused')
+        self.assertEqual(admission.pauses, 1)
+
+        # resumes below 80% of the budget
+        self.receiver.complete(1)
+        self.assertEqual(first.transport.producerState, 'paused')
+        self.receiver.complete(1)
+        self.assertEqual(admission.held, 0)
+        self.assertEqual(first.transport.producerState, 'producing')
+        self.assertEqual(second.transport.producerState, 'producing')
+
+    def testBufferedBudget(self):
+        admission = AdmissionControl(max_buffered=len(HL7_MESSAGE) * 2 + 50)
+        factory = MLLPFactory(self.receiver, max_in_flight=1, admission=admission)
+        protocol = self.connect(factory)
+        protocol.dataReceived(FRAME * 3)
+        # one frame in flight and two queued
+        self.assertEqual(admission.buffered, len(HL7_MESSAGE) * 2 + len(protocol.scanner))
+        self.assertEqual(admission.held, 0)
+        protocol.dataReceived(FRAME[:100])
+        self.assertEqual(admission.buffered, len(HL7_MESSAGE) * 2 + len(protocol.scanner))
+        self.assertEqual(admission.held, 1)
+        self.assertEqual(factory.bufferedBytes(), admission.buffered)
+
+        self.receiver.complete(1)
+        self.assertEqual(admission.held, 0)
+        # still paused by max_in_flight
+        self.assertEqual(protocol.transport.producerState, 'paused')
+        self.receiver.complete(2)
+        self.assertEqual(protocol.transport.producerState, 'producing')
+
+    def testPartialFramesNotHeld(self):
+        # partial frames only complete by reading, so they are never held
+        admission = AdmissionControl(max_buffered=10)
+        factory = MLLPFactory(self.receiver, admission=admission)
+        protocol = self.connect(factory)
+        protocol.dataReceived(FRAME[:20])
+        self.assertEqual(admission.held, 0)
+        self.assertEqual(protocol.transport.producerState, 'producing')
+
+    def testPriority(self):
+        admission = AdmissionControl(max_in_flight=10, priorities=[parse_priority('10.0.0.1=0')])
+        factory = MLLPFactory(self.receiver, admission=admission)
+        critical = self.connect(factory, '10.0.0.1')
+        other = self.connect(factory)
+        other.dataReceived(FRAME * 8)
+        # the default tier is held at 80% of the budget, the critical feed
+        # may use the rest
+        self.assertEqual(other.transport.producerState, 'paused')
+        self.assertEqual(critical.transport.producerState, 'producing')
+
+        # new connections of a held tier are held at once
+        late = self.connect(factory, '192.0.2.2')
+        self.assertEqual(late.transport.producerState, 'paused')
+        self.assertEqual(admission.held, 2)
+
+        critical.dataReceived(FRAME * 2)
+        self.assertEqual(critical.transport.producerState, 'paused')
+        self.receiver.complete(3)
+        self.assertEqual(critical.transport.producerState, 'producing')
+        self.assertEqual(other.transport.producerState, 'paused')
+        self.receiver.complete(1)
+        self.assertEqual(other.transport.producerState, 'producing')
+
+    def testConnectionLost(self):
+        admission = AdmissionControl(max_in_flight=2)
+        factory = MLLPFactory(self.receiver, admission=admission)
+        first, second = self.connect(factory), self.connect(factory)
+        first.dataReceived(FRAME * 2)
+        self.assertEqual(second.transport.producerState, 'paused')
+        first.connectionLost(None)
+        self.assertEqual((admission.in_flight, admission.held), (0, 0))
+        self.assertEqual(second.transport.producerState, 'producing')
+        # messages of the closed connection complete without being counted
+        self.receiver.complete(2)
+        self.assertEqual(admission.in_flight, 0)
+
+    def testPauseListening(self):
+        admission = AdmissionControl(max_in_flight=5, pause_listening=True)
+        factory = MLLPFactory(self.receiver, admission=admission)
+        port = Mock()
+        endpoint = Mock()
+        endpoint.listen.return_value = defer.succeed(port)
+        listening = []
+        AdmissionEndpoint(endpoint, admission).listen(factory).addCallback(listening.append)
+        self.assertEqual(listening, [port])
+
+        self.connect(factory).dataReceived(FRAME * 5)
+        self.assertFalse(admission.listening)
+        port.stopReading.assert_called_once_with()
+        self.receiver.complete(1)
+        self.assertFalse(port.startReading.called)
+        self.receiver.complete(1)
+        self.assertTrue(admission.listening)
+        port.startReading.assert_called_once_with()
+
+    def testMetrics(self):
+        from txHL7.metrics import Metrics
+
+        metrics = Metrics()
+        admission = AdmissionControl(max_in_flight=1)
+        factory = MLLPFactory(self.receiver, metrics=metrics, admission=admission)
+        self.connect(factory).dataReceived(FRAME)
+        rendered = metrics.render()
+        self.assertIn('admission_held_connections 1', rendered)
+        self.assertIn('admission_usage 1.0', rendered)
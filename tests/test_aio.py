@@ -0,0 +1,85 @@
+import asyncio
+
+from mock import Mock
+from twisted.trial.unittest import TestCase
+
+from txHL7.aio import MLLPServer
+
+from .test_mllp import CustomCaptureReceiver, UnrejectableMessage
+
+
+class FailingReceiver(CustomCaptureReceiver):
+    async def handleMessage(self, message_container):
+        if message_container.raw_message == u'BAD':
+            raise ValueError('bad message')
+        await asyncio.sleep(0.01)
+        return message_container.ack()
+
+
+class UnrejectableReceiver(FailingReceiver):
+    def parseMessage(self, raw_message):
+        return UnrejectableMessage(raw_message)
+
+
+class MLLPServerProtocolTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def connect(self, server, data, delay=0.05):
+        transport = Mock()
+
+        async def session():
+            protocol = server()
+            protocol.connection_made(transport)
+            protocol.data_received(data)
+            await asyncio.sleep(delay)
+            return protocol
+
+        return self.loop.run_until_complete(session()), transport
+
+    def testCoroutineErrorRejects(self):
+        protocol, transport = self.connect(
+            MLLPServer(FailingReceiver()), b'\x0bM1\x1c\x0d\x0bBAD\x1c\x0d\x0bM3\x1c\x0d'
+        )
+        self.assertEqual(
+            [c[0][0] for c in transport.write.call_args_list],
+            [b'\x0bACK-AA\x1c\x0d', b'\x0bACK-AR\x1c\x0d', b'\x0bACK-AA\x1c\x0d'],
+        )
+
+    def testFailedRejection(self):
+        protocol, transport = self.connect(
+            MLLPServer(UnrejectableReceiver()), b'\x0bBAD\x1c\x0d\x0bM2\x1c\x0d'
+        )
+        # the first message goes unanswered, without holding back the second
+        self.assertEqual(
+            [c[0][0] for c in transport.write.call_args_list],
+            [b'\x0bACK-AA\x1c\x0d'],
+        )
+        self.assertEqual(protocol.in_flight, 0)
+
+    def testPauseReading(self):
+        protocol, transport = self.connect(
+            MLLPServer(FailingReceiver(), max_in_flight=1),
+            b'\x0bM1\x1c\x0d\x0bM2\x1c\x0d', delay=0.001,
+        )
+        self.assertTrue(transport.pause_reading.called)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertTrue(transport.resume_reading.called)
+        self.assertEqual(transport.write.call_count, 2)
+
+    def testSynchronousReceiver(self):
+        protocol, transport = self.connect(MLLPServer(CustomCaptureReceiver()), b'\x0bM1\x1c\x0d', delay=0)
+        self.assertEqual(transport.write.call_args[0][0], b'\x0bACK-AA\x1c\x0d')
+
+    def testConnectionLostWhileHandling(self):
+        protocol, transport = self.connect(
+            MLLPServer(FailingReceiver(), max_in_flight=1),
+            b'\x0bM1\x1c\x0d\x0bM2\x1c\x0d', delay=0.001,
+        )
+        self.assertEqual(len(protocol.tasks), 1)
+        protocol.connection_lost(None)
+        # resuming reading once the response is done no longer fails
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(protocol.tasks, set())
+        self.assertFalse(transport.resume_reading.called)
@@ -0,0 +1,87 @@
+from mock import Mock
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from txHL7.batch import MessageBatcher
+from txHL7.mllp import MLLPFactory
+from txHL7.receiver import AbstractBatchReceiver
+
+from .test_mllp import CustomMessage
+
+
+class BatchCaptureReceiver(AbstractBatchReceiver):
+    message_cls = CustomMessage
+
+    def __init__(self):
+        self.batches = []
+
+    def handleMessages(self, message_containers):
+        self.batches.append([c.raw_message for c in message_containers])
+        return [
+            ValueError() if c.raw_message == u'BAD' else c.ack()
+            for c in message_containers
+        ]
+
+
+def connect(factory):
+    protocol = factory.buildProtocol(None)
+    protocol.makeConnection(Mock())
+    return protocol
+
+
+def written(protocol):
+    return [c[0][0] for c in protocol.transport.write.call_args_list]
+
+
+class BatchReceiverTest(TestCase):
+    def setUp(self):
+        self.receiver = BatchCaptureReceiver()
+        self.clock = task.Clock()
+
+    def testBatchPerRead(self):
+        protocol = connect(MLLPFactory(self.receiver))
+        protocol.dataReceived(b'\x0bM1\x1c\x0d\x0bBAD\x1c\x0d\x0bM3\x1c\x0d')
+        protocol.dataReceived(b'\x0bM4\x1c\x0d')
+
+        self.assertEqual(self.receiver.batches, [[u'M1', u'BAD', u'M3'], [u'M4']])
+        # only the failed message is rejected
+        self.assertEqual(written(protocol), [
+            b'\x0bACK-AA\x1c\x0d', b'\x0bACK-AR\x1c\x0d',
+            b'\x0bACK-AA\x1c\x0d', b'\x0bACK-AA\x1c\x0d',
+        ])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def testWindowAcrossConnections(self):
+        factory = MLLPFactory(self.receiver, batch_window=0.5, clock=self.clock)
+        first, second = connect(factory), connect(factory)
+        first.dataReceived(b'\x0bM1\x1c\x0d')
+        second.dataReceived(b'\x0bM2\x1c\x0d')
+        self.assertEqual(self.receiver.batches, [])
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.receiver.batches, [[u'M1', u'M2']])
+        self.assertEqual(written(first), [b'\x0bACK-AA\x1c\x0d'])
+        self.assertEqual(written(second), [b'\x0bACK-AA\x1c\x0d'])
+
+    def testBatchSize(self):
+        factory = MLLPFactory(self.receiver, batch_size=2, batch_window=10, clock=self.clock)
+        protocol = connect(factory)
+        protocol.dataReceived(b'\x0bM1\x1c\x0d\x0bM2\x1c\x0d\x0bM3\x1c\x0d')
+        self.assertEqual(self.receiver.batches, [[u'M1', u'M2']])
+        self.clock.advance(10)
+        self.assertEqual(self.receiver.batches, [[u'M1', u'M2'], [u'M3']])
+
+
+class MessageBatcherTest(TestCase):
+    def testHandlerFailureRejectsBatch(self):
+        batcher = MessageBatcher(lambda containers: defer.fail(RuntimeError()))
+        deferreds = [batcher.add(i) for i in range(2)]
+        batcher.flush()
+        for d in deferreds:
+            self.failureResultOf(d, RuntimeError)
+
+    def testResultCountMismatch(self):
+        batcher = MessageBatcher(lambda containers: [])
+        d = batcher.add(1)
+        batcher.flush()
+        self.failureResultOf(d, ValueError)
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.internet.testing import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txHL7.capture import CLOSE, FRAME, MAGIC, OPEN, CaptureWriter, read_capture
+from txHL7.mllp import MLLPFactory
+
+from .test_mllp import CustomCaptureReceiver
+from .utils import HL7_MESSAGE
+
+
+class CaptureWriterTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.time = 1000.0
+
+    def writer(self, **kwargs):
+        writer = CaptureWriter(self.directory, flush_interval=60, now=lambda: self.time, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def records(self, writer):
+        return [
+            record
+            for name in writer.files
+            for record in read_capture(os.path.join(self.directory, name))
+        ]
+
+    @defer.inlineCallbacks
+    def testRoundTrip(self):
+        writer = self.writer()
+        connection_id = writer.connectionOpened('10.0.0.1:2575')
+        self.time += 0.5
+        writer.framesReceived(connection_id, [HL7_MESSAGE, b'MSH|2'])
+        self.time += 0.5
+        writer.connectionClosed(connection_id)
+        self.assertEqual(writer.buffered, 4 * writer.header.size + 13 + len(HL7_MESSAGE) + 5)
+        yield writer.flush()
+        self.assertEqual((writer.records, writer.buffered), (4, 0))
+        # written by the writer's own thread, not the reactor's pool
+        self.assertEqual(writer._pool.name, 'txHL7.capture')
+        self.assertEqual(self.records(writer), [
+            (OPEN, connection_id, 1000.0, b'10.0.0.1:2575'),
+            (FRAME, connection_id, 1000.5, HL7_MESSAGE),
+            (FRAME, connection_id, 1000.5, b'MSH|2'),
+            (CLOSE, connection_id, 1001.0, b''),
+        ])
+
+    @defer.inlineCallbacks
+    def testRotation(self):
+        writer = self.writer(file_size=len(HL7_MESSAGE) * 2, max_files=2)
+        connection_id = writer.connectionOpened()
+        for i in range(4):
+            writer.framesReceived(connection_id, [HL7_MESSAGE] * 2)
+            yield writer.flush()
+        self.assertEqual(writer.files, ['capture-000003.cap', 'capture-000004.cap'])
+        self.assertEqual(sorted(os.listdir(self.directory)), writer.files)
+        self.assertEqual(len(self.records(writer)), 4)
+        yield writer.close()
+
+        # a new writer continues the numbering
+        writer = self.writer()
+        writer.connectionOpened()
+        yield writer.flush()
+        self.assertEqual(writer.files[-1], 'capture-000005.cap')
+
+    @defer.inlineCallbacks
+    def testCloseStopsThread(self):
+        writer = self.writer()
+        writer.connectionOpened()
+        yield writer.flush()
+        pool = writer._pool
+        yield writer.close()
+        self.assertIsNone(writer._pool)
+        self.assertTrue(pool.joined)
+
+    def testDropsWhenBehind(self):
+        writer = self.writer(max_buffered=len(HL7_MESSAGE) * 2)
+        connection_id = writer.connectionOpened()
+        writer.framesReceived(connection_id, [HL7_MESSAGE] * 3)
+        self.assertEqual(writer.dropped, 2)
+
+    def testNotACapture(self):
+        path = os.path.join(self.directory, 'capture-000001.cap')
+        with open(path, 'wb') as f:
+            f.write(b'MSH|')
+        self.assertRaises(ValueError, list, read_capture(path))
+
+    @defer.inlineCallbacks
+    def testTornRecord(self):
+        writer = self.writer()
+        writer.framesReceived(writer.connectionOpened(), [HL7_MESSAGE])
+        yield writer.close()
+        path = os.path.join(self.directory, writer.files[0])
+        with open(path, 'rb+') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        [(kind, connection_id, timestamp, payload)] = read_capture(path)
+        self.assertEqual(kind, OPEN)
+
+    @defer.inlineCallbacks
+    def testProtocolTap(self):
+        writer = self.writer()
+        factory = MLLPFactory(CustomCaptureReceiver(), capture=writer)
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d\x0bMSH|2\x1c')
+        protocol.dataReceived(b'\x0d')
+        protocol.connectionLost(None)
+        yield writer.flush()
+        with open(os.path.join(self.directory, writer.files[0]), 'rb') as f:
+            self.assertEqual(f.read(len(MAGIC)), MAGIC)
+        self.assertEqual([record[::3] for record in self.records(writer)], [
+            (OPEN, b'192.168.1.1:54321'),
+            (FRAME, HL7_MESSAGE),
+            (FRAME, b'MSH|2'),
+            (CLOSE, b''),
+        ])
@@ -0,0 +1,122 @@
+from mock import Mock
+from twisted.internet import defer, endpoints, reactor, task
+from twisted.trial.unittest import TestCase
+from zope.interface import implementer
+
+from txHL7.client import MLLPClient, MLLPClientFactory
+from txHL7.mllp import MLLPFactory
+from txHL7.receiver import IHL7Receiver, LazyHL7MessageContainer
+
+from .test_mllp import CaptureReceiver
+from .utils import message
+
+
+def ack(control_id):
+    return b'\x0bMSH|^~\\&|A|B|C|D|1||ACK^R01^ACK|X|P|2.4\rMSA|AA|' + control_id + b'\r\x1c\x0d'
+
+
+@implementer(IHL7Receiver)
+class LazyCaptureReceiver(CaptureReceiver):
+    def parseMessage(self, raw_message):
+        return LazyHL7MessageContainer(raw_message)
+
+    def getCodec(self):
+        return 'cp1252', 'strict'
+
+    def getTimeout(self):
+        return None
+
+
+class MLLPClientProtocolTest(TestCase):
+    def setUp(self):
+        self.destination = Mock()
+        self.destination.client = MLLPClient()
+        self.protocol = MLLPClientFactory(self.destination).buildProtocol(None)
+        self.protocol.makeConnection(Mock())
+
+    def testCorrelateByControlId(self):
+        first = self.protocol.sendMessage(b'M1', u'ID-1')
+        second = self.protocol.sendMessage(b'M2', u'ID-2')
+        self.assertEqual(self.protocol.outstanding, 2)
+
+        self.protocol.dataReceived(ack(b'ID-2') + ack(b'ID-1'))
+        self.assertTrue(self.successResultOf(first).endswith(u'MSA|AA|ID-1\r'))
+        self.assertTrue(self.successResultOf(second).endswith(u'MSA|AA|ID-2\r'))
+        self.assertEqual(self.protocol.outstanding, 0)
+
+    def testUnknownControlIdDiscarded(self):
+        first = self.protocol.sendMessage(b'M1', u'ID-1')
+        self.protocol.dataReceived(ack(b'OTHER'))
+        self.assertNoResult(first)
+        self.assertEqual(self.protocol.outstanding, 1)
+
+    def testMissingControlIdAssignedToOldest(self):
+        first = self.protocol.sendMessage(b'M1', u'ID-1')
+        self.protocol.sendMessage(b'M2', u'ID-2')
+        self.protocol.dataReceived(ack(b''))
+        self.assertTrue(self.successResultOf(first).endswith(u'MSA|AA|\r'))
+
+    def testLateAckOfCancelledSend(self):
+        first = self.protocol.sendMessage(b'M1', u'ID-1')
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        second = self.protocol.sendMessage(b'M2', u'ID-2')
+        # resent with the same control ID
+        third = self.protocol.sendMessage(b'M1', u'ID-1')
+        self.protocol.dataReceived(ack(b'ID-1'))
+        self.assertNoResult(second)
+        self.assertNoResult(third)
+        self.protocol.dataReceived(ack(b'ID-2') + ack(b'ID-1'))
+        self.assertTrue(self.successResultOf(second).endswith(u'MSA|AA|ID-2\r'))
+        self.assertTrue(self.successResultOf(third).endswith(u'MSA|AA|ID-1\r'))
+        self.assertEqual(self.protocol.cancelled, {})
+
+    def testConnectionLostFailsPending(self):
+        d = self.protocol.sendMessage(b'M1', u'ID-1')
+        self.protocol.connectionLost(Exception('gone'))
+        self.failureResultOf(d, Exception)
+
+    def testCancel(self):
+        d = self.protocol.sendMessage(b'M1', u'ID-1')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.protocol.outstanding, 0)
+
+
+class MLLPClientTest(TestCase):
+    timeout = 30
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.receiver = LazyCaptureReceiver()
+        endpoint = endpoints.serverFromString(reactor, 'tcp:0:interface=127.0.0.1')
+        self.port = yield endpoint.listen(MLLPFactory(self.receiver))
+        self.addCleanup(self.port.stopListening)
+        self.endpoint = 'tcp:host=127.0.0.1:port={0}'.format(self.port.getHost().port)
+        self.client = MLLPClient(encoding='cp1252', pool_size=2, window=4)
+        self.addCleanup(self.client.close)
+
+    @defer.inlineCallbacks
+    def testPipelinedSends(self):
+        control_ids = [u'CTRL-{0}'.format(i) for i in range(20)]
+        acks = yield defer.gatherResults([
+            self.client.send(self.endpoint, message(control_id))
+            for control_id in control_ids
+        ])
+        for control_id, response in zip(control_ids, acks):
+            self.assertTrue(response.endswith(u'MSA|AA|' + control_id + u'\r'))
+        self.assertEqual(len(self.receiver.messages), 20)
+        self.assertEqual(len(self.client.destinations[self.endpoint].connections), 2)
+
+    @defer.inlineCallbacks
+    def testReconnect(self):
+        self.client.retryPolicy = lambda attempt: 0.01
+        yield self.client.send(self.endpoint, message(u'BEFORE'))
+        destination = self.client.destinations[self.endpoint]
+        for connection in list(destination.connections):
+            connection.transport.loseConnection()
+        while destination.connections:
+            yield task.deferLater(reactor, 0.001, lambda: None)
+
+        response = yield self.client.send(self.endpoint, message(u'AFTER'))
+        self.assertTrue(response.endswith(u'MSA|AA|AFTER\r'))
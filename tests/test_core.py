@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from mock import Mock
+from twisted.trial.unittest import TestCase
+
+from txHL7 import offload
+from txHL7.core import BytesCodec, CharsetCodec, MLLPCodec
+from txHL7.framing import FramedMessage
+from txHL7.mllp import MinimalLowerLayerProtocol, MLLPFactory
+from txHL7.offload import _parse_payload, _start_worker
+from txHL7.receiver import (
+    AbstractBytesReceiver, AbstractReceiver, LazyHL7MessageContainer
+)
+
+from .utils import HL7_MESSAGE
+
+UTF8_MESSAGE = (
+    HL7_MESSAGE.replace(b'|P|2.4', b'|P|2.4||||||UNICODE UTF-8')
+    .replace(b'EVERYWOMAN', u'ÉVÉ'.encode('utf-8'))
+)
+LATIN1_MESSAGE = (
+    HL7_MESSAGE.replace(b'|P|2.4', b'|P|2.4||||||8859/1~UNICODE UTF-8')
+    .replace(b'EVERYWOMAN', u'ÉVÉ'.encode('latin-1'))
+    .replace(b'GHH LAB', u'GHH LÄB'.encode('latin-1'))
+)
+
+
+class ForwardingReceiver(AbstractBytesReceiver):
+    def __init__(self):
+        self.messages = []
+
+    def handleMessage(self, message_container):
+        self.messages.append(message_container.raw_message)
+        return message_container.ack()
+
+
+class TextReceiver(AbstractReceiver):
+    message_cls = LazyHL7MessageContainer
+
+    def __init__(self, codec=None):
+        self.messages = []
+        self.codec = codec
+
+    def handleMessage(self, message_container):
+        self.messages.append(message_container.raw_message)
+        return message_container.ack()
+
+    def getCodec(self):
+        return self.codec
+
+
+def create_protocol(receiver, **kwargs):
+    protocol = MinimalLowerLayerProtocol()
+    protocol.factory = MLLPFactory(receiver, **kwargs)
+    protocol.makeConnection(Mock())
+    return protocol
+
+
+class CodecTest(TestCase):
+    def testFromReceiver(self):
+        self.assertIsInstance(MLLPCodec.fromReceiver(ForwardingReceiver()), BytesCodec)
+        codec = CharsetCodec()
+        self.assertIs(MLLPCodec.fromReceiver(TextReceiver(codec)), codec)
+        codec = MLLPCodec.fromReceiver(TextReceiver(('cp1252', 'replace')))
+        self.assertEqual((codec.encoding, codec.errors), ('cp1252', 'replace'))
+
+    def testBytesCodec(self):
+        codec = BytesCodec()
+        # the encoding is still that of the wire, for responses
+        self.assertEqual((codec.decodes, codec.encoding), (False, 'ascii'))
+        self.assertIs(codec.decode(HL7_MESSAGE), HL7_MESSAGE)
+        self.assertIs(codec.encode(HL7_MESSAGE), HL7_MESSAGE)
+        self.assertEqual(codec.encode(u'ACK'), b'ACK')
+        self.assertIs(codec.forMessage(HL7_MESSAGE), codec)
+
+    def testCharsetCodec(self):
+        codec = CharsetCodec(default=MLLPCodec('ascii'))
+        self.assertEqual(codec.forMessage(UTF8_MESSAGE).encoding, 'utf-8')
+        # the first repetition is the message's character set
+        self.assertEqual(codec.forMessage(LATIN1_MESSAGE).encoding, 'iso8859-1')
+        self.assertIs(codec.forMessage(HL7_MESSAGE), codec.default)
+        self.assertIn(u'ÉVÉ', codec.decode(UTF8_MESSAGE))
+        self.assertEqual(codec.encode(codec.decode(LATIN1_MESSAGE)), LATIN1_MESSAGE)
+
+    def testCharsetCodecCache(self):
+        codec = CharsetCodec(charsets={'X-CUSTOM': 'cp1252', 'X-MISSING': 'no-such-codec'})
+        custom = HL7_MESSAGE.replace(b'|P|2.4', b'|P|2.4||||||x-custom')
+        self.assertEqual(codec.forMessage(custom).encoding, 'cp1252')
+        self.assertIs(codec.forMessage(custom), codec.forMessage(custom))
+        missing = HL7_MESSAGE.replace(b'|P|2.4', b'|P|2.4||||||X-MISSING')
+        self.assertIs(codec.forMessage(missing), codec.default)
+        self.assertEqual(len(codec._codecs), 2)
+
+
+class BytesReceiverTest(TestCase):
+    def testNoDecode(self):
+        receiver = ForwardingReceiver()
+        protocol = create_protocol(receiver)
+        protocol.factory.decode = Mock(side_effect=AssertionError('decoded'))
+        protocol.dataReceived(b'\x0b' + UTF8_MESSAGE + b'\x1c\x0d')
+        self.assertEqual(receiver.messages, [UTF8_MESSAGE])
+        written = protocol.transport.write.call_args[0][0]
+        self.assertTrue(written.startswith(b'\x0bMSH|^~\\&|GHH OE|BLDG4|GHH LAB|ELAB-3|'))
+        self.assertTrue(written.endswith(b'MSA|AA|CNTRL-3456\r\x1c\x0d'))
+
+    def testOffloadedParseNotDecoded(self):
+        import pickle
+        receiver = ForwardingReceiver()
+        _start_worker(pickle.dumps(receiver.parseMessage))
+        self.addCleanup(setattr, offload, '_parse', None)
+        payload = pickle.dumps((UTF8_MESSAGE, None, None))
+        container = pickle.loads(_parse_payload(payload)[0])
+        self.assertEqual(container.raw_message, UTF8_MESSAGE)
+
+
+class DetectCharsetTest(TestCase):
+    def testPerMessageCodec(self):
+        receiver = TextReceiver(('ascii', 'strict'))
+        protocol = create_protocol(receiver, detect_charset=True)
+        protocol.dataReceived(b'\x0b' + UTF8_MESSAGE + b'\x1c\x0d')
+        protocol.dataReceived(b'\x0b' + LATIN1_MESSAGE + b'\x1c\x0d')
+        protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        self.assertEqual(len(receiver.messages), 3)
+        self.assertIn(u'ÉVÉ', receiver.messages[0])
+        self.assertIn(u'GHH LÄB', receiver.messages[1])
+
+        acks = [call[0][0] for call in protocol.transport.write.call_args_list]
+        # the ACK echoes the sender in the message's own character set
+        self.assertIsInstance(acks[1], FramedMessage)
+        self.assertIn(u'|GHH LÄB|'.encode('latin-1'), acks[1])
+        self.assertIn(b'MSA|AA|CNTRL-3456', acks[2])
+
+    def testBytesReceiverUnaffected(self):
+        protocol = create_protocol(ForwardingReceiver(), detect_charset=True)
+        self.assertIsInstance(protocol.factory.codec, BytesCodec)
@@ -0,0 +1,155 @@
+from mock import Mock
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from txHL7.dedup import DuplicateCache
+from txHL7.framing import FramedMessage, frame
+from txHL7.mllp import MinimalLowerLayerProtocol, MLLPFactory
+
+from .test_mllp import HL7CaptureReceiver, HL7ControlMessage
+from .utils import HL7_MESSAGE
+
+ACK = frame(b'MSH|^~\\&|GHH OE|BLDG4|GHH LAB|ELAB-3|20020215||ACK^R01^ACK|1|P|2.4\rMSA|AA|CNTRL-3456')
+NAK = frame(b'MSH|^~\\&|GHH OE|BLDG4|GHH LAB|ELAB-3|20020215||ACK^R01^ACK|1|P|2.4\rMSA|AR|CNTRL-3456')
+
+
+class CountingReceiver(HL7CaptureReceiver):
+    def __init__(self):
+        super(CountingReceiver, self).__init__()
+        self.parsed = 0
+
+    def parseMessage(self, raw_message):
+        self.parsed += 1
+        return super(CountingReceiver, self).parseMessage(raw_message)
+
+
+class DuplicateCacheTest(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = DuplicateCache(max_entries=2, ttl=60, clock=self.clock)
+
+    def testKey(self):
+        self.assertEqual(DuplicateCache.key(HL7_MESSAGE), (b'ELAB-3', b'CNTRL-3456'))
+        self.assertIsNone(DuplicateCache.key(b'MSH|^~\\&|A|B'))
+
+    def testHit(self):
+        key = (b'F', b'1')
+        self.assertIsNone(self.cache.begin(key))
+        self.assertEqual(self.cache.finish(key, ACK), ACK)
+        ack = self.successResultOf(self.cache.begin(key))
+        self.assertEqual(ack, ACK)
+        self.assertIsInstance(ack, FramedMessage)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def testWaitForOriginal(self):
+        key = (b'F', b'1')
+        self.assertIsNone(self.cache.begin(key))
+        d = self.cache.begin(key)
+        self.assertNoResult(d)
+        self.cache.finish(key, ACK)
+        self.assertEqual(self.successResultOf(d), ACK)
+        self.assertEqual(self.cache.waits, 1)
+
+    def testRejectionNotCached(self):
+        key = (b'F', b'1')
+        self.cache.begin(key)
+        waiting = self.cache.begin(key)
+        self.cache.finish(key, NAK)
+        # the duplicate already waiting gets the rejection, later ones retry
+        self.assertEqual(self.successResultOf(waiting), NAK)
+        self.assertIsNone(self.cache.begin(key))
+        self.assertEqual(len(self.cache), 0)
+
+    def testExpiry(self):
+        key = (b'F', b'1')
+        self.cache.begin(key)
+        self.cache.finish(key, ACK)
+        self.clock.advance(61)
+        self.assertIsNone(self.cache.begin(key))
+        self.assertEqual(self.cache.expirations, 1)
+
+    def testEvictLeastRecentlyUsed(self):
+        for i in (b'1', b'2'):
+            self.cache.begin((b'F', i))
+            self.cache.finish((b'F', i), ACK)
+        self.successResultOf(self.cache.begin((b'F', b'1')))
+        self.cache.begin((b'F', b'3'))
+        self.cache.finish((b'F', b'3'), ACK)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertIsNone(self.cache.begin((b'F', b'2')))
+        self.successResultOf(self.cache.begin((b'F', b'1')))
+
+
+class ProtocolDuplicateTest(TestCase):
+    def setUp(self):
+        self.receiver = CountingReceiver()
+        self.cache = DuplicateCache(clock=task.Clock())
+        self.protocol = MinimalLowerLayerProtocol()
+        self.protocol.factory = MLLPFactory(self.receiver, duplicates=self.cache)
+        self.protocol.makeConnection(Mock())
+
+    def written(self):
+        return [call[0][0] for call in self.protocol.transport.write.call_args_list]
+
+    def testRetransmitAnsweredFromCache(self):
+        self.protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        self.protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        first, second = self.written()
+        self.assertEqual(first, second)
+        self.assertEqual(self.receiver.parsed, 1)
+        self.assertEqual(len(self.receiver.messages), 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def testMetrics(self):
+        from txHL7.metrics import Metrics
+        metrics = Metrics()
+        MLLPFactory(self.receiver, duplicates=self.cache, metrics=metrics)
+        self.cache.begin((b'F', b'1'))
+        text = metrics.render()
+        self.assertIn('# TYPE txhl7_duplicate_misses_total counter\ntxhl7_duplicate_misses_total 1\n', text)
+        self.assertIn('txhl7_duplicate_entries 0\n', text)
+
+    def testRetransmitWhileHandling(self):
+        pending = defer.Deferred()
+        self.receiver.handleMessage = lambda container: pending.addCallback(
+            lambda ignored: container.ack())
+        data = b'\x0b' + HL7_MESSAGE + b'\x1c\x0d'
+        self.protocol.dataReceived(data + data)
+        self.assertEqual(self.written(), [])
+        pending.callback(None)
+        first, second = self.written()
+        self.assertEqual(first, second)
+        self.assertEqual(self.receiver.parsed, 1)
+        self.assertEqual(self.protocol.in_flight, 0)
+
+    def testRejectedRetransmitHandledAgain(self):
+        self.receiver.ack_code = 'AE'
+        self.protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        self.receiver.ack_code = 'AA'
+        self.protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        first, second = self.written()
+        self.assertIn(b'MSA|AE|', first)
+        self.assertIn(b'MSA|AA|', second)
+        self.assertEqual(self.receiver.parsed, 2)
+
+    def testDistinctControlIds(self):
+        self.protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        other = HL7_MESSAGE.replace(b'CNTRL-3456', b'CNTRL-1')
+        self.protocol.dataReceived(b'\x0b' + other + b'\x1c\x0d')
+        self.assertEqual(self.receiver.parsed, 2)
+        self.assertEqual(self.cache.misses, 2)
+
+    def testRetransmitAfterFailedResponse(self):
+        pending = defer.Deferred()
+        self.receiver.handleMessage = lambda container: pending
+        data = b'\x0b' + HL7_MESSAGE + b'\x1c\x0d'
+        self.protocol.dataReceived(data + data)
+        self.patch(HL7ControlMessage, 'err', lambda self, err: 1 / 0)
+        pending.errback(Exception())
+        # neither is answered, and the key is released for the next one
+        self.assertEqual(self.written(), [])
+        self.assertEqual(self.protocol.in_flight, 0)
+        self.assertIsNone(self.cache.begin(DuplicateCache.key(HL7_MESSAGE)))
+        # the handling error and the failed rejection
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 2)
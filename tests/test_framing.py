@@ -0,0 +1,74 @@
+from twisted.trial.unittest import TestCase
+
+from txHL7.framing import FrameTooLarge, MLLPFrameScanner
+
+from .utils import HL7_MESSAGE
+
+
+def frame(message):
+    return b'\x0b' + message + b'\x1c\x0d'
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class CountingBuffer(bytearray):
+    """bytearray that records how many bytes each ``find`` searches"""
+    scanned = 0
+
+    def find(self, sub, start=0):
+        CountingBuffer.scanned += len(self) - start
+        return super(CountingBuffer, self).find(sub, start)
+
+
+class MLLPFrameScannerTest(TestCase):
+    def setUp(self):
+        self.scanner = MLLPFrameScanner()
+
+    def testSingleFrame(self):
+        self.assertEqual(self.scanner.feed(frame(HL7_MESSAGE)), [HL7_MESSAGE])
+        self.assertEqual(len(self.scanner), 1)  # trailing <CR>
+
+    def testMultipleFramesInOneChunk(self):
+        frames = self.scanner.feed(frame(HL7_MESSAGE) + frame(b'MSH|2') + frame(b'MSH|3'))
+        # the <CR> trailer of a frame is not carried into the next message
+        self.assertEqual(frames, [HL7_MESSAGE, b'MSH|2', b'MSH|3'])
+
+    def testFrameSplitAcrossChunks(self):
+        data = frame(HL7_MESSAGE) * 3
+        frames = []
+        for chunk in chunked(data, 7):
+            frames.extend(self.scanner.feed(chunk))
+        self.assertEqual(frames, [HL7_MESSAGE] * 3)
+
+    def testEmptyFramesDropped(self):
+        self.assertEqual(self.scanner.feed(b'\x0b\x1c\x0d\x0b\x1c\x0d'), [])
+
+    def testLinearScan(self):
+        # a large frame arriving in many reads is searched exactly once,
+        # independently of the chunk size
+        data = frame(b'OBX|' + b'A' * (1024 * 1024))
+        for size in (1024, 16 * 1024, 64 * 1024):
+            scanner = MLLPFrameScanner()
+            scanner._buffer = CountingBuffer()
+            CountingBuffer.scanned = 0
+            frames = []
+            for chunk in chunked(data, size):
+                frames.extend(scanner.feed(chunk))
+            self.assertEqual(len(frames), 1)
+            self.assertEqual(len(frames[0]), len(data) - 3)
+            # every byte searched once, plus the <CR> after the end block
+            self.assertEqual(CountingBuffer.scanned, len(data) + 1)
+
+    def testMaxFrameSizeComplete(self):
+        scanner = MLLPFrameScanner(max_frame_size=len(HL7_MESSAGE))
+        self.assertEqual(scanner.feed(frame(HL7_MESSAGE)), [HL7_MESSAGE])
+        self.assertRaises(FrameTooLarge, scanner.feed, frame(HL7_MESSAGE + b'X'))
+
+    def testMaxFrameSizeUnterminated(self):
+        scanner = MLLPFrameScanner(max_frame_size=100)
+        scanner.feed(b'\x0b' + b'A' * 100)
+        # rejected before the end block ever arrives
+        self.assertRaises(FrameTooLarge, scanner.feed, b'A')
+        self.assertEqual(len(scanner), 0)
@@ -0,0 +1,84 @@
+from twisted.trial.unittest import TestCase
+
+from txHL7.histogram import BusyTimer, Histogram
+
+
+class HistogramTest(TestCase):
+    def testExactBelowPrecision(self):
+        histogram = Histogram()
+        for value in range(1, 101):
+            histogram.record(value)
+        self.assertEqual(len(histogram), 100)
+        self.assertEqual(histogram.percentile(50), 50)
+        self.assertEqual(histogram.percentile(99), 99)
+        self.assertEqual(histogram.percentile(100), 100)
+        self.assertEqual(histogram.min, 1)
+        self.assertEqual(histogram.mean(), 50.5)
+
+    def testRelativePrecision(self):
+        histogram = Histogram()
+        values = [int(1.37 ** i) for i in range(10, 60)]
+        for value in values:
+            histogram.record(value)
+        for i, value in enumerate(values):
+            estimate = histogram.percentile(100.0 * (i + 1) / len(values))
+            self.assertTrue(value <= estimate <= value * 1.001, (value, estimate))
+
+    def testBucketsAreSparse(self):
+        histogram = Histogram()
+        histogram.record(10 ** 9, count=1000)
+        histogram.record(5)
+        self.assertEqual(len(histogram.counts), 2)
+        self.assertEqual(histogram.percentile(0.05), 5)
+        self.assertEqual(histogram.percentile(99.9), 10 ** 9)
+
+    def testExpectedInterval(self):
+        # a 1000us stall in a 100us loop hides nine measurements
+        histogram = Histogram()
+        histogram.record(1000, expected_interval=100)
+        self.assertEqual(len(histogram), 10)
+        self.assertEqual(histogram.min, 100)
+        self.assertEqual(histogram.percentile(50), 500)
+
+    def testMerge(self):
+        a, b = Histogram(), Histogram()
+        a.record(10)
+        b.record(5000, count=3)
+        a.merge(b)
+        self.assertEqual(len(a), 4)
+        self.assertEqual((a.min, a.max), (10, 5000))
+        self.assertEqual(a.percentile(50), 5000)
+
+    def testSummary(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.summary()['p99.9'], 0)
+        histogram.record(7)
+        self.assertEqual(histogram.summary(), {
+            'count': 1, 'min': 7, 'mean': 7.0, 'max': 7,
+            'p50': 7, 'p99': 7, 'p99.9': 7,
+        })
+        self.assertEqual(
+            histogram.summaryLine(scale=1),
+            'p50 7.000  p99 7.000  p99.9 7.000  max 7.000  mean 7.000',
+        )
+
+    def testNegative(self):
+        self.assertRaises(ValueError, Histogram().record, -1)
+
+
+class BusyTimerTest(TestCase):
+    def testUtilization(self):
+        self.time = 0.0
+        timer = BusyTimer(2, now=lambda: self.time)
+        self.assertEqual(timer.utilization, 0.0)
+        timer.start()
+        first = timer.begin()
+        self.time = 1.0
+        second = timer.begin()
+        self.time = 2.0
+        timer.end(first)
+        self.assertEqual((timer.running, timer.busy_time), (1, 2.0))
+        # one slot for two seconds and the other for one, of four
+        self.assertEqual(timer.utilization, 0.75)
+        timer.end(second)
+        self.assertEqual((timer.running, timer.utilization), (0, 0.75))
@@ -0,0 +1,133 @@
+import asyncio
+
+from mock import Mock
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from txHL7.aio import MLLPServer
+from txHL7.idle import IdleTimer
+from txHL7.mllp import MLLPFactory
+
+from .test_mllp import CustomCaptureReceiver
+
+
+class Connection(object):
+    def __init__(self):
+        self.timed_out = False
+
+    def timeoutConnection(self):
+        self.timed_out = True
+
+
+class CountingTimer(IdleTimer):
+    sweeps = 0
+
+    def sweep(self):
+        self.sweeps += 1
+        IdleTimer.sweep(self)
+
+
+class TimeoutReceiver(CustomCaptureReceiver):
+    def getTimeout(self):
+        return 10
+
+
+class IdleTimerTest(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timer = IdleTimer(10, resolution=1.0, clock=self.clock)
+
+    def testTimeout(self):
+        idle, active = Connection(), Connection()
+        self.timer.add(idle)
+        self.timer.add(active)
+        self.assertEqual(len(self.timer), 2)
+        for i in range(12):
+            self.clock.advance(1)
+            self.timer.touch(active)
+        self.assertTrue(idle.timed_out)
+        self.assertFalse(active.timed_out)
+        self.assertEqual((len(self.timer), self.timer.expired), (1, 1))
+
+        self.clock.advance(11)
+        self.assertTrue(active.timed_out)
+        self.assertEqual(len(self.timer), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def testWithinResolution(self):
+        self.clock.advance(0.5)
+        connection = Connection()
+        self.timer.add(connection)
+        self.clock.advance(9.9)
+        self.assertFalse(connection.timed_out)
+        self.clock.advance(0.6)
+        self.assertTrue(connection.timed_out)
+
+    def testBusyConnectionsSweptOncePerTimeout(self):
+        timer = CountingTimer(10, resolution=1.0, clock=self.clock)
+        connections = [Connection() for i in range(100)]
+        for connection in connections:
+            timer.add(connection)
+        for i in range(300):
+            self.clock.advance(0.1)
+            for connection in connections:
+                timer.touch(connection)
+        self.assertFalse(any(c.timed_out for c in connections))
+        # one sweep per timeout, not one timer per read
+        self.assertEqual(timer.sweeps, 3)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def testRemove(self):
+        connection = Connection()
+        self.timer.add(connection)
+        self.timer.remove(connection)
+        self.timer.remove(connection)
+        self.assertEqual(len(self.timer), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(20)
+        self.assertFalse(connection.timed_out)
+
+
+class ProtocolTimeoutTest(TestCase):
+    def testFactoryTimer(self):
+        clock = task.Clock()
+        factory = MLLPFactory(TimeoutReceiver(), clock=clock)
+        protocols = []
+        for i in range(3):
+            protocol = factory.buildProtocol(None)
+            protocol.makeConnection(Mock())
+            protocols.append(protocol)
+        self.assertEqual(len(factory.idle), 3)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        clock.advance(6)
+        protocols[0].dataReceived(b'\x0bM1\x1c\x0d')
+        protocols[2].connectionLost(None)
+        clock.advance(5)
+        self.assertFalse(protocols[0].transport.loseConnection.called)
+        self.assertTrue(protocols[1].transport.loseConnection.called)
+        self.assertFalse(protocols[2].transport.loseConnection.called)
+        clock.advance(6)
+        self.assertTrue(protocols[0].transport.loseConnection.called)
+
+    def testNoTimeout(self):
+        self.assertIsNone(MLLPFactory(CustomCaptureReceiver()).idle)
+
+    def testAsyncio(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        server = MLLPServer(TimeoutReceiver(), idle_resolution=0.01)
+        server.timeout = 0.05
+        transport = Mock()
+
+        async def session():
+            protocol = server()
+            protocol.connection_made(transport)
+            await asyncio.sleep(0.03)
+            self.assertFalse(transport.close.called)
+            await asyncio.sleep(0.1)
+            protocol.connection_lost(None)
+
+        loop.run_until_complete(session())
+        self.assertTrue(transport.close.called)
+        self.assertEqual(server.idle.expired, 1)
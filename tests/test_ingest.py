@@ -0,0 +1,147 @@
+import io
+import os
+import tempfile
+
+from twisted.internet import defer, reactor, task
+from twisted.trial.unittest import TestCase
+
+from txHL7.framing import FramedMessage
+from txHL7.ingest import (
+    Ingester, ShardedIngester, ack_code, iter_messages, shard
+)
+from txHL7.receiver import AbstractReceiver, LazyHL7MessageContainer
+
+from .utils import HL7_MESSAGE, PendingReceiver
+
+MESSAGES = [HL7_MESSAGE.replace(b'CNTRL-3456', 'C{0}'.format(i).encode('ascii')) for i in range(20)]
+
+
+def write_file(test, data):
+    fd, path = tempfile.mkstemp(suffix='.hl7')
+    test.addCleanup(os.remove, path)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def batch_file(messages):
+    body = b''.join(messages).replace(b'\r', b'\r\n')
+    trailer = b'BTS|' + str(len(messages)).encode('ascii') + b'\r\nFTS|1\r\n'
+    return b'FHS|^~\\&|GHH LAB\r\nBHS|^~\\&|GHH LAB\r\n' + body + trailer
+
+
+def mllp_file(messages):
+    return b''.join(b'\x0b' + message + b'\x1c\x0d' for message in messages)
+
+
+class ControlIDReceiver(AbstractReceiver):
+    """Rejects messages with an odd control ID and fails on C13"""
+    message_cls = LazyHL7MessageContainer
+
+    def __init__(self):
+        self.control_ids = []
+
+    def handleMessage(self, message_container):
+        control_id = message_container.view.field(u'MSH', 10)
+        if control_id == u'C13':
+            raise ValueError('failed')
+        self.control_ids.append(control_id)
+        return message_container.ack('AE' if int(control_id[1:]) % 2 else 'AA')
+
+
+class IterMessagesTest(TestCase):
+    def testBatchFile(self):
+        data = batch_file(MESSAGES[:3])
+        self.assertEqual([m for o, m in iter_messages(data)], MESSAGES[:3])
+
+    def testMLLPWrapped(self):
+        data = b'\r\n' + mllp_file(MESSAGES[:3])
+        self.assertEqual([m for o, m in iter_messages(data)], MESSAGES[:3])
+
+    def testUnterminatedFrame(self):
+        data = mllp_file(MESSAGES[:2]) + b'\x0b' + MESSAGES[2]
+        self.assertEqual([m for o, m in iter_messages(data)], MESSAGES[:2])
+
+    def testRanges(self):
+        # every message is yielded by exactly one range, wherever it is cut
+        for data in (batch_file(MESSAGES), mllp_file(MESSAGES)):
+            for cuts in ([0, 1, 500, 1000, 5000], [0, 2, 3, 4, 9999], [0, 700]):
+                bounds = cuts + [len(data)]
+                messages = []
+                for start, end in zip(bounds, bounds[1:]):
+                    messages.extend(m for o, m in iter_messages(data, start, end))
+                self.assertEqual(messages, MESSAGES)
+
+
+class ShardTest(TestCase):
+    def testShard(self):
+        first = write_file(self, b'x' * 100)
+        empty = write_file(self, b'')
+        second = write_file(self, b'x' * 50)
+        self.assertEqual(shard([first, empty, second], 3), [
+            [(first, 0, 50)],
+            [(first, 50, 100)],
+            [(second, 0, 50)],
+        ])
+        self.assertEqual(shard([second], 100), [[(second, i, i + 1)] for i in range(50)])
+        self.assertEqual(shard([empty], 4), [])
+
+
+class IngesterTest(TestCase):
+    @defer.inlineCallbacks
+    def testResults(self):
+        receiver = ControlIDReceiver()
+        out = io.StringIO()
+        ingester = Ingester(receiver, concurrency=3, out=out)
+        paths = [write_file(self, batch_file(MESSAGES[:10])), write_file(self, mllp_file(MESSAGES[10:]))]
+        result = yield ingester.ingest(paths)
+        self.assertIs(result, ingester)
+        self.assertEqual(receiver.control_ids, ['C{0}'.format(i) for i in range(20) if i != 13])
+        self.assertEqual((ingester.messages, ingester.errors), (20, 1))
+        # the odd control IDs, including C13, which was rejected with AR
+        self.assertEqual(ingester.rejected, 10)
+        self.assertEqual(ingester.bytes, ingester.total_bytes)
+        self.assertEqual(len(ingester.histogram), 20)
+        self.flushLoggedErrors(ValueError)
+
+        ingester.report(out)
+        self.assertIn('messages 20, rejected 10, errors 1', out.getvalue())
+        self.assertEqual(ingester.result(), 'txhl7-ingest-result messages=20 rejected=10 errors=1 bytes={0}'.format(ingester.bytes))
+
+    @defer.inlineCallbacks
+    def testConcurrency(self):
+        receiver = PendingReceiver()
+        ingester = Ingester(receiver, concurrency=4)
+        d = ingester.ingest([write_file(self, mllp_file(MESSAGES))])
+        while not d.called:
+            # let the cooperator dispatch the next messages, then answer them
+            yield task.deferLater(reactor, 0, lambda: None)
+            self.assertLessEqual(ingester.outstanding, 4)
+            receiver.complete(len(receiver.pending))
+        yield d
+        self.assertEqual(ingester.messages, 20)
+        self.assertEqual(receiver.max_pending, 4)
+        self.assertEqual(ingester.outstanding, 0)
+
+    def testAckCode(self):
+        self.assertEqual(ack_code(u'MSH|^~\\&\rMSA|AE|1\r'), b'AE')
+        self.assertEqual(ack_code(FramedMessage(b'\x0bMSH|^~\\&\rMSA|AA|1\r\x1c\r')), b'AA')
+        self.assertIsNone(ack_code(b'MSH|^~\\&\r'))
+
+
+class ShardedIngesterTest(TestCase):
+    timeout = 60
+
+    @defer.inlineCallbacks
+    def testWorkers(self):
+        paths = [write_file(self, batch_file(MESSAGES)), write_file(self, mllp_file(MESSAGES))]
+        out, err = io.StringIO(), io.StringIO()
+        ingester = ShardedIngester(
+            paths, ['--receiver', 'txHL7.router.AcceptReceiver'], 3, out=out, err=err,
+        )
+        yield ingester.run()
+        self.assertEqual(len(ingester.processes), 3)
+        self.assertEqual(ingester.failed, 0, err.getvalue())
+        self.assertEqual((ingester.messages, ingester.rejected, ingester.errors), (40, 0, 0))
+        self.assertEqual(ingester.bytes, ingester.total_bytes)
+        self.assertIn('[worker 2] messages ', out.getvalue())
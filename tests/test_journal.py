@@ -0,0 +1,195 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from txHL7.journal import Journal, JournalingReceiver, SegmentLog, SegmentReader
+from txHL7.receiver import AbstractReceiver, LazyHL7MessageContainer
+
+from .utils import HL7_MESSAGE
+
+MESSAGE = HL7_MESSAGE.decode('ascii')
+
+
+class RecordingReceiver(AbstractReceiver):
+    message_cls = LazyHL7MessageContainer
+
+    def __init__(self, failures=0):
+        self.messages = []
+        self.failures = failures
+        self.delivered = defer.Deferred()
+        self.expected = None
+
+    def handleMessage(self, message_container):
+        if self.failures:
+            self.failures -= 1
+            raise Exception('downstream unavailable')
+        self.messages.append(message_container.view.field('MSH', 10))
+        if self.expected is not None and len(self.messages) >= self.expected:
+            self.delivered.callback(self.messages)
+        return message_container.ack()
+
+    def waitFor(self, count):
+        self.expected = count
+        if len(self.messages) >= count:
+            return defer.succeed(self.messages)
+        return self.delivered
+
+
+def message(n):
+    return MESSAGE.replace('CNTRL-3456', 'C{0}'.format(n))
+
+
+def make_directory(test):
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory)
+    return directory
+
+
+class SegmentLogTest(TestCase):
+    def setUp(self):
+        self.directory = make_directory(self)
+
+    def testAppendAndRead(self):
+        segment_log = SegmentLog(self.directory, segment_size=100)
+        for i in range(5):
+            self.assertEqual(segment_log.append(message(i).encode('ascii')), i + 1)
+        segment_log.sync(segment_log.syncTargets())
+        # every record fills a segment of 100 bytes
+        self.assertEqual(segment_log.segments, [1, 2, 3, 4, 5])
+
+        reader = SegmentReader(segment_log, after=2)
+        self.assertEqual(
+            [seq for seq, payload in reader.read(4)], [3, 4],
+        )
+        seq, payload = reader.read(5)[0]
+        self.assertEqual((seq, payload), (5, message(4).encode('ascii')))
+        self.assertEqual(reader.read(5), [])
+        reader.close()
+
+        segment_log.removeBefore(3)
+        self.assertEqual(segment_log.segments, [4, 5])
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        segment_log.close()
+
+    def testRecoverTornRecord(self):
+        segment_log = SegmentLog(self.directory)
+        segment_log.append(b'first')
+        segment_log.append(b'second')
+        segment_log.close()
+        path = segment_log.path(1)
+        size = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            f.write(segment_log.header.pack(3, 100, 0) + b'torn')
+
+        segment_log = SegmentLog(self.directory)
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(segment_log.append(b'third'), 3)
+        segment_log.close()
+        reader = SegmentReader(SegmentLog(self.directory))
+        self.assertEqual(
+            [payload for seq, payload in reader.read(3)], [b'first', b'second', b'third']
+        )
+        reader.close()
+
+
+class JournalTest(TestCase):
+    @defer.inlineCallbacks
+    def testGroupCommit(self):
+        journal = Journal(make_directory(self))
+        self.addCleanup(journal.close)
+        seqs = yield defer.gatherResults([journal.append(b'x') for i in range(50)])
+        self.assertEqual(seqs, list(range(1, 51)))
+        self.assertEqual(journal.durable, 50)
+        self.assertEqual(journal.records, 50)
+        # the first record is synced alone, the rest wait for the next fsync
+        self.assertEqual(journal.commits, 2)
+
+    @defer.inlineCallbacks
+    def testCheckpoint(self):
+        directory = make_directory(self)
+        journal = Journal(directory)
+        self.assertEqual(journal.readCheckpoint(), 0)
+        yield journal.checkpoint(7)
+        journal.close()
+        self.assertEqual(Journal(directory).readCheckpoint(), 7)
+
+
+class JournalingReceiverTest(TestCase):
+    def setUp(self):
+        self.directory = make_directory(self)
+
+    def createReceiver(self, downstream, **kwargs):
+        receiver = JournalingReceiver(downstream, self.directory, **kwargs)
+        receiver.start()
+        self.addCleanup(receiver.stop)
+        return receiver
+
+    @defer.inlineCallbacks
+    def testAckOnceDurable(self):
+        downstream = RecordingReceiver()
+        receiver = JournalingReceiver(downstream, self.directory)
+        self.addCleanup(receiver.stop)
+        # not delivered until started
+        acks = yield defer.gatherResults([
+            receiver.handleMessage(receiver.parseMessage(message(i)))
+            for i in range(3)
+        ])
+        self.assertEqual([ack.split('\r')[1] for ack in acks],
+                         ['MSA|AA|C0', 'MSA|AA|C1', 'MSA|AA|C2'])
+        self.assertEqual(downstream.messages, [])
+        receiver.start()
+        messages = yield downstream.waitFor(3)
+        self.assertEqual(messages, ['C0', 'C1', 'C2'])
+
+    @defer.inlineCallbacks
+    def testResumeFromCheckpoint(self):
+        first = RecordingReceiver()
+        receiver = JournalingReceiver(first, self.directory, checkpoint_every=1)
+        receiver.start()
+        for i in range(3):
+            yield receiver.handleMessage(receiver.parseMessage(message(i)))
+        yield first.waitFor(3)
+        yield receiver.stop()
+
+        second = RecordingReceiver()
+        receiver = JournalingReceiver(second, self.directory)
+        receiver.start()
+        yield receiver.handleMessage(receiver.parseMessage(message(3)))
+        messages = yield second.waitFor(1)
+        yield receiver.stop()
+        self.assertEqual(messages, ['C3'])
+        self.assertEqual(receiver.consumer.lag, 0)
+        self.assertEqual(receiver.journal.readCheckpoint(), 4)
+
+    @defer.inlineCallbacks
+    def testRetry(self):
+        downstream = RecordingReceiver(failures=2)
+        receiver = self.createReceiver(downstream, retry_delay=0.01)
+        yield receiver.handleMessage(receiver.parseMessage(message(1)))
+        messages = yield downstream.waitFor(1)
+        self.assertEqual(messages, ['C1'])
+        self.assertEqual(receiver.consumer.retries, 2)
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 2)
+
+    @defer.inlineCallbacks
+    def testStopWhileRetrying(self):
+        downstream = RecordingReceiver(failures=1)
+        receiver = JournalingReceiver(downstream, self.directory, retry_delay=60)
+        receiver.start()
+        yield receiver.handleMessage(receiver.parseMessage(message(1)))
+        yield task.deferLater(receiver.journal.reactor, 0.01, lambda: None)
+        yield receiver.stop()
+        self.assertEqual(receiver.consumer.delivered, 0)
+        self.assertEqual(receiver.journal.readCheckpoint(), 0)
+        self.flushLoggedErrors(Exception)
+
+    def testDelegates(self):
+        downstream = RecordingReceiver()
+        receiver = JournalingReceiver(downstream, self.directory)
+        self.addCleanup(receiver.stop)
+        self.assertEqual(receiver.getCodec(), (None, None))
+        self.assertIsNone(receiver.getTimeout())
+        self.assertIsInstance(receiver.parseMessage(MESSAGE), LazyHL7MessageContainer)
@@ -0,0 +1,130 @@
+from twisted.internet import defer
+from twisted.internet.testing import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txHL7.lanes import KeyedReceiver, patient_key
+from txHL7.mllp import MLLPFactory
+from txHL7.receiver import AbstractReceiver, LazyHL7MessageContainer
+
+from .utils import HL7_MESSAGE, AckReceiver, PendingReceiver, message
+
+
+class PatientKeyTest(TestCase):
+    def testKey(self):
+        self.assertEqual(patient_key(HL7_MESSAGE), b'555-44-4444')
+        self.assertEqual(patient_key(HL7_MESSAGE.decode('ascii')), u'555-44-4444')
+
+    def testFirstIdentifier(self):
+        raw = message(u'1', patient=u'12345^^^HOSP^MR~999^^^SSA^SS')
+        self.assertEqual(patient_key(raw), u'12345')
+
+    def testNoPatient(self):
+        self.assertIsNone(patient_key(HL7_MESSAGE.split(b'\r')[0]))
+        self.assertIsNone(patient_key(message(u'1', patient=u'')))
+        self.assertIsNone(patient_key(u'MSH|^~\\&|\rPIDX|||1\r'))
+
+
+class KeyedReceiverTest(TestCase):
+    def setUp(self):
+        self.receiver = PendingReceiver()
+        self.time = 0.0
+        self.keyed = KeyedReceiver(self.receiver, lanes=2, now=lambda: self.time)
+
+    def handle(self, control_id, patient):
+        container = LazyHL7MessageContainer(message(control_id, patient))
+        return self.keyed.handleMessage(container)
+
+    def testOrderedPerKey(self):
+        results = [
+            self.handle(u'A1', u'A'), self.handle(u'A2', u'A'),
+            self.handle(u'B1', u'B'), self.handle(u'C1', u'C'),
+        ]
+        self.assertEqual(self.receiver.started, [u'A1', u'B1'])
+        self.assertEqual((self.keyed.busy, self.keyed.waiting, self.keyed.keys), (2, 2, 3))
+        self.assertEqual((self.keyed.key_waits, self.keyed.lane_waits), (1, 1))
+        self.assertEqual(self.keyed.hotKeys(), [(u'A', 1), (u'C', 1)])
+
+        self.time = 1.0
+        self.receiver.completeMessage(u'A1')
+        # C waited for a lane before A2 was ready
+        self.assertEqual(self.receiver.started, [u'A1', u'B1', u'C1'])
+        self.receiver.completeMessage(u'B1')
+        self.assertEqual(self.receiver.started, [u'A1', u'B1', u'C1', u'A2'])
+        self.time = 2.0
+        self.receiver.completeMessage(u'C1')
+        self.receiver.completeMessage(u'A2')
+        for d in results:
+            self.assertIn(u'MSA|AA', self.successResultOf(d))
+        self.assertEqual((self.keyed.busy, self.keyed.waiting, self.keyed.keys), (0, 0, 0))
+        self.assertEqual(self.keyed.handled, 4)
+        self.assertEqual(self.keyed.key_skew, 0.25)
+        # two lanes busy the first second, both the second
+        self.assertEqual(self.keyed.occupancy, 1.0)
+
+    def testSynchronousReceiver(self):
+        keyed = KeyedReceiver(AckReceiver(), lanes=1)
+        for i in range(3):
+            d = keyed.handleMessage(LazyHL7MessageContainer(message(str(i))))
+            self.assertIn(u'MSA|AA', self.successResultOf(d))
+        self.assertEqual((keyed.handled, keyed.keys, keyed.key_waits), (3, 0, 0))
+
+    def testLargeSynchronousBacklog(self):
+        class FirstPendingReceiver(AbstractReceiver):
+            message_cls = LazyHL7MessageContainer
+
+            def __init__(self):
+                self.first = None
+                self.handled = 0
+
+            def handleMessage(self, message_container):
+                self.handled += 1
+                if self.first is None:
+                    self.first = defer.Deferred()
+                    return self.first
+                return message_container.ack()
+
+        receiver = FirstPendingReceiver()
+        keyed = KeyedReceiver(receiver, lanes=1)
+        results = [
+            keyed.handleMessage(LazyHL7MessageContainer(message(str(i), str(i))))
+            for i in range(5000)
+        ]
+        self.assertEqual((receiver.handled, keyed.waiting), (1, 4999))
+        # the waiting messages complete synchronously, without recursing
+        receiver.first.callback(u'ACK')
+        self.assertEqual((receiver.handled, keyed.handled, keyed.waiting, keyed.keys), (5000, 5000, 0, 0))
+        for d in results[1:]:
+            self.assertIn(u'MSA|AA', self.successResultOf(d))
+
+    def testCancelWaiting(self):
+        self.handle(u'A1', u'A')
+        waiting = self.handle(u'A2', u'A')
+        last = self.handle(u'A3', u'A')
+        waiting.cancel()
+        self.failureResultOf(waiting, defer.CancelledError)
+        self.receiver.completeMessage(u'A1')
+        # the cancelled message is never handled
+        self.assertEqual(self.receiver.started, [u'A1', u'A3'])
+        self.receiver.completeMessage(u'A3')
+        self.successResultOf(last)
+        self.assertEqual(self.keyed.waiting, 0)
+
+    def testCustomKey(self):
+        keyed = KeyedReceiver(self.receiver, lanes=4, key=lambda raw_message: None)
+        for i in range(3):
+            keyed.handleMessage(LazyHL7MessageContainer(message(str(i), str(i))))
+        self.assertEqual((keyed.busy, keyed.waiting), (1, 2))
+
+    def testFactory(self):
+        factory = MLLPFactory(self.keyed)
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        for control_id, patient in ((u'A1', u'A'), (u'A2', u'A'), (u'B1', u'B')):
+            protocol.dataReceived(b'\x0b' + message(control_id, patient).encode('ascii') + b'\x1c\r')
+        self.assertEqual(self.receiver.started, [u'A1', u'B1'])
+        self.receiver.completeMessage(u'B1')
+        self.receiver.completeMessage(u'A1')
+        self.receiver.completeMessage(u'A2')
+        # responses are written in the order the messages arrived
+        written = protocol.transport.value()
+        self.assertTrue(written.index(b'A1') < written.index(b'A2') < written.index(b'B1'))
@@ -0,0 +1,112 @@
+import io
+import os
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+
+from txHL7.loadgen import LoadGenerator, load_corpus, split_messages
+from txHL7.mllp import MLLPFactory
+
+from .utils import HL7_MESSAGE, AckReceiver
+
+
+class RejectingReceiver(AckReceiver):
+    def handleMessage(self, message_container):
+        return message_container.err(Exception('rejected'))
+
+
+class SplitMessagesTest(TestCase):
+    def testSegmentDelimited(self):
+        second = HL7_MESSAGE.replace(b'CNTRL-3456', b'CNTRL-2')
+        data = b'FHS|^~\\&\nBHS|^~\\&\n' + (HL7_MESSAGE + second).replace(b'\r', b'\r\n') + b'BTS|2\nFTS|1\n'
+        self.assertEqual(split_messages(data), [HL7_MESSAGE, second])
+
+    def testMLLPWrapped(self):
+        data = b'\x0b' + HL7_MESSAGE + b'\x1c\r\x0b' + HL7_MESSAGE + b'\x1c\r'
+        self.assertEqual(split_messages(data), [HL7_MESSAGE, HL7_MESSAGE])
+
+    def testLoadCorpus(self):
+        fd, path = tempfile.mkstemp(suffix='.hl7')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HL7_MESSAGE.replace(b'\r', b'\n'))
+        self.assertEqual(load_corpus([path]), [HL7_MESSAGE])
+
+
+class LoadGeneratorTest(TestCase):
+    def listen(self, receiver):
+        port = reactor.listenTCP(0, MLLPFactory(receiver), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return 'tcp:host=127.0.0.1:port={0}'.format(port.getHost().port)
+
+    @defer.inlineCallbacks
+    def testClosedLoop(self):
+        generator = LoadGenerator(
+            self.listen(AckReceiver()), [HL7_MESSAGE], connections=4,
+            window=3, count=200,
+        )
+        yield generator.run()
+        self.assertEqual((generator.sent, generator.acked), (200, 200))
+        self.assertEqual((generator.rejected, generator.failed), (0, 0))
+        self.assertEqual(len(generator.histogram), 200)
+        self.assertTrue(generator.throughput > 0)
+        out = io.StringIO()
+        generator.report(out)
+        self.assertIn('acked 200', out.getvalue())
+        self.assertIn('p99.9', out.getvalue())
+
+    @defer.inlineCallbacks
+    def testOpenLoop(self):
+        generator = LoadGenerator(
+            self.listen(AckReceiver()), [HL7_MESSAGE], connections=2,
+            rate=1000, count=100,
+        )
+        yield generator.run()
+        self.assertEqual(generator.acked, 100)
+        # the schedule spreads 100 messages at 1000/s over about 0.1s
+        self.assertTrue(generator.elapsed >= 0.099, generator.elapsed)
+        self.assertIn('open loop', self.report(generator))
+
+    @defer.inlineCallbacks
+    def testOpenLoopMeasuresFromSchedule(self):
+        # a generator that falls behind its schedule still counts the delay
+        clock = iter([0.0, 0.5, 0.5, 0.5, 0.6])
+        generator = LoadGenerator(
+            self.listen(AckReceiver()), [HL7_MESSAGE], rate=10, count=2,
+            now=lambda: next(clock),
+        )
+        yield generator.run()
+        self.assertEqual(generator.acked, 2)
+        # sent at 0.5 when scheduled for 0.0 and 0.1, acked at 0.5 and 0.6
+        self.assertEqual(generator.histogram.max, 500000)
+        self.assertEqual(generator.histogram.min, 400000)
+
+    @defer.inlineCallbacks
+    def testDuration(self):
+        generator = LoadGenerator(
+            self.listen(AckReceiver()), [HL7_MESSAGE], rate=200, duration=0.1,
+        )
+        yield generator.run()
+        self.assertEqual(generator.sent, 20)
+        self.assertEqual(generator.acked, generator.sent)
+
+    @defer.inlineCallbacks
+    def testRejected(self):
+        generator = LoadGenerator(
+            self.listen(RejectingReceiver()), [HL7_MESSAGE], count=5,
+        )
+        yield generator.run()
+        self.assertEqual((generator.acked, generator.rejected), (5, 5))
+
+    def testConnectionRefused(self):
+        generator = LoadGenerator('tcp:host=127.0.0.1:port=1', [HL7_MESSAGE])
+        return self.assertFailure(generator.run(), IOError)
+
+    def testEmptyCorpus(self):
+        self.assertRaises(ValueError, LoadGenerator, 'tcp:host=127.0.0.1:port=1', [])
+
+    def report(self, generator):
+        out = io.StringIO()
+        generator.report(out)
+        return out.getvalue()
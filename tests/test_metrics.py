@@ -0,0 +1,117 @@
+from mock import Mock
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from txHL7.metrics import STAGES, Metrics, MetricsResource
+from txHL7.mllp import MinimalLowerLayerProtocol, MLLPFactory
+
+from .test_mllp import HL7CaptureReceiver
+from .utils import HL7_MESSAGE
+
+
+class FakeClock(object):
+    """Advances one millisecond per reading"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 0.001
+        return self.now
+
+
+class FailingReceiver(HL7CaptureReceiver):
+    def handleMessage(self, message_container):
+        raise Exception('failed')
+
+
+def create_protocol(receiver, metrics):
+    protocol = MinimalLowerLayerProtocol()
+    protocol.factory = MLLPFactory(receiver, metrics=metrics)
+    protocol.makeConnection(Mock())
+    return protocol
+
+
+class MetricsTest(TestCase):
+    def testObserve(self):
+        metrics = Metrics(clock=FakeClock())
+        metrics.observe('parse', metrics.clock())
+        self.assertEqual(metrics.stages['parse'].max, 1000)
+
+    def testRender(self):
+        metrics = Metrics(clock=FakeClock())
+        metrics.observe('handle', metrics.clock())
+        metrics.increment('messages', 3)
+        metrics.gauge('queued', 'Queued messages.', lambda: 7)
+        metrics.counter('retries', 'Retried messages.', lambda: 2)
+        text = metrics.render()
+        self.assertIn('# TYPE txhl7_stage_seconds summary\n', text)
+        self.assertIn('txhl7_stage_seconds{stage="handle",quantile="0.99"} 0.001\n', text)
+        self.assertIn('txhl7_stage_seconds_count{stage="handle"} 1\n', text)
+        self.assertIn('txhl7_stage_seconds_count{stage="frame"} 0\n', text)
+        self.assertIn('# TYPE txhl7_messages_total counter\ntxhl7_messages_total 3\n', text)
+        self.assertIn('# TYPE txhl7_queued gauge\ntxhl7_queued 7\n', text)
+        self.assertIn('# TYPE txhl7_retries_total counter\ntxhl7_retries_total 2\n', text)
+
+    def testResource(self):
+        metrics = Metrics()
+        request = DummyRequest([b''])
+        body = MetricsResource(metrics).render_GET(request)
+        self.assertIn(b'txhl7_naks_total 0', body)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b'Content-Type'),
+            [b'text/plain; version=0.0.4; charset=utf-8'],
+        )
+
+
+class ProtocolMetricsTest(TestCase):
+    def testStages(self):
+        metrics = Metrics(clock=FakeClock())
+        protocol = create_protocol(HL7CaptureReceiver(), metrics)
+        data = b'\x0b' + HL7_MESSAGE + b'\x1c\x0d'
+        protocol.dataReceived(data)
+
+        for stage in STAGES:
+            self.assertEqual(metrics.stages[stage].count, 1, stage)
+        self.assertEqual(metrics.counters['messages'], 1)
+        self.assertEqual(metrics.counters['bytes_received'], len(data))
+        written = protocol.transport.write.call_args[0][0]
+        self.assertEqual(metrics.counters['bytes_sent'], len(written))
+        self.assertEqual(metrics.counters['connections'], 1)
+        self.assertEqual(metrics.counters['naks'], 0)
+
+    def testNak(self):
+        metrics = Metrics()
+        protocol = create_protocol(FailingReceiver(), metrics)
+        protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        self.assertEqual(metrics.counters['naks'], 1)
+        self.flushLoggedErrors()
+
+    def testGauges(self):
+        metrics = Metrics()
+        receiver = HL7CaptureReceiver()
+        pending = defer.Deferred()
+        receiver.handleMessage = lambda container: pending
+        protocol = create_protocol(receiver, metrics)
+        protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d\x0bMSH|')
+        text = metrics.render()
+        self.assertIn('txhl7_open_connections 1\n', text)
+        self.assertIn('txhl7_in_flight_messages 1\n', text)
+        self.assertIn('txhl7_buffered_bytes 6\n', text)
+
+        pending.callback(None)
+        protocol.connectionLost(None)
+        self.assertIn('txhl7_open_connections 0\n', metrics.render())
+
+    def testTimeout(self):
+        metrics = Metrics()
+        protocol = create_protocol(HL7CaptureReceiver(), metrics)
+        protocol.timeoutConnection()
+        self.assertEqual(metrics.counters['timeouts'], 1)
+        protocol.transport.loseConnection.assert_called_once_with()
+
+    def testDisabled(self):
+        protocol = create_protocol(HL7CaptureReceiver(), None)
+        self.assertIsNone(protocol.metrics)
+        protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        self.assertEqual(protocol.transport.write.call_count, 1)
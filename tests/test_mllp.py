@@ -6,6 +6,8 @@ from twisted.trial.unittest import TestCase
 from zope.interface import implementer
 import six
 
+from txHL7.ack import ACKBuilder
+from txHL7.framing import FrameTooLarge
 from txHL7.mllp import IHL7Receiver, MinimalLowerLayerProtocol, MLLPFactory
 from txHL7.receiver import (
     AbstractReceiver, HL7MessageContainer, MessageContainer
@@ -65,7 +67,7 @@ class HL7CaptureReceiver(CaptureReceiver):
 def create_protocol(receiver):
     protocol = MinimalLowerLayerProtocol()
     protocol.factory = MLLPFactory(receiver)
-    protocol.transport = Mock()
+    protocol.makeConnection(Mock())
     return protocol
 
 
@@ -100,6 +102,29 @@ class MinimalLowerLayerProtocolTest(BaseTestCase):
         self.assertAck(self.protocol.transport.write.call_args[0][0], 'AA',
                        sending_facility=u'x\u201ay')
 
+    def testFramedAck(self):
+        builder = ACKBuilder('cp1252')
+        self.receiver.handleMessage = lambda container: builder.frame(
+            container.raw_message, message_id=ACK_ID
+        )
+        self.protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+
+        self.assertAck(self.protocol.transport.write.call_args[0][0], 'AA')
+
+    def testPipelinedMessages(self):
+        self.protocol.dataReceived((b'\x0b' + HL7_MESSAGE + b'\x1c\x0d') * 2)
+        self.assertEqual(self.receiver.messages, [HL7_MESSAGE.decode('cp1252')] * 2)
+
+    def testOversizedFrame(self):
+        self.protocol.factory.max_frame_size = 10
+        self.protocol.scanner = self.protocol.factory.buildScanner()
+
+        self.protocol.dataReceived(b'\x0b' + HL7_MESSAGE)
+
+        self.assertEqual(self.receiver.messages, [])
+        self.assertTrue(self.protocol.transport.loseConnection.called)
+        self.assertEqual(len(self.flushLoggedErrors(FrameTooLarge)), 1)
+
 
 class BasicCaptureReceiver(AbstractReceiver, CaptureReceiver):
     """AbstractReceiver subclass that just captures messages"""
@@ -142,3 +167,93 @@ class CustomReceiverTest(TestCase):
             b"\x0bACK-AA\x1c\x0d",
             self.protocol.transport.write.call_args[0][0]
         )
+
+
+class DeferredReceiver(AbstractReceiver):
+    """Receiver whose handleMessage results are fired by the test"""
+    message_cls = CustomMessage
+
+    def __init__(self):
+        self.deferreds = []
+
+    def handleMessage(self, message_container):
+        d = defer.Deferred()
+        self.deferreds.append((message_container, d))
+        return d
+
+    def fire(self, index):
+        message_container, d = self.deferreds[index]
+        d.callback(message_container.ack())
+
+
+class UnrejectableMessage(CustomMessage):
+    def err(self, err):
+        raise ValueError('Unable to build a NAK')
+
+
+class InFlightLimitTest(TestCase):
+    def setUp(self):
+        self.receiver = DeferredReceiver()
+        self.protocol = create_protocol(self.receiver)
+        self.protocol.factory.max_in_flight = 2
+
+    def testBackpressure(self):
+        transport = self.protocol.transport
+        self.protocol.dataReceived(b''.join(
+            b'\x0bM' + six.text_type(i).encode('ascii') + b'\x1c\x0d' for i in range(4)
+        ))
+
+        # only two messages are handed to the receiver, the rest stay queued
+        self.assertEqual(len(self.receiver.deferreds), 2)
+        self.assertEqual(len(self.protocol.queue), 2)
+        self.assertTrue(transport.pauseProducing.called)
+
+        self.receiver.fire(0)
+        self.assertEqual(len(self.receiver.deferreds), 3)
+        self.assertFalse(transport.resumeProducing.called)
+
+        self.receiver.fire(1)
+        self.receiver.fire(2)
+        self.assertEqual(len(self.receiver.deferreds), 4)
+        self.assertTrue(transport.resumeProducing.called)
+
+        self.receiver.fire(3)
+        self.assertEqual(self.protocol.in_flight, 0)
+        self.assertEqual(transport.write.call_count, 4)
+
+
+class OrderedAckTest(TestCase):
+    def setUp(self):
+        self.receiver = DeferredReceiver()
+        self.protocol = create_protocol(self.receiver)
+
+    def testAcksWrittenInArrivalOrder(self):
+        self.protocol.dataReceived(b'\x0bM1\x1c\x0d\x0bM2\x1c\x0d\x0bM3\x1c\x0d')
+        # all three are handled concurrently
+        self.assertEqual(len(self.receiver.deferreds), 3)
+
+        self.receiver.deferreds[2][1].callback(u'ACK-3')
+        self.receiver.deferreds[1][1].errback(Exception())
+        self.assertFalse(self.protocol.transport.write.called)
+
+        self.receiver.deferreds[0][1].callback(u'ACK-1')
+        self.assertEqual(
+            [c[0][0] for c in self.protocol.transport.write.call_args_list],
+            [b'\x0bACK-1\x1c\x0d', b'\x0bACK-AR\x1c\x0d', b'\x0bACK-3\x1c\x0d'],
+        )
+        self.assertEqual(self.protocol.sequencer.blocked, 2)
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+
+    def testFailedRejection(self):
+        self.receiver.message_cls = UnrejectableMessage
+        self.protocol.dataReceived(b'\x0bM1\x1c\x0d\x0bM2\x1c\x0d')
+        self.receiver.deferreds[0][1].errback(Exception())
+        self.receiver.fire(1)
+        # the first message goes unanswered, without holding back the second
+        self.assertEqual(
+            [c[0][0] for c in self.protocol.transport.write.call_args_list],
+            [b'\x0bACK-AA\x1c\x0d'],
+        )
+        self.assertEqual(self.protocol.in_flight, 0)
+        # the handling error and the failed rejection
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 2)
@@ -0,0 +1,103 @@
+import threading
+
+from mock import Mock
+from twisted.internet import defer, reactor, task
+from twisted.trial.unittest import TestCase
+
+from txHL7.mllp import MLLPFactory
+from txHL7.offload import ParsePool
+from txHL7.receiver import HL7MessageContainer
+
+from .test_batch import BatchCaptureReceiver
+from .test_core import ForwardingReceiver
+from .test_mllp import HL7CaptureReceiver
+from .utils import HL7_MESSAGE
+
+
+class ParsePoolTest(TestCase):
+    timeout = 60
+
+    def setUp(self):
+        self.pool = ParsePool(threshold=100, max_workers=1)
+        self.addCleanup(self.pool.close)
+        self.receiver = HL7CaptureReceiver()
+        self.factory = MLLPFactory(self.receiver, parse_pool=self.pool)
+
+    @defer.inlineCallbacks
+    def testLargeFrameParsedInPool(self):
+        d = self.factory.parseFrame(HL7_MESSAGE)
+        self.assertEqual(self.pool.queue_depth, 1)
+
+        container = yield d
+        self.assertTrue(isinstance(container, HL7MessageContainer))
+        self.assertEqual(str(container.message.segment('MSH')(10)), 'CNTRL-3456')
+        self.assertEqual(self.pool.queue_depth, 0)
+        self.assertEqual(self.pool.completed, 1)
+        self.assertTrue(self.pool.serialize_time > 0)
+        self.assertTrue(self.pool.parse_time > 0)
+
+    def testSmallFrameParsedInline(self):
+        container = self.successResultOf(self.factory.parseFrame(b'MSH|^~\\&|A'))
+        self.assertEqual(container.raw_message, u'MSH|^~\\&|A')
+        self.assertEqual(self.pool.submitted, 0)
+
+    @defer.inlineCallbacks
+    def testBytesReceiverNotDecoded(self):
+        receiver = ForwardingReceiver()
+        factory = MLLPFactory(receiver, parse_pool=ParsePool(threshold=100, max_workers=1))
+        self.addCleanup(factory.parse_pool.close)
+        self.assertEqual(factory.encoding, 'ascii')
+        container = yield factory.parseFrame(HL7_MESSAGE)
+        self.assertEqual(container.raw_message, HL7_MESSAGE)
+        self.assertEqual(factory.parse_pool.completed, 1)
+
+    @defer.inlineCallbacks
+    def testBatchReceiver(self):
+        receiver = BatchCaptureReceiver()
+        factory = MLLPFactory(receiver, parse_pool=ParsePool(threshold=5, max_workers=1))
+        self.addCleanup(factory.parse_pool.close)
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(Mock())
+        protocol.dataReceived(b'\x0bMESSAGE-1\x1c\x0d\x0bM2\x1c\x0d')
+        while protocol.in_flight:
+            yield task.deferLater(reactor, 0.05, lambda: None)
+        # the pool-parsed message is flushed in a batch of its own
+        self.assertEqual(receiver.batches, [[u'M2'], [u'MESSAGE-1']])
+        self.assertEqual(protocol.transport.write.call_count, 2)
+
+    def testUnpicklableReceiverParsedInline(self):
+        receiver = HL7CaptureReceiver()
+        receiver.lock = threading.Lock()
+        pool = ParsePool(threshold=100, max_workers=1)
+        factory = MLLPFactory(receiver, parse_pool=pool)
+        container = self.successResultOf(factory.parseFrame(HL7_MESSAGE))
+        self.assertEqual(str(container.message.segment('MSH')(10)), 'CNTRL-3456')
+        self.assertEqual((pool.unpicklable, pool.submitted), (1, 0))
+
+    @defer.inlineCallbacks
+    def testParserFixedOnceStarted(self):
+        yield self.factory.parseFrame(HL7_MESSAGE)
+        self.assertRaises(RuntimeError, self.pool.setParser, HL7CaptureReceiver().parseMessage)
+
+    @defer.inlineCallbacks
+    def testMetrics(self):
+        from txHL7.metrics import Metrics
+        metrics = Metrics()
+        MLLPFactory(self.receiver, parse_pool=self.pool, metrics=metrics)
+        yield self.factory.parseFrame(HL7_MESSAGE)
+        text = metrics.render()
+        self.assertIn('txhl7_parse_pool_queue_depth 0\n', text)
+        self.assertIn('# TYPE txhl7_parse_pool_submitted_total counter\ntxhl7_parse_pool_submitted_total 1\n', text)
+        self.assertIn('txhl7_parse_pool_parse_seconds_total ', text)
+
+    @defer.inlineCallbacks
+    def testProtocolAcks(self):
+        protocol = self.factory.buildProtocol(None)
+        protocol.makeConnection(Mock())
+        protocol.dataReceived(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        self.assertEqual(self.receiver.messages, [])
+
+        while protocol.in_flight:
+            yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(self.receiver.messages, [HL7_MESSAGE.decode('cp1252')])
+        self.assertTrue(protocol.transport.write.called)
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from txHL7.metrics import Metrics, MetricsResource
+from txHL7.profiler import ProfileResource, ProfileTrigger, SamplingProfiler
+
+
+def busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+class SamplingProfilerTest(TestCase):
+    def testSamples(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        self.assertTrue(profiler.running)
+        # long enough to be sampled often while the loop holds the GIL
+        busy(0.5)
+        profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertGreater(sum(profiler.samples.values()), 10)
+
+        [(label, samples)] = profiler.top(1)
+        self.assertTrue(label.startswith('busy (test_profiler.py:'), label)
+        for line in profiler.collapsed().splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        self.assertIn('testSamples (test_profiler.py:', profiler.collapsed())
+        self.assertIn('busy (test_profiler.py:', profiler.report())
+
+    def testStartTwice(self):
+        profiler = SamplingProfiler()
+        profiler.start()
+        self.addCleanup(profiler.stop)
+        self.assertRaises(RuntimeError, profiler.start)
+
+
+class ProfileTriggerTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clock = task.Clock()
+        self.trigger = ProfileTrigger(self.directory, seconds=5, reactor=self.clock)
+
+    def testTrigger(self):
+        d = self.trigger.trigger()
+        self.assertIsNone(self.trigger.trigger())
+        busy(0.05)
+        self.clock.advance(5)
+        profiler = self.successResultOf(d)
+        self.assertIsNone(self.trigger.running)
+        [name] = os.listdir(self.directory)
+        self.assertTrue(name.startswith('txhl7-profile-{0}-'.format(os.getpid())))
+        with open(os.path.join(self.directory, name)) as f:
+            self.assertEqual(f.read(), profiler.collapsed())
+
+    def testResource(self):
+        root = MetricsResource(Metrics())
+        root.putChild(b'profile', ProfileResource(self.trigger))
+        request = DummyRequest([b'profile'])
+        request.args = {b'seconds': [b'2']}
+        child = root.getChildWithDefault(b'profile', request)
+        self.assertEqual(child.render_GET(request), NOT_DONE_YET)
+        self.assertEqual(ProfileResource(self.trigger).render_GET(DummyRequest([])), b'A profile is already running\n')
+        busy(0.05)
+        self.clock.advance(2)
+        self.assertEqual(request.finished, 1)
+        self.assertIn(b'testResource (test_profiler.py:', b''.join(request.written))
+
+        # other paths serve the metrics
+        self.assertIsInstance(root.getChildWithDefault(b'metrics', DummyRequest([])), MetricsResource)
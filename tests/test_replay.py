@@ -0,0 +1,101 @@
+import io
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+
+from txHL7.capture import CaptureWriter
+from txHL7.mllp import MLLPFactory
+from txHL7.replay import Replayer, load_sessions
+from txHL7.view import read_header
+
+from .utils import AckReceiver, message
+
+
+class OrderReceiver(AckReceiver):
+    def __init__(self):
+        self.control_ids = []
+
+    def handleMessage(self, message_container):
+        self.control_ids.append(read_header(message_container.raw_message.encode('ascii')).field(10))
+        return super(OrderReceiver, self).handleMessage(message_container)
+
+
+class ReplayTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    @defer.inlineCallbacks
+    def capture(self):
+        # two overlapping connections over 0.2 seconds
+        times = iter([0.0, 0.05, 0.1, 0.02, 0.06, 0.15, 0.2, 0.2])
+        writer = CaptureWriter(self.directory, now=lambda: next(times))
+        first = writer.connectionOpened('10.0.0.1:1')
+        writer.framesReceived(first, [message(b'A1')])
+        writer.framesReceived(first, [message(b'A2')])
+        second = writer.connectionOpened('10.0.0.2:1')
+        writer.framesReceived(second, [message(b'B1'), message(b'B2')])
+        writer.framesReceived(second, [message(b'B3')])
+        writer.framesReceived(first, [message(b'A3')])
+        writer.connectionClosed(first)
+        yield writer.close()
+        sessions = load_sessions([os.path.join(self.directory, name) for name in writer.files])
+        return sessions
+
+    def listen(self, receiver):
+        port = reactor.listenTCP(0, MLLPFactory(receiver), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return 'tcp:host=127.0.0.1:port={0}'.format(port.getHost().port)
+
+    @defer.inlineCallbacks
+    def testLoadSessions(self):
+        first, second = yield self.capture()
+        self.assertEqual((first.peer, first.opened, first.closed), ('10.0.0.1:1', 0.0, 0.2))
+        self.assertEqual([offset for offset, frame in first.frames], [0.05, 0.1, 0.2])
+        self.assertEqual(first.frames[0][1], b'\x0b' + message(b'A1') + b'\x1c\r')
+        self.assertEqual((second.opened, second.closed, len(second.frames)), (0.02, None, 3))
+
+    def assertOrdered(self, control_ids):
+        self.assertEqual(sorted(control_ids), [b'A1', b'A2', b'A3', b'B1', b'B2', b'B3'])
+        for prefix in (b'A', b'B'):
+            self.assertEqual(
+                [c for c in control_ids if c.startswith(prefix)],
+                [prefix + b'1', prefix + b'2', prefix + b'3'],
+            )
+
+    @defer.inlineCallbacks
+    def testTimed(self):
+        sessions = yield self.capture()
+        receiver = OrderReceiver()
+        replayer = Replayer(self.listen(receiver), sessions, speed=2)
+        yield replayer.run()
+        self.assertEqual((replayer.sent, replayer.acked, replayer.failed), (6, 6, 0))
+        self.assertOrdered(receiver.control_ids)
+        # the last frame was captured 0.2s in
+        self.assertTrue(replayer.elapsed >= 0.099, replayer.elapsed)
+        out = io.StringIO()
+        replayer.report(out)
+        self.assertIn('2 connections, 6 frames, replayed at 2x', out.getvalue())
+
+    @defer.inlineCallbacks
+    def testMaxSpeed(self):
+        sessions = yield self.capture()
+        receiver = OrderReceiver()
+        replayer = Replayer(self.listen(receiver), sessions, speed=None, window=2)
+        yield replayer.run()
+        self.assertEqual((replayer.acked, replayer.rejected), (6, 0))
+        self.assertOrdered(receiver.control_ids)
+        self.assertTrue(replayer.throughput > 0)
+
+    @defer.inlineCallbacks
+    def testConnectError(self):
+        sessions = yield self.capture()
+        port = reactor.listenTCP(0, MLLPFactory(AckReceiver()), interface='127.0.0.1')
+        number = port.getHost().port
+        yield port.stopListening()
+        replayer = Replayer('tcp:host=127.0.0.1:port={0}'.format(number), sessions, speed=None)
+        yield replayer.run()
+        self.assertEqual((replayer.connect_errors, replayer.failed, replayer.sent), (2, 6, 0))
@@ -0,0 +1,119 @@
+from mock import Mock, patch
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from txHL7.framing import FramedMessage
+from txHL7.mllp import MinimalLowerLayerProtocol, MLLPFactory
+from txHL7.receiver import AbstractReceiver, LazyHL7MessageContainer
+from txHL7.router import AcceptReceiver, Route, Router, parse_route
+
+from .utils import HL7_MESSAGE
+
+ADT = HL7_MESSAGE.replace(b'ORU^R01', b'ADT^A01^ADT_A01')
+
+
+class RecordingReceiver(AbstractReceiver):
+    message_cls = LazyHL7MessageContainer
+
+    def __init__(self, codec=None):
+        self.messages = []
+        self.codec = codec
+
+    def handleMessage(self, message_container):
+        self.messages.append(message_container.raw_message)
+        return message_container.ack()
+
+    def getCodec(self):
+        return self.codec, None
+
+
+class RouterTest(TestCase):
+    def setUp(self):
+        self.adt = RecordingReceiver()
+        self.lab = RecordingReceiver()
+        self.fallback = RecordingReceiver()
+        self.router = Router([
+            ('ADT^*', self.adt),
+            ('GHH LAB|ELAB-?|ORU^R01', self.lab),
+        ], fallback=self.fallback)
+
+    def handle(self, router, message):
+        container = router.parseMessage(message.decode('latin-1'))
+        return self.successResultOf(defer.maybeDeferred(router.handleMessage, container))
+
+    def testRouteByType(self):
+        ack = self.handle(self.router, ADT)
+        self.assertIsInstance(ack, FramedMessage)
+        self.assertIn(b'MSA|AA|CNTRL-3456', ack)
+        self.assertEqual(len(self.adt.messages), 1)
+        self.assertEqual(self.lab.messages, [])
+
+    def testRouteBySender(self):
+        self.handle(self.router, HL7_MESSAGE)
+        self.assertEqual(len(self.lab.messages), 1)
+        other = HL7_MESSAGE.replace(b'ELAB-3', b'ELAB-10')
+        self.handle(self.router, other)
+        self.assertEqual(len(self.fallback.messages), 1)
+
+    def testDispatchTable(self):
+        self.handle(self.router, ADT)
+        self.handle(self.router, ADT)
+        self.assertEqual(list(self.router.table), [(u'GHH LAB', u'ELAB-3', u'ADT^A01')])
+        router = Router([('ADT^*', self.adt)], table_size=0)
+        self.handle(router, ADT)
+        self.assertEqual(router.table, {})
+
+    def testNoRoute(self):
+        router = Router([('ADT^*', self.adt)])
+        ack = self.handle(router, HL7_MESSAGE)
+        self.assertIn(b'MSA|AR|CNTRL-3456', ack)
+
+    def testRouteCodec(self):
+        receiver = RecordingReceiver(codec='utf-8')
+        router = Router([('*^*', Route(receiver))])
+        message = HL7_MESSAGE.replace(b'EVERYWOMAN', u'ÉVE'.encode('utf-8'))
+        ack = self.handle(router, message)
+        self.assertIn(u'ÉVE', receiver.messages[0])
+        self.assertIn(b'MSA|AA|', ack)
+
+    def testAcceptRouteDoesNotParse(self):
+        # the router reads only MSH, the receiver builds its ACK from it
+        router = Router([('ORU^*', AcceptReceiver())])
+        with patch('hl7.parse', side_effect=AssertionError('parsed')):
+            ack = self.handle(router, HL7_MESSAGE)
+        self.assertIn(b'MSA|AA|CNTRL-3456', ack)
+
+    def testRouteTimeout(self):
+        clock = task.Clock()
+        receiver = RecordingReceiver()
+        receiver.handleMessage = lambda container: defer.Deferred()
+        router = Router([('*^*', Route(receiver, timeout=5, reactor=clock))])
+        container = router.parseMessage(HL7_MESSAGE.decode('latin-1'))
+        d = router.handleMessage(container)
+        self.assertNoResult(d)
+        clock.advance(5)
+        self.assertIn(b'MSA|AR|CNTRL-3456', self.successResultOf(d))
+        self.flushLoggedErrors(defer.TimeoutError)
+
+    def testProtocol(self):
+        protocol = MinimalLowerLayerProtocol()
+        protocol.factory = MLLPFactory(self.router)
+        protocol.makeConnection(Mock())
+        protocol.dataReceived(b'\x0b' + ADT + b'\x1c\x0d')
+        written = protocol.transport.write.call_args[0][0]
+        self.assertTrue(written.startswith(b'\x0bMSH|^~\\&|GHH OE|BLDG4|GHH LAB|ELAB-3|'))
+        self.assertIn(b'MSA|AA|CNTRL-3456\r\x1c\x0d', written)
+
+
+class ParseRouteTest(TestCase):
+    def testParse(self):
+        pattern, route = parse_route('APP|*|ADT^*=txHL7.router.AcceptReceiver,codec=cp1252,timeout=2.5')
+        self.assertEqual(pattern, 'APP|*|ADT^*')
+        self.assertIsInstance(route.receiver, AcceptReceiver)
+        self.assertEqual(route.codec.encoding, 'cp1252')
+        self.assertEqual(route.timeout, 2.5)
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, parse_route, 'ADT^*')
+        self.assertRaises(ValueError, parse_route, 'A|B=txHL7.router.AcceptReceiver')
+        self.assertRaises(ValueError, parse_route, 'ADT^*=txHL7.router.AcceptReceiver,retries=3')
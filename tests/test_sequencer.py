@@ -0,0 +1,33 @@
+from twisted.trial.unittest import TestCase
+
+from txHL7.sequencer import ResponseSequencer
+
+
+class ResponseSequencerTest(TestCase):
+    def setUp(self):
+        self.released = []
+        self.sequencer = ResponseSequencer(self.released.append)
+
+    def testInOrder(self):
+        for i in range(3):
+            self.sequencer.complete(self.sequencer.reserve(), i)
+        self.assertEqual(self.released, [0, 1, 2])
+        self.assertEqual(self.sequencer.blocked, 0)
+        self.assertEqual(len(self.sequencer), 0)
+
+    def testOutOfOrder(self):
+        seqs = [self.sequencer.reserve() for i in range(4)]
+        self.sequencer.complete(seqs[2], 'c')
+        self.sequencer.complete(seqs[1], 'b')
+        self.assertEqual(self.released, [])
+        self.assertEqual(self.sequencer.buffered, 2)
+
+        self.sequencer.complete(seqs[0], 'a')
+        self.assertEqual(self.released, ['a', 'b', 'c'])
+        self.assertEqual(len(self.sequencer), 1)
+
+        self.sequencer.complete(seqs[3], 'd')
+        self.assertEqual(self.released, ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.sequencer.blocked, 2)
+        self.assertEqual(self.sequencer.max_buffered, 2)
+        self.assertEqual(self.sequencer.buffered, 0)
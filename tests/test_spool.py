@@ -0,0 +1,146 @@
+from mock import Mock
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from zope.interface.exceptions import Invalid
+
+from txHL7.framing import FrameTooLarge
+from txHL7.mllp import MLLPFactory
+from txHL7.receiver import (
+    AbstractBytesReceiver, AbstractStreamingReceiver, LazyHL7MessageContainer,
+    SpooledMessageContainer
+)
+from txHL7.spool import SpooledFrame, SpoolingFrameScanner
+
+from .test_mllp import CustomCaptureReceiver
+from .utils import HL7_MESSAGE
+
+OBX = b'OBX|1|ED|PDF^Report||^AP^PDF^Base64^' + b'QUJD' * 2000 + b'||||||F\r'
+LARGE_MESSAGE = HL7_MESSAGE + OBX * 5
+
+
+def wrap(message):
+    return b'\x0b' + message + b'\x1c\x0d'
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class StreamingReceiver(AbstractStreamingReceiver):
+    """Collects the OBX segments of spooled messages"""
+    message_cls = LazyHL7MessageContainer
+
+    def __init__(self):
+        self.messages = []
+        self.segments = []
+
+    def handleMessage(self, message_container):
+        self.messages.append(message_container)
+        if isinstance(message_container, SpooledMessageContainer):
+            for segment in message_container.message.segments():
+                if segment[:4] in (u'OBX|', b'OBX|'):
+                    self.segments.append(segment)
+        return message_container.ack()
+
+
+class SpoolingFrameScannerTest(TestCase):
+    def setUp(self):
+        self.scanner = SpoolingFrameScanner(spool_threshold=4096)
+
+    def testSmallFrames(self):
+        frames = self.scanner.feed(wrap(HL7_MESSAGE) * 2)
+        self.assertEqual(frames, [HL7_MESSAGE] * 2)
+        self.assertNotIsInstance(frames[0], SpooledFrame)
+
+    def testSpool(self):
+        data = wrap(HL7_MESSAGE) + wrap(LARGE_MESSAGE) + wrap(HL7_MESSAGE)
+        frames = []
+        for chunk in chunks(data, 1000):
+            frames.extend(self.scanner.feed(chunk))
+            # at most the threshold and a chunk are held in memory
+            self.assertLessEqual(len(self.scanner), 5096)
+        self.assertEqual(len(frames), 3)
+        small, spooled, last = frames
+        self.assertEqual((small, last), (HL7_MESSAGE, HL7_MESSAGE))
+        self.assertIsInstance(spooled, SpooledFrame)
+        self.addCleanup(spooled.close)
+        self.assertEqual(spooled, HL7_MESSAGE.split(b'\r')[0])
+        self.assertEqual(spooled.size, len(LARGE_MESSAGE))
+        self.assertEqual(spooled.mmap()[:], LARGE_MESSAGE)
+        self.assertEqual(list(spooled.raw_segments()), LARGE_MESSAGE.split(b'\r')[:-1])
+        self.assertEqual(self.scanner.spooled, 0)
+
+    def testMaxFrameSize(self):
+        scanner = SpoolingFrameScanner(max_frame_size=10000, spool_threshold=4096)
+        data = wrap(LARGE_MESSAGE)
+        scanner.feed(data[:5000])
+        spool = scanner._spool
+        self.assertRaises(FrameTooLarge, scanner.feed, data[5000:])
+        self.assertTrue(spool.closed)
+        self.assertEqual((len(scanner), scanner.spooled), (0, 0))
+
+    def testPaddingOnly(self):
+        self.assertEqual(self.scanner.feed(b'\r\n' * 4000), [])
+        self.assertIsNone(self.scanner._spool)
+        self.assertEqual(self.scanner.feed(wrap(HL7_MESSAGE)), [HL7_MESSAGE])
+
+
+class StreamingProtocolTest(TestCase):
+    def connect(self, receiver, **kwargs):
+        factory = MLLPFactory(receiver, spool_threshold=4096, **kwargs)
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(Mock())
+        return protocol
+
+    def testSpooledMessage(self):
+        receiver = StreamingReceiver()
+        protocol = self.connect(receiver)
+        for chunk in chunks(wrap(LARGE_MESSAGE) + wrap(HL7_MESSAGE), 1000):
+            protocol.dataReceived(chunk)
+        spooled, small = receiver.messages
+        self.assertIsInstance(spooled, SpooledMessageContainer)
+        self.assertEqual(spooled.raw_message, HL7_MESSAGE.split(b'\r')[0].decode('ascii'))
+        self.assertEqual(spooled.message.size, len(LARGE_MESSAGE))
+        self.assertEqual(receiver.segments, [OBX[:-1].decode('ascii')] * 5)
+        # the spool file is deleted once the message is handled
+        self.assertTrue(spooled.message.file.closed)
+        self.assertNotIsInstance(small, SpooledMessageContainer)
+
+        acks = [c[0][0] for c in protocol.transport.write.call_args_list]
+        self.assertEqual(len(acks), 2)
+        for ack in acks:
+            self.assertIn(b'MSA|AA|CNTRL-3456', ack)
+
+    def testBytesReceiver(self):
+        class BytesStreamingReceiver(AbstractBytesReceiver, StreamingReceiver):
+            pass
+
+        receiver = BytesStreamingReceiver()
+        protocol = self.connect(receiver)
+        for chunk in chunks(wrap(LARGE_MESSAGE), 1000):
+            protocol.dataReceived(chunk)
+        [spooled] = receiver.messages
+        # segments are not decoded
+        self.assertEqual(receiver.segments, [OBX[:-1]] * 5)
+        self.assertIsInstance(spooled.raw_message, bytes)
+        self.assertIn(b'MSA|AA|CNTRL-3456', protocol.transport.write.call_args[0][0])
+
+    def testConnectionLost(self):
+        class PendingReceiver(StreamingReceiver):
+            def handleMessage(self, message_container):
+                self.messages.append(message_container)
+                return defer.Deferred()
+
+        protocol = self.connect(PendingReceiver(), max_in_flight=1)
+        data = wrap(HL7_MESSAGE) + wrap(LARGE_MESSAGE) * 2
+        for chunk in chunks(data[:-1000], 1000):
+            protocol.dataReceived(chunk)
+        [queued] = protocol.queue
+        partial = protocol.scanner._spool
+        protocol.connectionLost(None)
+        # the spool files of the queued and the partial frame are deleted
+        self.assertTrue(queued.file.closed)
+        self.assertTrue(partial.closed)
+
+    def testRequiresStreamingReceiver(self):
+        self.assertRaises(Invalid, MLLPFactory, CustomCaptureReceiver(), spool_threshold=4096)
@@ -0,0 +1,91 @@
+import threading
+
+from twisted.internet import defer, reactor, task
+from twisted.trial.unittest import TestCase
+
+from txHL7.receiver import AbstractReceiver, LazyHL7MessageContainer
+from txHL7.threaded import ThreadedReceiver
+
+from .utils import message
+
+
+class BlockingReceiver(AbstractReceiver):
+    """Blocks each message until ``release`` is set"""
+    message_cls = LazyHL7MessageContainer
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.threads = set()
+
+    def handleMessage(self, message_container):
+        self.threads.add(threading.current_thread().name)
+        if not self.release.wait(10):
+            raise RuntimeError('not released')
+        if u'FAIL' in message_container.raw_message:
+            raise ValueError('failed')
+        return message_container.ack()
+
+    def getTimeout(self):
+        return 30
+
+
+class ThreadedReceiverTest(TestCase):
+    def setUp(self):
+        self.receiver = BlockingReceiver()
+        self.threaded = ThreadedReceiver(self.receiver, threads=2, queue_size=2)
+        self.addCleanup(self.threaded.stop)
+        self.addCleanup(self.receiver.release.set)
+
+    def handle(self, control_id):
+        container = self.threaded.parseMessage(message(control_id))
+        return defer.maybeDeferred(self.threaded.handleMessage, container)
+
+    @defer.inlineCallbacks
+    def testOverload(self):
+        ds = [self.handle('M{0}'.format(i)) for i in range(4)]
+        self.assertEqual((self.threaded.busy, self.threaded.queue_depth), (2, 2))
+
+        # the queue is full, so the message is refused without waiting
+        overloaded = self.successResultOf(self.handle('M4'))
+        self.assertIn(u'MSA|AE|M4', overloaded)
+        self.assertEqual(self.threaded.overloaded, 1)
+        self.assertFalse(any(d.called for d in ds))
+
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.receiver.release.set()
+        acks = yield defer.gatherResults(ds)
+        self.assertEqual([ack.split(u'MSA|')[1] for ack in acks],
+                         [u'AA|M{0}\r'.format(i) for i in range(4)])
+        self.assertEqual(self.threaded.completed, 4)
+        self.assertEqual((self.threaded.busy, self.threaded.queue_depth), (0, 0))
+        self.assertEqual(len(self.threaded.queue_wait), 4)
+        # the queued messages waited for the first two
+        self.assertGreater(self.threaded.queue_wait.max, 40000)
+        self.assertGreater(self.threaded.utilization, 0)
+        self.assertLessEqual(self.threaded.utilization, 1)
+        self.assertEqual(len(self.receiver.threads), 2)
+        self.assertTrue(all('txHL7.threaded' in name for name in self.receiver.threads))
+
+    @defer.inlineCallbacks
+    def testOverloadCode(self):
+        self.threaded.overload_code = 'AR'
+        self.threaded.queue_size = 0
+        ds = [self.handle('M0'), self.handle('M1')]
+        self.assertIn(u'MSA|AR|M2', self.successResultOf(self.handle('M2')))
+        self.receiver.release.set()
+        yield defer.gatherResults(ds)
+
+    @defer.inlineCallbacks
+    def testFailure(self):
+        self.receiver.release.set()
+        d = self.handle('FAIL')
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual(self.threaded.busy, 0)
+        ack = yield self.handle('M1')
+        self.assertIn(u'MSA|AA|M1', ack)
+
+    def testDelegates(self):
+        self.assertEqual(self.threaded.getTimeout(), 30)
+        self.assertEqual(self.threaded.getCodec(), (None, None))
+        self.assertIsInstance(self.threaded.parseMessage(message('M1')), LazyHL7MessageContainer)
+        self.assertEqual(self.threaded.utilization, 0.0)
@@ -0,0 +1,60 @@
+import asyncio
+import threading
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+from twisted.trial.unittest import TestCase
+
+from txHL7.aio import MLLPServer
+from txHL7.mllp import MLLPFactory
+
+from .utils import AckReceiver, loopback_throughput
+
+COUNT = 2000
+
+
+class CoroutineAckReceiver(AckReceiver):
+    async def handleMessage(self, message_container):
+        await asyncio.sleep(0)
+        return message_container.ack()
+
+
+class ThroughputTest(TestCase):
+    """Runs each server front-end against the same blocking loopback client"""
+    timeout = 120
+
+    def assertAllAcked(self, result):
+        acks, seconds = result
+        self.assertEqual(acks, ['C{0}'.format(i) for i in range(COUNT)])
+        log.msg('{0}: {1:.0f} messages/s'.format(self.id(), COUNT / seconds))
+
+    @defer.inlineCallbacks
+    def testTwisted(self):
+        port = reactor.listenTCP(0, MLLPFactory(AckReceiver()), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        result = yield threads.deferToThread(
+            loopback_throughput, port.getHost().port, COUNT
+        )
+        self.assertAllAcked(result)
+
+    def runAsyncio(self, receiver):
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(
+            loop.create_server(MLLPServer(receiver), '127.0.0.1', 0)
+        )
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            return loopback_throughput(server.sockets[0].getsockname()[1], COUNT)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+
+    def testAsyncio(self):
+        self.assertAllAcked(self.runAsyncio(AckReceiver()))
+
+    def testAsyncioCoroutineReceiver(self):
+        self.assertAllAcked(self.runAsyncio(CoroutineAckReceiver()))
@@ -0,0 +1,97 @@
+import itertools
+
+from mock import Mock
+from twisted.python import log
+from twisted.trial.unittest import TestCase
+
+from txHL7.mllp import MLLPFactory
+from txHL7.trace import STAGES, TraceContext, Tracer
+
+from .test_admission import FRAME
+from .utils import PendingReceiver
+
+
+class TraceContextTest(TestCase):
+    def testDescribe(self):
+        trace = TraceContext(3, b'CNTRL-3456', 500, 0)
+        trace.spans.extend([('frame', 1.0, 1.001), ('handle', 1.002, 1.5)])
+        self.assertAlmostEqual(trace.duration, 0.5)
+        self.assertEqual(
+            trace.describe(),
+            'connection 3 control ID CNTRL-3456 (500 bytes) took 500.0 ms: frame 1.0 ms, handle 498.0 ms',
+        )
+
+
+class TracerTest(TestCase):
+    def setUp(self):
+        self.spans = []
+        self.clock = itertools.count()
+        self.tracer = Tracer(
+            hooks=[lambda *span: self.spans.append(span)], slow_threshold=20,
+            clock=lambda: float(next(self.clock)), now=lambda: 1000.0,
+        )
+        self.receiver = PendingReceiver()
+        self.logged = []
+        log.addObserver(self.logged.append)
+        self.addCleanup(log.removeObserver, self.logged.append)
+
+    def connect(self, factory):
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(Mock())
+        return protocol
+
+    def slowMessages(self):
+        return [
+            event['message'][0] for event in self.logged
+            if event['message'] and event['message'][0].startswith('Slow message')
+        ]
+
+    def testSpans(self):
+        factory = MLLPFactory(self.receiver, tracer=self.tracer)
+        # the second connection is numbered 2
+        self.connect(factory)
+        second = self.connect(factory)
+        second.dataReceived(FRAME * 2)
+        self.assertEqual([span[1] for span in self.spans], ['frame', 'frame', 'decode', 'parse', 'decode', 'parse'])
+        self.receiver.complete(2)
+        self.assertEqual(
+            [span[1] for span in self.spans[6:]], ['handle', 'write', 'handle', 'write'],
+        )
+        traces = [span[0] for span in self.spans]
+        trace = traces[0]
+        self.assertEqual(set(traces), set(traces[:2]))
+        self.assertEqual(trace.connection_id, 2)
+        self.assertEqual(trace.control_id, b'CNTRL-3456')
+        self.assertEqual(trace.size, len(FRAME) - 3)
+        self.assertEqual(trace.arrival, 1000.0)
+        self.assertEqual([stage for stage, start, end in trace.spans], list(STAGES))
+        # both frames came from the same read
+        self.assertEqual(traces[0].spans[0], traces[-1].spans[0])
+        self.assertEqual(self.tracer.traced, 2)
+
+    def testSlowMessages(self):
+        factory = MLLPFactory(self.receiver, tracer=self.tracer)
+        protocol = self.connect(factory)
+        protocol.dataReceived(FRAME)
+        self.receiver.complete(1)
+        self.assertEqual(self.slowMessages(), [])
+
+        protocol.dataReceived(FRAME)
+        for i in range(20):
+            next(self.clock)
+        self.receiver.complete(1)
+        self.assertEqual(self.tracer.slow, 1)
+        [message] = self.slowMessages()
+        self.assertIn('connection 1 control ID CNTRL-3456', message)
+        self.assertIn('handle 21000.0 ms', message)
+
+    def testHookFailure(self):
+        def failing(*span):
+            raise ValueError('hook')
+
+        self.tracer.hooks.insert(0, failing)
+        factory = MLLPFactory(self.receiver, tracer=self.tracer)
+        self.connect(factory).dataReceived(FRAME)
+        self.receiver.complete(1)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 5)
+        self.assertEqual(self.tracer.traced, 1)
@@ -0,0 +1,56 @@
+from twisted.trial.unittest import TestCase
+import hl7
+
+from txHL7.receiver import LazyHL7MessageContainer
+from txHL7.view import HL7MessageView
+
+from .utils import HL7_MESSAGE
+
+
+class HL7MessageViewTest(TestCase):
+    def setUp(self):
+        self.raw = HL7_MESSAGE.decode('cp1252')
+        self.view = HL7MessageView(self.raw)
+        self.message = hl7.parse(self.raw)
+
+    def testSegments(self):
+        self.assertEqual(len(self.view), 4)
+        self.assertEqual(self.view[1].segment_id, 'PID')
+        self.assertEqual(len(self.view.segments('OBR')), 1)
+        self.assertEqual(self.view.segments('OBX'), [])
+        self.assertRaises(KeyError, self.view.segment, 'OBX')
+
+    def testFieldsMatchHL7(self):
+        for segment_id in ('MSH', 'PID', 'OBR'):
+            segment = self.view.segment(segment_id)
+            expected = self.message.segment(segment_id)
+            for index in range(1, len(expected)):
+                self.assertEqual(segment.field(index), str(expected(index)))
+
+    def testField(self):
+        self.assertEqual(self.view.field('MSH', 9), 'ORU^R01')
+        self.assertEqual(self.view.field('MSH', 10), 'CNTRL-3456')
+        self.assertEqual(self.view.field('PID', 3), '555-44-4444')
+        # missing fields are empty
+        self.assertEqual(self.view.field('MSH', 30), '')
+
+    def testComponent(self):
+        msh = self.view.segment('MSH')
+        self.assertEqual(msh.component(9, 1), 'ORU')
+        self.assertEqual(msh.component(9, 2), 'R01')
+        self.assertEqual(msh.component(9, 3), '')
+
+    def testBytes(self):
+        view = HL7MessageView(HL7_MESSAGE)
+        self.assertEqual(view.field(b'MSH', 10), b'CNTRL-3456')
+        self.assertEqual(view.segment(b'MSH').component(9, 1), b'ORU')
+
+
+class LazyHL7MessageContainerTest(TestCase):
+    def testLazyMaterialize(self):
+        container = LazyHL7MessageContainer(HL7_MESSAGE.decode('cp1252'))
+        self.assertEqual(container.view.field('PID', 3), '555-44-4444')
+        self.assertEqual(container._message, None)
+
+        self.assertEqual(str(container.message), str(hl7.parse(container.raw_message)))
+        self.assertTrue(container.ack().startswith('MSH|^~\\&|GHH OE|BLDG4|'))
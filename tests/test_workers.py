@@ -0,0 +1,70 @@
+import socket
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.trial.unittest import TestCase
+
+from txHL7.workers import WorkerPoolService, listen_socket
+
+from .utils import HL7_MESSAGE
+
+
+def send_message(port):
+    # blocking MLLP round trip, run in a thread
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    try:
+        sock.sendall(b'\x0b' + HL7_MESSAGE + b'\x1c\x0d')
+        response = b''
+        while not response.endswith(b'\x1c\x0d'):
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        return response
+    finally:
+        sock.close()
+
+
+class ListenSocketTest(TestCase):
+    def testInterface(self):
+        sock = listen_socket('tcp:0:interface=127.0.0.1')
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getsockname()[0], '127.0.0.1')
+        self.assertTrue(sock.get_inheritable())
+
+    def testUnsupportedEndpoint(self):
+        self.assertRaises(ValueError, listen_socket, 'unix:/tmp/mllp.sock')
+
+
+class WorkerPoolServiceTest(TestCase):
+    timeout = 60
+
+    @defer.inlineCallbacks
+    def waitForAck(self, port):
+        # workers need a moment to import and adopt the socket
+        for attempt in range(50):
+            response = yield threads.deferToThread(send_message, port)
+            if response:
+                return response
+            yield task.deferLater(reactor, 0.2, lambda: None)
+        self.fail('No ACK received')
+
+    @defer.inlineCallbacks
+    def testWorkersServeAndRestart(self):
+        pool = WorkerPoolService('tcp:0:interface=127.0.0.1', [], 2)
+        pool.restart_delay = 0.1
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        self.assertEqual(len(pool.processes), 2)
+
+        response = yield self.waitForAck(pool.port)
+        self.assertTrue(response.startswith(b'\x0bMSH|^~\\&|GHH OE|BLDG4|GHH LAB|ELAB-3|'))
+
+        crashed = pool.processes[0]
+        crashed.transport.signalProcess('KILL')
+        yield crashed.ended
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        self.assertEqual(pool.restarts, 1)
+        self.assertTrue(pool.processes[0] is not crashed)
+
+        yield pool.stopService()
+        self.assertEqual(pool.processes, {})
@@ -1,2 +1,92 @@
+from twisted.internet import defer
+
+from txHL7.receiver import AbstractReceiver, LazyHL7MessageContainer
 
 HL7_MESSAGE = b'MSH|^~\\&|GHH LAB|ELAB-3|GHH OE|BLDG4|200202150930||ORU^R01|CNTRL-3456|P|2.4\rPID|||555-44-4444||EVERYWOMAN^EVE^E^^^^L|JONES|196203520|F|||153 FERNWOOD DR.^^STATESVILLE^OH^35292||(206)3345232|(206)752-121||||AC555444444||67-A4335^OH^20030520\rOBR|1|845439^GHH OE|1045813^GHH LAB|1554-5^GLUCOSE|||200202150730||||||||555-55-5555^PRIMARY^PATRICIA P^^^^MD^^LEVEL SEVEN HEALTHCARE, INC.|||||||||F||||||444-44-4444^HIPPOCRATES^HOWARD H^^^^MD\rBX|1|SN|1554-5^GLUCOSE^POST 12H CFST:MCNC:PT:SER/PLAS:QN||^182|mg/dl|70_105|H|||F\r'
+
+
+def message(control_id, patient=None):
+    """HL7_MESSAGE with the control ID ``control_id`` and, if given, the
+    patient identifier ``patient``: a bytestring if ``control_id`` is one,
+    otherwise decoded.
+    """
+    if isinstance(control_id, bytes):
+        return message(control_id.decode('ascii'), patient).encode('ascii')
+    raw_message = HL7_MESSAGE.decode('ascii').replace(u'CNTRL-3456', control_id)
+    if patient is not None:
+        raw_message = raw_message.replace(u'PID|||555-44-4444', u'PID|||' + patient)
+    return raw_message
+
+
+class AckReceiver(AbstractReceiver):
+    """Accepts every message"""
+    message_cls = LazyHL7MessageContainer
+
+    def handleMessage(self, message_container):
+        return message_container.ack()
+
+
+class PendingReceiver(AbstractReceiver):
+    """Holds each message until the test completes it"""
+    message_cls = LazyHL7MessageContainer
+
+    def __init__(self):
+        # (message_container, Deferred) pairs, oldest first
+        self.pending = []
+        self.max_pending = 0
+        # the control ID of each message handed over
+        self.started = []
+
+    def handleMessage(self, message_container):
+        d = defer.Deferred()
+        self.started.append(message_container.raw_message.split(u'|')[9])
+        self.pending.append((message_container, d))
+        self.max_pending = max(self.max_pending, len(self.pending))
+        return d
+
+    def complete(self, count=1):
+        """Accept the ``count`` oldest pending messages"""
+        for i in range(count):
+            message_container, d = self.pending.pop(0)
+            d.callback(message_container.ack())
+
+    def completeMessage(self, control_id):
+        """Accept the pending message with the control ID ``control_id``"""
+        for i, (message_container, d) in enumerate(self.pending):
+            if message_container.raw_message.split(u'|')[9] == control_id:
+                del self.pending[i]
+                d.callback(message_container.ack())
+                return
+        raise KeyError(control_id)
+
+
+def loopback_throughput(port, count, window=50):
+    """Blocking MLLP client shared by the server throughput tests: sends
+    ``count`` messages over one loopback connection, keeping up to ``window``
+    unacknowledged, and returns ``(control_ids, seconds)`` with the MSA-2 of
+    each ACK in the order received.
+    """
+    import socket
+    import time
+
+    sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+    acks = []
+    buffer = b''
+    start = time.time()
+    try:
+        sent = 0
+        while len(acks) < count:
+            while sent < count and sent - len(acks) < window:
+                message = HL7_MESSAGE.replace(b'CNTRL-3456', 'C{0}'.format(sent).encode('ascii'))
+                sock.sendall(b'\x0b' + message + b'\x1c\x0d')
+                sent += 1
+            data = sock.recv(65536)
+            if not data:
+                break
+            buffer += data
+            *frames, buffer = buffer.split(b'\x1c\x0d')
+            for frame in frames:
+                acks.append(frame.split(b'\rMSA|')[1].split(b'|')[1].rstrip(b'\r').decode('ascii'))
+    finally:
+        sock.close()
+    return acks, time.time() - start
@@ -1,4 +1,6 @@
-from twisted.application import internet
+import sys
+
+from twisted.application import internet, service
 from twisted.application.service import IServiceMaker
 from twisted.internet import endpoints
 from twisted.plugin import IPlugin
@@ -17,12 +19,128 @@ class Options(usage.Options):
     optParameters = [
         ['endpoint', 'e', DEFAULT_ENDPOINT, 'The string endpoint on which to listen.'],
         ['receiver', 'r', DEFAULT_RECEIVER, 'A txHL7.receiver.IHL7Receiver subclass to handle messages.'],
+        ['max-frame-size', None, None, 'Maximum MLLP frame size in bytes; larger frames close the connection.', int],
+        ['max-in-flight', None, None, 'Maximum messages handled concurrently per connection before reading pauses.', int],
+        ['batch-size', None, None, 'Maximum messages per batch for IHL7BatchReceiver receivers.', int],
+        ['batch-window', None, None, 'Seconds to collect messages from all connections into a batch.', float],
+        ['parse-offload-threshold', None, None, 'Parse frames of at least this many bytes in a process pool.', int],
+        ['parse-workers', None, None, 'Number of processes parsing large frames (default: CPU count).', int],
+        ['workers', 'w', None, 'Number of worker processes sharing the listening socket (tcp endpoints only).', int],
+        ['metrics-endpoint', None, None, 'The string endpoint on which to serve Prometheus metrics.'],
+        ['dedup-size', None, None, 'Answer retransmitted messages from a cache of the ACKs of this many recent messages.', int],
+        ['dedup-ttl', None, 3600, 'Seconds an ACK is kept in the --dedup-size cache.', float],
+        ['journal', None, None, 'Directory in which to journal messages, ACKing them once durable and delivering them to the receiver afterwards.'],
+        ['threads', None, None, 'Run the receiver\'s blocking handleMessage in a dedicated pool of this many threads.', int],
+        ['thread-queue-size', None, 100, 'Messages that may wait for a --threads thread; further messages are answered with --overload-code.', int],
+        ['overload-code', None, 'AE', 'The ACK code (AE or AR) answering messages refused because the --threads queue is full.'],
+        ['max-total-in-flight', None, None, 'Maximum messages handled concurrently across all connections before reading pauses.', int],
+        ['max-buffered-bytes', None, None, 'Maximum bytes of frames buffered across all connections before reading pauses.', int],
+        ['spool-threshold', None, None, 'Write frames larger than this many bytes to a temporary file as they arrive, for IHL7StreamingReceiver receivers to read a segment at a time.', int],
+        ['spool-dir', None, None, 'Directory for the --spool-threshold temporary files (default: the system temporary directory).'],
+        ['slow-message-threshold', None, None, 'Log messages taking at least this many seconds from their arrival to the write of their response, with the time spent in each stage.', float],
+        ['profile-dir', None, None, 'Profile the reactor thread for --profile-seconds on SIGUSR2, writing the collapsed stacks to this directory; also serves /profile?seconds=N on --metrics-endpoint.'],
+        ['profile-seconds', None, 10, 'Seconds to profile for on SIGUSR2.', float],
+        ['capture-dir', None, None, 'Record received frames, with their connections and arrival times, to rotating capture files in this directory for replay with python -m txHL7.replay.'],
+        ['capture-file-size', None, 64 * 1024 * 1024, 'Start a new --capture-dir file once one reaches this many bytes.', int],
+        ['capture-files', None, None, 'Keep at most this many --capture-dir files, deleting the oldest.', int],
+        ['lanes', None, None, 'Handle messages with different --lane-key keys on up to this many lanes at once, one message per key at a time.', int],
+        ['priority-reserve', None, 0.2, 'Fraction of the --max-total-in-flight and --max-buffered-bytes budgets reserved for each more critical --priority tier.', float],
+    ]
+
+    optFlags = [
+        ['detect-charset', None, 'Decode each message with the character set named in its MSH-18, falling back to the receiver\'s codec.'],
+        ['pause-listening', None, 'Stop accepting connections while --max-total-in-flight or --max-buffered-bytes is exceeded.'],
     ]
 
     longdesc = """\
 Starts an MLLP server. If no arguments are specified,
 it will be a demo server that logs and ACKs each message received."""
 
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['routes'] = []
+        self['priorities'] = []
+        self['trace-hooks'] = []
+        self['lane-key'] = None
+
+    def opt_route(self, spec):
+        """Route messages matching PATTERN (TYPE or APPLICATION|FACILITY|TYPE,
+        with wildcards) to another receiver: PATTERN=RECEIVER[,codec=CODEC][,timeout=SECONDS].
+        May be repeated; rules are tried in order, and --receiver handles
+        messages matching none.
+        """
+        self['routes'].append(spec)
+
+    def opt_trace_hook(self, name):
+        """Pass the spans of each message to the callable NAME, which takes
+        the trace context, the stage, and the start and end of the span.
+        May be repeated.
+        """
+        try:
+            hook = reflect.namedAny(name)
+        except (ValueError, AttributeError, ImportError) as e:
+            raise usage.UsageError('--trace-hook: {0}'.format(e))
+        if not callable(hook):
+            raise usage.UsageError('--trace-hook: {0!r} is not callable'.format(name))
+        self['trace-hooks'].append(hook)
+
+    def opt_lane_key(self, name):
+        """Order --lanes messages by the result of the callable NAME, which
+        takes the decoded raw message (default: the patient ID in PID-3).
+        """
+        try:
+            key = reflect.namedAny(name)
+        except (ValueError, AttributeError, ImportError) as e:
+            raise usage.UsageError('--lane-key: {0}'.format(e))
+        if not callable(key):
+            raise usage.UsageError('--lane-key: {0!r} is not callable'.format(name))
+        self['lane-key'] = key
+
+    def opt_priority(self, spec):
+        """Give feeds from ADDRESS (an IP address or network) a priority tier
+        for admission control: ADDRESS=TIER, tier 0 being the most critical.
+        May be repeated; the first match applies, and other feeds get the
+        tier after the last one.
+        """
+        from txHL7.admission import parse_priority
+        try:
+            self['priorities'].append(parse_priority(spec))
+        except ValueError as e:
+            raise usage.UsageError('--priority: {0}'.format(e))
+
+    def parseOptions(self, options=None):
+        # keep the arguments, worker processes are started with the same ones
+        self.argv = list(sys.argv[1:] if options is None else options)
+        usage.Options.parseOptions(self, options)
+
+    def postOptions(self):
+        if self['workers'] and not self['endpoint'].startswith(('tcp:', 'tcp6:')):
+            raise usage.UsageError('--workers requires a tcp or tcp6 endpoint')
+        if self['workers'] and self['metrics-endpoint']:
+            raise usage.UsageError('--metrics-endpoint cannot be combined with --workers')
+        if self['workers'] and self['journal']:
+            raise usage.UsageError('--journal cannot be combined with --workers')
+        if self['workers'] and self['capture-dir']:
+            raise usage.UsageError('--capture-dir cannot be combined with --workers')
+        if self['overload-code'] not in ('AE', 'AR'):
+            raise usage.UsageError('--overload-code must be AE or AR')
+        if self['spool-threshold'] is not None and (self['routes'] or self['journal'] or self['threads'] or self['lanes']):
+            raise usage.UsageError('--spool-threshold cannot be combined with --route, --journal, --threads or --lanes')
+        if self['parse-offload-threshold'] is not None and (
+                self['routes'] or self['journal'] or self['threads'] or self['lanes']):
+            raise usage.UsageError(
+                '--parse-offload-threshold cannot be combined with --route, --journal, --threads or --lanes'
+            )
+        if self['lanes'] is not None and self['journal']:
+            raise usage.UsageError('--lanes cannot be combined with --journal')
+        if self['lane-key'] is not None and self['lanes'] is None:
+            raise usage.UsageError('--lane-key requires --lanes')
+        budgeted = self['max-total-in-flight'] is not None or self['max-buffered-bytes'] is not None
+        if (self['priorities'] or self['pause-listening']) and not budgeted:
+            raise usage.UsageError(
+                '--priority and --pause-listening require --max-total-in-flight or --max-buffered-bytes'
+            )
+
 
 @implementer(IServiceMaker, IPlugin)
 class MLLPServiceMaker(object):
@@ -31,21 +149,197 @@ class MLLPServiceMaker(object):
     description = "HL7 MLLP server."
     options = Options
 
+    def makeFactory(self, options):
+        """Construct the MLLPFactory and receiver described by ``options``.
+
+        :rtype: :py:class:`txHL7.mllp.MLLPFactory`
+        """
+        from txHL7.mllp import IHL7Receiver, MLLPFactory
+
+        receiver_class = reflect.namedClass(options['receiver'])
+        verifyClass(IHL7Receiver, receiver_class)
+        receiver = receiver_class()
+        threaded = None
+        if options['threads'] is not None:
+            from txHL7.threaded import ThreadedReceiver
+            receiver = threaded = ThreadedReceiver(
+                receiver, threads=options['threads'],
+                queue_size=options['thread-queue-size'],
+                overload_code=options['overload-code'],
+            )
+        if options['routes']:
+            from txHL7.router import Router, parse_route
+            receiver = Router(
+                [parse_route(spec) for spec in options['routes']],
+                fallback=receiver, timeout=receiver.getTimeout(),
+            )
+        keyed = None
+        if options['lanes'] is not None:
+            from txHL7.lanes import KeyedReceiver, patient_key
+            receiver = keyed = KeyedReceiver(
+                receiver, lanes=options['lanes'],
+                key=options['lane-key'] or patient_key,
+            )
+        if options['journal'] is not None:
+            receiver = self.journalReceiver(receiver, options['journal'])
+        parse_pool = None
+        if options['parse-offload-threshold'] is not None:
+            from txHL7.offload import ParsePool
+            parse_pool = ParsePool(
+                threshold=options['parse-offload-threshold'],
+                max_workers=options['parse-workers'],
+            )
+        metrics = None
+        if options['metrics-endpoint'] is not None:
+            from txHL7.metrics import Metrics
+            metrics = Metrics()
+            if threaded is not None:
+                self.threadGauges(metrics, threaded)
+            if keyed is not None:
+                self.laneGauges(metrics, keyed)
+        duplicates = None
+        if options['dedup-size'] is not None:
+            from txHL7.dedup import DuplicateCache
+            duplicates = DuplicateCache(
+                max_entries=options['dedup-size'], ttl=options['dedup-ttl'],
+            )
+        admission = None
+        if options['max-total-in-flight'] is not None or options['max-buffered-bytes'] is not None:
+            from txHL7.admission import AdmissionControl
+            admission = AdmissionControl(
+                max_in_flight=options['max-total-in-flight'],
+                max_buffered=options['max-buffered-bytes'],
+                priorities=options['priorities'],
+                reserve=options['priority-reserve'],
+                pause_listening=options['pause-listening'],
+            )
+        tracer = None
+        if options['trace-hooks'] or options['slow-message-threshold'] is not None:
+            from txHL7.trace import Tracer
+            tracer = Tracer(
+                hooks=options['trace-hooks'],
+                slow_threshold=options['slow-message-threshold'],
+            )
+        capture = None
+        if options['capture-dir'] is not None:
+            capture = self.captureWriter(options)
+        return MLLPFactory(
+            receiver,
+            max_frame_size=options['max-frame-size'],
+            max_in_flight=options['max-in-flight'],
+            batch_size=options['batch-size'],
+            batch_window=options['batch-window'],
+            parse_pool=parse_pool,
+            metrics=metrics,
+            duplicates=duplicates,
+            detect_charset=options['detect-charset'],
+            admission=admission,
+            tracer=tracer,
+            spool_threshold=options['spool-threshold'],
+            spool_directory=options['spool-dir'],
+            capture=capture,
+        )
+
+    def threadGauges(self, metrics, threaded):
+        metrics.gauge('thread_queue_depth', 'Messages waiting for a receiver thread.',
+                      lambda: threaded.queue_depth)
+        metrics.gauge('thread_busy', 'Receiver threads handling a message.',
+                      lambda: threaded.busy)
+        metrics.gauge('thread_utilization', 'Fraction of receiver thread time spent handling messages.',
+                      lambda: threaded.utilization)
+        metrics.counter('thread_overloaded', 'Messages refused because the receiver thread queue was full.',
+                        lambda: threaded.overloaded)
+        metrics.gauge('thread_queue_wait_p99_seconds', '99th percentile of the time messages waited for a receiver thread.',
+                      lambda: threaded.queue_wait.percentile(99) / 1e6)
+
+    def laneGauges(self, metrics, keyed):
+        metrics.gauge('lane_busy', 'Lanes handling a message.',
+                      lambda: keyed.busy)
+        metrics.gauge('lane_occupancy', 'Fraction of lane time spent handling messages.',
+                      lambda: keyed.occupancy)
+        metrics.gauge('lane_waiting', 'Messages waiting for their ordering key or a lane.',
+                      lambda: keyed.waiting)
+        metrics.gauge('lane_active_keys', 'Ordering keys with a message running or waiting.',
+                      lambda: keyed.keys)
+        metrics.counter('lane_key_waits', 'Messages that waited behind an earlier message with the same key.',
+                        lambda: keyed.key_waits)
+        metrics.gauge('lane_key_skew', 'Fraction of messages that waited for their ordering key.',
+                      lambda: keyed.key_skew)
+
+    def profileTrigger(self, options):
+        """Install the ``--profile-dir`` SIGUSR2 handler once the reactor runs
+
+        :rtype: :py:class:`txHL7.profiler.ProfileTrigger`
+        """
+        from twisted.internet import reactor
+        from txHL7.profiler import ProfileTrigger
+
+        trigger = ProfileTrigger(options['profile-dir'], seconds=options['profile-seconds'])
+        reactor.callWhenRunning(trigger.install)
+        return trigger
+
+    def captureWriter(self, options):
+        from twisted.internet import reactor
+        from txHL7.capture import CaptureWriter
+
+        capture = CaptureWriter(
+            options['capture-dir'], file_size=options['capture-file-size'],
+            max_files=options['capture-files'],
+        )
+        reactor.addSystemEventTrigger('before', 'shutdown', capture.close)
+        return capture
+
+    def journalReceiver(self, receiver, directory):
+        from twisted.internet import reactor
+        from txHL7.journal import JournalingReceiver
+
+        receiver = JournalingReceiver(receiver, directory)
+        reactor.callWhenRunning(receiver.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', receiver.stop)
+        return receiver
+
     def makeService(self, options):
         """Construct a server using MLLPFactory.
 
-        :rtype: :py:class:`twisted.application.internet.StreamServerEndpointService`
+        :rtype: :py:class:`twisted.application.internet.StreamServerEndpointService`,
+            :py:class:`txHL7.workers.WorkerPoolService` with ``--workers``, or
+            a :py:class:`twisted.application.service.MultiService` of the
+            server and the metrics endpoint with ``--metrics-endpoint``
         """
         from twisted.internet import reactor
-        from txHL7.mllp import IHL7Receiver, MLLPFactory
 
         receiver_name = options['receiver']
-        receiver_class = reflect.namedClass(receiver_name)
-        verifyClass(IHL7Receiver, receiver_class)
-        factory = MLLPFactory(receiver_class())
-        endpoint = endpoints.serverFromString(reactor, options['endpoint'])
-        server = internet.StreamServerEndpointService(endpoint, factory)
+        if options['workers']:
+            from txHL7.workers import WorkerPoolService
+            server = WorkerPoolService(options['endpoint'], options.argv, options['workers'])
+        else:
+            factory = self.makeFactory(options)
+            endpoint = endpoints.serverFromString(reactor, options['endpoint'])
+            if factory.admission is not None and factory.admission.pause_listening:
+                from txHL7.admission import AdmissionEndpoint
+                endpoint = AdmissionEndpoint(endpoint, factory.admission)
+            server = internet.StreamServerEndpointService(endpoint, factory)
+            trigger = None
+            if options['profile-dir'] is not None:
+                trigger = self.profileTrigger(options)
+            if factory.metrics is not None:
+                server = self.addMetricsService(server, factory.metrics, options, trigger)
         server.setName(u"mllp-{0}".format(receiver_name))
         return server
 
+    def addMetricsService(self, server, metrics, options, trigger=None):
+        from twisted.internet import reactor
+        from twisted.web.server import Site
+        from txHL7.metrics import MetricsResource
+
+        parent = service.MultiService()
+        server.setServiceParent(parent)
+        endpoint = endpoints.serverFromString(reactor, options['metrics-endpoint'])
+        root = MetricsResource(metrics)
+        if trigger is not None:
+            from txHL7.profiler import ProfileResource
+            root.putChild(b'profile', ProfileResource(trigger))
+        internet.StreamServerEndpointService(endpoint, Site(root)).setServiceParent(parent)
+        return parent
+
 serviceMaker = MLLPServiceMaker()
@@ -0,0 +1,104 @@
+"""ACK construction directly from the raw message header.
+
+:py:class:`txHL7.ack.ACKBuilder` produces the same acknowledgement as
+:py:meth:`hl7.Message.create_ack`, but only reads the ``MSH`` fields it
+needs, using :py:func:`txHL7.view.read_header`, instead of parsing the whole
+message and building a new one.
+"""
+import datetime
+
+from hl7.util import generate_message_control_id
+
+from txHL7.framing import frame
+from txHL7.view import read_header
+
+
+class ACKBuilder(object):
+    """Builds original mode ACKs from raw HL7 messages.
+
+    ``encoding`` and ``errors`` are the codec used by :py:meth:`frame` to
+    encode the ACK, and should match the receiver's
+    :py:meth:`txHL7.receiver.IHL7Receiver.getCodec`.
+    """
+    def __init__(self, encoding='ascii', errors='strict'):
+        self.encoding = encoding
+        self.errors = errors
+        # literal parts of the ACK, pre-encoded for bytes messages
+        self._text = dict((literal, literal) for literal in ('MSH', 'MSA', 'ACK'))
+        self._encoded = dict(
+            (literal, literal.encode(encoding, errors)) for literal in self._text
+        )
+
+    def fields(self, raw_message, ack_code='AA', message_id=None,
+               application=None, facility=None, timestamp=None):
+        """Return the ACK as a list of segments, each a list of field values
+        of the same type as ``raw_message``.
+        """
+        msh = read_header(raw_message)
+        text = not isinstance(raw_message, bytes)
+
+        def value(v):
+            v = str(v)
+            return v if text else v.encode(self.encoding, self.errors)
+
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        if message_id is None:
+            message_id = generate_message_control_id()
+        literals = self._text if text else self._encoded
+        component = raw_message[4:5]
+        ack = literals['ACK']
+        return [
+            [
+                literals['MSH'] + msh.field(1) + msh.field(2),
+                value(application) if application is not None else msh.field(5),
+                value(facility) if facility is not None else msh.field(6),
+                msh.field(3),
+                msh.field(4),
+                value(timestamp),
+                raw_message[0:0],
+                ack + component + msh.component(9, 2) + component + ack,
+                value(message_id),
+                msh.field(11),
+                msh.field(12),
+            ],
+            [literals['MSA'], value(ack_code), msh.field(10)],
+        ]
+
+    def text(self, raw_message, ack_code='AA', **kwargs):
+        """Return the ACK for the unicode ``raw_message``, equal to
+        ``str(hl7.parse(raw_message).create_ack(ack_code, ...))``.
+        Accepts the same keyword arguments as :py:meth:`fields`.
+
+        :rtype: unicode
+        """
+        separator = raw_message[3:4]
+        return u''.join(
+            separator.join(segment) + u'\r'
+            for segment in self.fields(raw_message, ack_code, **kwargs)
+        )
+
+    def frame(self, raw_message, ack_code='AA', **kwargs):
+        """Return the encoded ACK wrapped in its MLLP block, ready to be
+        written to the transport. ``raw_message`` may be the decoded message
+        or the raw frame bytes, in which case the ACK is assembled from slices
+        of the frame without decoding it.
+
+        :rtype: :py:class:`txHL7.framing.FramedMessage`
+        """
+        if isinstance(raw_message, bytes):
+            separator = raw_message[3:4]
+            payload = b''.join(
+                separator.join(segment) + b'\r'
+                for segment in self.fields(raw_message, ack_code, **kwargs)
+            )
+        else:
+            payload = self.text(raw_message, ack_code, **kwargs).encode(
+                self.encoding, self.errors
+            )
+        return frame(payload)
+
+
+_builder = ACKBuilder()
+build_ack = _builder.text
+frame_ack = _builder.frame
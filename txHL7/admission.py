@@ -0,0 +1,218 @@
+"""Admission control across all the connections of a listener.
+
+``max_in_flight`` and ``max_frame_size`` bound what a single connection may
+hold, but a burst from many feeds at once can still exhaust memory.
+:py:class:`txHL7.admission.AdmissionControl` keeps budgets for the messages
+being handled and the bytes buffered by all connections together, and stops
+reading from connections while they are exceeded, so that TCP flow control
+pushes back on the senders::
+
+    admission = AdmissionControl(
+        max_in_flight=500, max_buffered=64 * 1024 * 1024,
+        priorities=[parse_priority('10.1.0.0/16=0')],
+    )
+    factory = MLLPFactory(receiver, admission=admission)
+
+Feeds are given priority tiers by address. Lower priority tiers are held
+first, leaving the rest of the budget to the more critical feeds.
+"""
+import ipaddress
+
+from twisted.internet.interfaces import IStreamServerEndpoint
+from zope.interface import implementer
+
+
+def parse_priority(spec):
+    """Parse ``ADDRESS=TIER``, where ADDRESS is an IP address or network, into
+    an ``(network, tier)`` pair for :py:class:`AdmissionControl`.
+
+    :rtype: tuple
+    """
+    address, sep, tier = spec.rpartition('=')
+    if not sep:
+        raise ValueError('Expected ADDRESS=TIER, got {0!r}'.format(spec))
+    tier = int(tier)
+    if tier < 0:
+        raise ValueError('Priority tiers must not be negative, got {0!r}'.format(spec))
+    return ipaddress.ip_network(address.strip(), strict=False), tier
+
+
+class AdmissionControl(object):
+    """Holds the connections of a factory while more than ``max_in_flight``
+    messages are being handled or more than ``max_buffered`` bytes of frames
+    are buffered, in total. Either budget may be None for no limit.
+
+    ``priorities`` is a list of ``(network, tier)`` pairs, as returned by
+    :py:func:`parse_priority`, tried in order against the peer address of
+    each connection. Tier 0 is the most critical; connections matching no
+    pair get the tier after the last configured one. The connections of
+    tier ``t`` are held once usage of either budget reaches ``1 - t *
+    reserve`` (but at least ``reserve``), and released once it has fallen
+    by ``resume_ratio`` from there. With ``pause_listening``, ports added
+    with :py:meth:`addPort` stop accepting connections while a budget is
+    exceeded.
+
+    Partial frames can only complete by reading more, so connections are
+    never held while no message is being handled. Statistics:
+
+    * ``in_flight`` -- messages being handled
+    * ``buffered`` -- bytes of partial and queued frames
+    * ``held`` -- connections not being read from
+    * ``pauses`` -- times a tier was held
+    * ``listening`` -- whether the ports are accepting connections
+    """
+    def __init__(self, max_in_flight=None, max_buffered=None, priorities=None,
+                 reserve=0.2, resume_ratio=0.8, pause_listening=False):
+        self.max_in_flight = max_in_flight
+        self.max_buffered = max_buffered
+        self.priorities = list(priorities or ())
+        self.default_tier = max([tier + 1 for network, tier in self.priorities] or [0])
+        self.reserve = reserve
+        self.resume_ratio = resume_ratio
+        self.pause_listening = pause_listening
+        self.in_flight = 0
+        self.buffered = 0
+        self.pauses = 0
+        self.listening = True
+        self.ports = []
+        # tier to its connections, and the tiers being held
+        self.tiers = {}
+        self.paused = set()
+
+    @property
+    def held(self):
+        return sum(len(self.tiers[tier]) for tier in self.paused if tier in self.tiers)
+
+    def threshold(self, tier):
+        """Fraction of the budgets at which connections of ``tier`` are held
+
+        :rtype: float
+        """
+        return max(1.0 - tier * self.reserve, self.reserve)
+
+    def usage(self):
+        """Usage of the fuller budget, as a fraction of it
+
+        :rtype: float
+        """
+        usage = 0.0
+        if self.max_in_flight:
+            usage = self.in_flight / self.max_in_flight
+        if self.max_buffered:
+            usage = max(usage, self.buffered / self.max_buffered)
+        return usage
+
+    def tierFor(self, address):
+        """The priority tier of connections from ``address``
+
+        :rtype: int
+        """
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return self.default_tier
+        for network, tier in self.priorities:
+            if address.version == network.version and address in network:
+                return tier
+        return self.default_tier
+
+    def add(self, connection):
+        """Start accounting for ``connection``, a
+        :py:class:`txHL7.core.MLLPConnection`, holding it at once if its tier
+        is held
+        """
+        peer = connection.transport.getPeer()
+        tier = self.tierFor(getattr(peer, 'host', None))
+        connection.admission_tier = tier
+        connection.admitted = (0, 0)
+        self.tiers.setdefault(tier, set()).add(connection)
+        if tier in self.paused:
+            connection.held = True
+            connection.updateReading()
+
+    def remove(self, connection):
+        """Stop accounting for ``connection``, e.g. once it is closed"""
+        admitted = getattr(connection, 'admitted', None)
+        if admitted is None:
+            return
+        connection.admitted = None
+        self.in_flight -= admitted[0]
+        self.buffered -= admitted[1]
+        tier = connection.admission_tier
+        connections = self.tiers[tier]
+        connections.discard(connection)
+        if not connections:
+            del self.tiers[tier]
+        self.evaluate()
+
+    def update(self, connection):
+        """Account for the messages and bytes ``connection`` holds now, and
+        hold or release connections accordingly
+        """
+        admitted = connection.admitted
+        if admitted is None:
+            # closed, with messages still completing
+            return
+        in_flight = connection.in_flight
+        buffered = len(connection.scanner) + connection.queued_bytes
+        if admitted == (in_flight, buffered):
+            return
+        connection.admitted = (in_flight, buffered)
+        self.in_flight += in_flight - admitted[0]
+        self.buffered += buffered - admitted[1]
+        self.evaluate()
+
+    def evaluate(self):
+        """Hold or release each tier, and pause or resume listening"""
+        usage = self.usage()
+        if usage < self.reserve and not self.paused and self.listening:
+            # below every threshold, nothing to do
+            return
+        draining = self.in_flight > 0
+        for tier in sorted(set(self.tiers) | self.paused):
+            threshold = self.threshold(tier)
+            if tier in self.paused:
+                if usage < threshold * self.resume_ratio or not draining:
+                    self.paused.discard(tier)
+                    self._hold(tier, False)
+            elif usage >= threshold and draining:
+                self.paused.add(tier)
+                self.pauses += 1
+                self._hold(tier, True)
+        if self.pause_listening:
+            if self.listening and usage >= 1.0 and draining:
+                self.listening = False
+                for port in self.ports:
+                    port.stopReading()
+            elif not self.listening and (usage < self.resume_ratio or not draining):
+                self.listening = True
+                for port in self.ports:
+                    port.startReading()
+
+    def _hold(self, tier, held):
+        for connection in list(self.tiers.get(tier, ())):
+            connection.held = held
+            connection.updateReading()
+
+    def addPort(self, port):
+        """Pause and resume accepting connections on ``port``, a listening
+        :py:class:`twisted.internet.tcp.Port`, with ``pause_listening``.
+        Returns ``port``.
+        """
+        self.ports.append(port)
+        if not self.listening:
+            port.stopReading()
+        return port
+
+
+@implementer(IStreamServerEndpoint)
+class AdmissionEndpoint(object):
+    """A :py:class:`twisted.internet.interfaces.IStreamServerEndpoint` adding
+    the ports ``endpoint`` listens on to ``admission``
+    """
+    def __init__(self, endpoint, admission):
+        self.endpoint = endpoint
+        self.admission = admission
+
+    def listen(self, factory):
+        return self.endpoint.listen(factory).addCallback(self.admission.addPort)
@@ -0,0 +1,203 @@
+"""asyncio MLLP server.
+
+An alternative to the Twisted :py:class:`txHL7.mllp.MLLPFactory` for
+applications built on asyncio, or on a compatible loop such as uvloop. It
+shares the framing, flow control and ACK ordering of
+:py:class:`txHL7.core.MLLPConnection`, and accepts the same
+:py:class:`txHL7.receiver.IHL7Receiver` implementations, whose
+``handleMessage`` may additionally be a coroutine function.
+
+::
+
+    import asyncio
+    from txHL7.aio import start_server
+
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(start_server(Receiver(), '0.0.0.0', 2575))
+    loop.run_forever()
+"""
+import asyncio
+import inspect
+import logging
+
+from twisted.internet import defer
+from twisted.python import failure
+from zope.interface.verify import verifyObject
+
+from txHL7.core import MLLPCodec, MLLPConnection
+from txHL7.idle import IdleTimer
+from txHL7.receiver import IHL7Receiver
+
+logger = logging.getLogger(__name__)
+
+
+class MLLPServerProtocol(asyncio.Protocol, MLLPConnection):
+    """asyncio protocol for one MLLP connection of an
+    :py:class:`txHL7.aio.MLLPServer`.
+
+    If ``handleMessage`` fails, the error is passed to the container's
+    ``err`` as a :py:class:`twisted.python.failure.Failure`, as with the
+    Twisted server.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.codec = server.codec
+        self.max_frame_size = server.max_frame_size
+        self.max_in_flight = server.max_in_flight
+        self.transport = None
+        self.idle = None
+        # tasks awaiting responses; the loop only keeps weak references
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_event_loop()
+        self.startConnection()
+        self.idle = self.server.idleTimer(self.loop)
+        if self.idle is not None:
+            self.idle.add(self)
+
+    def connection_lost(self, exc):
+        if self.idle is not None:
+            self.idle.remove(self)
+        self.transport = None
+
+    def data_received(self, data):
+        if self.idle is not None:
+            self.idle.touch(self)
+        self.framesReceived(data)
+
+    def timeoutConnection(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def frameTooLarge(self, err):
+        # without a complete MSH we cannot NAK, so drop the connection
+        logger.error('Rejecting oversized MLLP frame: %s', err)
+        self.transport.close()
+
+    def pauseReading(self):
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def resumeReading(self):
+        if self.transport is not None:
+            self.transport.resume_reading()
+
+    def writeData(self, data):
+        if self.transport is not None:
+            self.transport.write(data)
+
+    def processMessage(self, raw_message):
+        seq = self.beginMessage()
+        receiver = self.server.receiver
+        codec = self.codec.forMessage(raw_message)
+        try:
+            # convert into unicode, parseMessage expects decoded string
+            container = receiver.parseMessage(codec.decode(raw_message))
+        except Exception:
+            # without a container there is no way to NAK, so drop the
+            # connection like any other protocol error
+            logger.exception('Unable to parse message')
+            self.transport.close()
+            self.completeMessage(seq, None)
+            return
+
+        try:
+            try:
+                result = receiver.handleMessage(container)
+            except Exception:
+                result = self.rejectMessage(container)
+            if isinstance(result, defer.Deferred):
+                result = result.asFuture(self.loop)
+            if inspect.isawaitable(result):
+                task = asyncio.ensure_future(self.awaitResponse(container, seq, result, codec))
+                self.tasks.add(task)
+                task.add_done_callback(self.responseDone)
+                return
+            response = self.encodeResponse(result, codec)
+        except Exception:
+            # send nothing rather than hold back the responses after it
+            logger.exception('Unable to respond to message')
+            response = None
+        self.completeMessage(seq, response)
+
+    async def awaitResponse(self, container, seq, result, codec):
+        try:
+            try:
+                response = await result
+            except Exception:
+                response = self.rejectMessage(container)
+            response = self.encodeResponse(response, codec)
+        except Exception:
+            logger.exception('Unable to respond to message')
+            response = None
+        self.completeMessage(seq, response)
+
+    def responseDone(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Error completing message', exc_info=task.exception())
+
+    def rejectMessage(self, container):
+        # called from an except block, the Failure captures the error
+        err = failure.Failure()
+        logger.error('Error handling message: %s', err.getErrorMessage())
+        return container.err(err)
+
+
+class MLLPServer(object):
+    """Protocol factory for :py:meth:`asyncio.AbstractEventLoop.create_server`,
+    configured like :py:class:`txHL7.mllp.MLLPFactory`.
+    """
+    protocol = MLLPServerProtocol
+
+    def __init__(self, receiver, max_frame_size=None, max_in_flight=None,
+                 idle_resolution=1.0):
+        verifyObject(IHL7Receiver, receiver)
+        self.receiver = receiver
+        self.codec = MLLPCodec.fromReceiver(receiver)
+        self.timeout = receiver.getTimeout()
+        self.max_frame_size = max_frame_size
+        self.max_in_flight = max_in_flight
+        self.idle_resolution = idle_resolution
+        self.idle = None
+
+    def __call__(self):
+        return self.protocol(self)
+
+    def idleTimer(self, loop):
+        """Return the :py:class:`txHL7.idle.IdleTimer` shared by the
+        connections, or None if the receiver has no timeout
+        """
+        if self.timeout is None:
+            return None
+        if self.idle is None:
+            self.idle = IdleTimer(self.timeout, self.idle_resolution, LoopClock(loop))
+        return self.idle
+
+
+class LoopClock(object):
+    """The :py:class:`twisted.internet.interfaces.IReactorTime` methods used
+    by :py:class:`txHL7.idle.IdleTimer`, for an asyncio ``loop``
+    """
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f, *args):
+        return self.loop.call_later(delay, f, *args)
+
+
+async def start_server(receiver, host=None, port=2575, loop=None, **kwargs):
+    """Listen for MLLP connections on ``host`` and ``port``, handling
+    messages with ``receiver``. Keyword arguments are passed to
+    :py:class:`txHL7.aio.MLLPServer`.
+
+    :rtype: :py:class:`asyncio.AbstractServer`
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return await loop.create_server(MLLPServer(receiver, **kwargs), host, port)
@@ -0,0 +1,80 @@
+from twisted.internet import defer
+from twisted.python import failure
+
+
+class MessageBatcher(object):
+    """Collects messages, from any number of connections, and passes them to
+    :py:meth:`txHL7.receiver.IHL7BatchReceiver.handleMessages` in a single
+    call, fanning the results back out to a Deferred per message.
+
+    A batch is handed over when :py:meth:`flush` is called, when it reaches
+    ``max_size`` messages, or ``window`` seconds after its first message
+    arrived. Without a ``window``, :py:class:`txHL7.mllp.MLLPFactory` flushes
+    after each read, so a batch holds the messages of one ``dataReceived``.
+    """
+    def __init__(self, handler, max_size=None, window=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.handler = handler
+        self.max_size = max_size
+        self.window = window
+        self.clock = clock
+        self.batches = 0
+        self._pending = []
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, message_container):
+        """Queue ``message_container`` for the next batch
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        d = defer.Deferred()
+        self._pending.append((message_container, d))
+        if self.max_size is not None and len(self._pending) >= self.max_size:
+            self.flush()
+        elif self.window is not None and self._timer is None:
+            self._timer = self.clock.callLater(self.window, self.flush)
+        return d
+
+    def flushSoon(self):
+        """Hand the pending messages to the handler on the next turn of the
+        reactor, unless a flush is already scheduled
+        """
+        if self._timer is None:
+            self._timer = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        """Hand every pending message to the handler now"""
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self.batches += 1
+
+        def onSuccess(results):
+            results = list(results)
+            if len(results) != len(batch):
+                raise ValueError(
+                    'handleMessages returned {0} results for {1} messages'.format(
+                        len(results), len(batch)
+                    )
+                )
+            for (message_container, d), result in zip(batch, results):
+                if isinstance(result, (failure.Failure, Exception)):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+        def onError(err):
+            for message_container, d in batch:
+                d.errback(err)
+
+        d = defer.maybeDeferred(self.handler, [c for c, _ in batch])
+        d.addCallback(onSuccess)
+        d.addErrback(onError)
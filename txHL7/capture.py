@@ -0,0 +1,224 @@
+"""Capture of received traffic for replay.
+
+Downstream logs keep the messages a server received, but not when they
+arrived or over which connections. Passing a
+:py:class:`txHL7.capture.CaptureWriter` to
+:py:class:`txHL7.mllp.MLLPFactory` records every frame with its connection
+and arrival time, along with the opening and closing of each connection, in
+rotating capture files that :py:class:`txHL7.replay.Replayer` sends again
+to any MLLP server.
+
+Records are collected in memory on the reactor thread and written by a
+thread of the writer's own, one batch at a time, so the server never waits
+for the disk, nor for the reactor's shared thread pool. If the disk falls behind by more than ``max_buffered`` bytes,
+frames are dropped from the capture (and counted) rather than delaying the
+server. Frames spooled to disk by :py:mod:`txHL7.spool` are not captured.
+
+Capture files start with :py:data:`MAGIC`, followed by records of a header
+(:py:attr:`CaptureWriter.header`: kind, connection id, time in seconds since
+the epoch and payload length) and the payload: the peer address for
+:py:data:`OPEN`, the frame, without MLLP wrapping, for :py:data:`FRAME`, and
+nothing for :py:data:`CLOSE`.
+"""
+import itertools
+import os
+import struct
+import time
+
+from twisted.internet import defer, threads
+from twisted.python import failure, log
+from twisted.python.threadpool import ThreadPool
+
+from txHL7.spool import SpooledFrame
+
+MAGIC = b'TXHL7CAP\x01'
+CAPTURE_SUFFIX = '.cap'
+
+OPEN, FRAME, CLOSE = 1, 2, 3
+
+HEADER = struct.Struct('>BIdI')
+
+
+def read_capture(path):
+    """Yield ``(kind, connection_id, timestamp, payload)`` for the records of
+    the capture file ``path``, stopping at a record torn by a crash
+
+    :rtype: iterator of tuples
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a txHL7 capture file'.format(path))
+        while True:
+            data = f.read(HEADER.size)
+            if len(data) < HEADER.size:
+                return
+            kind, connection_id, timestamp, length = HEADER.unpack(data)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield kind, connection_id, timestamp, payload
+
+
+class CaptureWriter(object):
+    """Writes capture files named ``capture-NNNNNN.cap`` to ``directory``,
+    starting a new one once a file reaches ``file_size`` bytes and keeping
+    at most ``max_files`` of them, or all if None.
+
+    Records are written once ``flush_size`` bytes are waiting or after
+    ``flush_interval`` seconds. Statistics: ``records`` and ``bytes``
+    written, and ``dropped`` frames.
+    """
+    header = HEADER
+
+    def __init__(self, directory, file_size=64 * 1024 * 1024, max_files=None,
+                 flush_size=256 * 1024, flush_interval=1.0,
+                 max_buffered=64 * 1024 * 1024, reactor=None, now=time.time):
+        if reactor is None:
+            from twisted.internet import reactor
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.file_size = file_size
+        self.max_files = max_files
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.reactor = reactor
+        self.now = now
+        self.files = sorted(
+            name for name in os.listdir(directory)
+            if name.startswith('capture-') and name.endswith(CAPTURE_SUFFIX)
+        )
+        self.records = 0
+        self.bytes = 0
+        self.dropped = 0
+        self._ids = itertools.count(1)
+        self._chunks = []
+        # bytes waiting, and being written
+        self._buffered = 0
+        self._writing = 0
+        self._file = None
+        self._call = None
+        self._flushing = None
+        # the thread writing the records, started by the first flush
+        self._pool = None
+
+    @property
+    def buffered(self):
+        """Bytes of records not yet written"""
+        return self._buffered + self._writing
+
+    def connectionOpened(self, peer=''):
+        """Record a new connection from ``peer``, returning its id
+
+        :rtype: int
+        """
+        connection_id = next(self._ids)
+        self._append(OPEN, connection_id, self.now(), peer.encode('utf-8', 'replace'))
+        return connection_id
+
+    def connectionClosed(self, connection_id):
+        self._append(CLOSE, connection_id, self.now(), b'')
+
+    def framesReceived(self, connection_id, frames):
+        """Record ``frames``, received together on connection ``connection_id``"""
+        timestamp = self.now()
+        for frame in frames:
+            if isinstance(frame, SpooledFrame):
+                # only the header is in memory
+                self.dropped += 1
+                continue
+            size = self.header.size + len(frame)
+            if self.buffered + size > self.max_buffered:
+                self.dropped += 1
+                continue
+            self._append(FRAME, connection_id, timestamp, frame)
+
+    def _append(self, kind, connection_id, timestamp, payload):
+        self._chunks.append(self.header.pack(kind, connection_id, timestamp, len(payload)))
+        self._chunks.append(payload)
+        self._buffered += self.header.size + len(payload)
+        if self._buffered >= self.flush_size:
+            self.flush()
+        elif self._call is None:
+            self._call = self.reactor.callLater(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Start writing the waiting records, unless a write is running, in
+        which case they follow it. Returns a Deferred firing once the
+        records waiting now are written.
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        if self._flushing is not None:
+            d = defer.Deferred()
+            self._flushing.addBoth(lambda result: self.flush().chainDeferred(d))
+            return d
+        if not self._chunks:
+            return defer.succeed(None)
+        chunks, self._chunks = self._chunks, []
+        self._writing, self._buffered = self._buffered, 0
+        if self._pool is None:
+            self._pool = ThreadPool(minthreads=0, maxthreads=1, name='txHL7.capture')
+            self._pool.start()
+        self._flushing = d = threads.deferToThreadPool(
+            self.reactor, self._pool, self._write, chunks,
+        )
+        d.addBoth(self._written, len(chunks) // 2)
+        return d
+
+    def _written(self, result, records):
+        self._flushing = None
+        if isinstance(result, failure.Failure):
+            log.err(result, 'Unable to write capture')
+            self.dropped += records
+        else:
+            self.records += records
+            self.bytes += self._writing
+        self._writing = 0
+        if self._buffered >= self.flush_size:
+            self.flush()
+        elif self._chunks and self._call is None:
+            self._call = self.reactor.callLater(self.flush_interval, self.flush)
+
+    def _write(self, chunks):
+        # in the writer's thread
+        if self._file is None or self._file.tell() >= self.file_size:
+            self._rotate()
+        self._file.writelines(chunks)
+        self._file.flush()
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        number = int(self.files[-1][8:-len(CAPTURE_SUFFIX)]) + 1 if self.files else 1
+        name = 'capture-{0:06d}{1}'.format(number, CAPTURE_SUFFIX)
+        self._file = open(os.path.join(self.directory, name), 'wb')
+        self._file.write(MAGIC)
+        self.files.append(name)
+        if self.max_files is not None:
+            while len(self.files) > self.max_files:
+                os.remove(os.path.join(self.directory, self.files.pop(0)))
+
+    def close(self):
+        """Write the waiting records, close the current file and stop the
+        writing thread
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        d = self.flush()
+
+        def closeFile(result):
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._pool is not None:
+                self._pool.stop()
+                self._pool = None
+
+        d.addBoth(closeFile)
+        return d
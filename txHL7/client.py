@@ -0,0 +1,228 @@
+"""MLLP client for sending messages to other HL7 systems.
+
+:py:class:`txHL7.client.MLLPClient` keeps a pool of persistent connections
+to each destination, given as a client endpoint string such as
+``tcp:host=engine.example.org:port=2575``. Each connection pipelines up to
+``window`` messages, and every send returns a Deferred that fires with the
+decoded ACK whose MSA-2 matches the message's MSH-10 control ID. Lost
+connections are re-established with exponential backoff.
+
+::
+
+    client = MLLPClient(pool_size=2, window=8)
+    d = client.send('tcp:host=localhost:port=2575', message)
+    d.addCallback(handle_ack)
+"""
+import collections
+
+from twisted.application.internet import ClientService, backoffPolicy
+from twisted.internet import defer, endpoints, error, protocol
+from twisted.python import log
+
+from txHL7 import framing
+from txHL7.view import HL7MessageView, read_header
+
+
+class MLLPClientProtocol(protocol.Protocol):
+    """Sends framed messages and matches the returned ACKs by control ID.
+
+    ACKs without an MSA-2 are assigned to the oldest outstanding message, as
+    MLLP responses are sent in order. ACKs whose MSA-2 matches no outstanding
+    message, such as the late ACK of a cancelled or timed out send, are
+    logged and discarded. The control IDs of the last ``tombstones``
+    cancelled sends are remembered, so that their ACKs are discarded
+    quietly.
+    """
+    tombstones = 100
+
+    def connectionMade(self):
+        self.scanner = framing.MLLPFrameScanner()
+        # control ID to the Deferreds waiting on it, in send order
+        self.pending = collections.OrderedDict()
+        # control IDs of cancelled sends to the number of ACKs still expected
+        self.cancelled = collections.OrderedDict()
+        self.outstanding = 0
+        self.factory.destination.connectionMade(self)
+
+    def connectionLost(self, reason):
+        self.factory.destination.connectionLost(self)
+        pending, self.pending = self.pending, collections.OrderedDict()
+        self.outstanding = 0
+        for deferreds in pending.values():
+            for d in deferreds:
+                d.errback(reason)
+
+    def sendMessage(self, message, control_id):
+        """Write the :py:class:`txHL7.framing.FramedMessage` ``message`` and
+        return a Deferred firing with the ACK for ``control_id``
+        """
+        d = defer.Deferred(lambda d: self._forget(control_id, d))
+        self.pending.setdefault(control_id, collections.deque()).append(d)
+        self.outstanding += 1
+        self.transport.write(message)
+        return d
+
+    def dataReceived(self, data):
+        for frame in self.scanner.feed(data):
+            ack = self.factory.destination.client.decode(frame)
+            try:
+                control_id = HL7MessageView(ack).field(u'MSA', 2) or None
+            except KeyError:
+                control_id = None
+            if control_id is None:
+                if not self.pending:
+                    log.msg(u'Discarding unexpected MLLP response: {0!r}'.format(ack))
+                    continue
+                control_id = next(iter(self.pending))
+            elif control_id in self.cancelled:
+                # the ACK of a cancelled send, which comes before that of
+                # any later send with the same control ID
+                self.cancelled[control_id] -= 1
+                if not self.cancelled[control_id]:
+                    del self.cancelled[control_id]
+                continue
+            elif control_id not in self.pending:
+                log.msg(u'Discarding MLLP response with unknown control ID: {0!r}'.format(ack))
+                continue
+            deferreds = self.pending[control_id]
+            d = deferreds.popleft()
+            if not deferreds:
+                del self.pending[control_id]
+            self.outstanding -= 1
+            d.callback(ack)
+        self.factory.destination.drain()
+
+    def _forget(self, control_id, d):
+        # a cancelled or timed out send no longer occupies the window
+        deferreds = self.pending.get(control_id, ())
+        if d in deferreds:
+            deferreds.remove(d)
+            if not deferreds:
+                del self.pending[control_id]
+            self.outstanding -= 1
+            self.cancelled[control_id] = self.cancelled.get(control_id, 0) + 1
+            while len(self.cancelled) > self.tombstones:
+                self.cancelled.popitem(last=False)
+            self.factory.destination.drain()
+
+
+class MLLPClientFactory(protocol.Factory):
+    protocol = MLLPClientProtocol
+
+    def __init__(self, destination):
+        self.destination = destination
+
+
+class Destination(object):
+    """The pooled connections of a :py:class:`txHL7.client.MLLPClient` to
+    one endpoint, and the sends waiting for room in their windows.
+    """
+    def __init__(self, client, endpoint_string):
+        self.client = client
+        self.endpoint_string = endpoint_string
+        self.connections = []
+        self.waiting = collections.deque()
+        endpoint = endpoints.clientFromString(client.reactor, endpoint_string)
+        factory = MLLPClientFactory(self)
+        self.services = [
+            ClientService(endpoint, factory, retryPolicy=client.retryPolicy,
+                          clock=client.reactor)
+            for i in range(client.pool_size)
+        ]
+        for service in self.services:
+            service.startService()
+
+    def send(self, message, control_id):
+        # the connection's Deferred, once the message has been written
+        sent = []
+
+        def cancel(d):
+            if sent:
+                sent[0].cancel()
+            else:
+                self.waiting.remove(entry)
+
+        d = defer.Deferred(cancel)
+        entry = (message, control_id, d, sent)
+        self.waiting.append(entry)
+        self.drain()
+        return d
+
+    def drain(self):
+        """Send waiting messages on the least busy connections"""
+        window = self.client.window
+        while self.waiting and self.connections:
+            connection = min(self.connections, key=lambda c: c.outstanding)
+            if connection.outstanding >= window:
+                break
+            message, control_id, d, sent = self.waiting.popleft()
+            sent.append(connection.sendMessage(message, control_id))
+            sent[0].chainDeferred(d)
+
+    def connectionMade(self, connection):
+        self.connections.append(connection)
+        self.drain()
+
+    def connectionLost(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+
+    def close(self):
+        for message, control_id, d, sent in self.waiting:
+            d.errback(error.ConnectionDone('MLLP client closed'))
+        self.waiting.clear()
+        return defer.DeferredList([s.stopService() for s in self.services])
+
+
+class MLLPClient(object):
+    """Pooled, pipelining MLLP client.
+
+    ``pool_size`` connections are opened to each destination, each with up
+    to ``window`` messages awaiting their ACK. Messages are unicode strings,
+    encoded with ``encoding`` and ``errors``, or already encoded bytestrings.
+    Sends that are outstanding when a connection is lost fail with the
+    connection's error rather than being retried, as the destination may
+    already have processed them. ``timeout``, if not None, fails a send
+    whose ACK has not arrived within that many seconds.
+    """
+    def __init__(self, reactor=None, encoding='utf-8', errors='strict',
+                 pool_size=1, window=1, timeout=None, retryPolicy=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.encoding = encoding
+        self.errors = errors
+        self.pool_size = pool_size
+        self.window = window
+        self.timeout = timeout
+        self.retryPolicy = retryPolicy or backoffPolicy()
+        self.destinations = {}
+
+    def send(self, endpoint_string, message):
+        """Send ``message`` to the endpoint, returning a Deferred that fires
+        with its ACK as a unicode string
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        if not isinstance(message, bytes):
+            message = message.encode(self.encoding, self.errors)
+        control_id = self.decode(read_header(message).field(10))
+        destination = self.destinations.get(endpoint_string)
+        if destination is None:
+            destination = Destination(self, endpoint_string)
+            self.destinations[endpoint_string] = destination
+        d = destination.send(framing.frame(message), control_id)
+        if self.timeout is not None:
+            d.addTimeout(self.timeout, self.reactor)
+        return d
+
+    def decode(self, value):
+        return value.decode(self.encoding, self.errors)
+
+    def close(self):
+        """Disconnect from every destination
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        destinations, self.destinations = self.destinations, {}
+        return defer.DeferredList([d.close() for d in destinations.values()])
@@ -0,0 +1,403 @@
+"""Event loop independent MLLP connection logic.
+
+:py:class:`txHL7.core.MLLPConnection` holds everything about an MLLP
+connection that does not depend on the networking framework: framing, the
+queue of messages waiting for an in-flight slot, ordering of responses, and
+encoding of ACKs. The Twisted :py:class:`txHL7.mllp.MinimalLowerLayerProtocol`
+and the asyncio :py:class:`txHL7.aio.MLLPServerProtocol` combine it with their
+framework's protocol class and implement its hooks.
+"""
+import codecs
+import collections
+import sys
+
+from txHL7 import framing
+from txHL7.receiver import IHL7BytesReceiver
+from txHL7.sequencer import ResponseSequencer
+from txHL7.view import read_header
+
+# HL7 table 0211 character sets (MSH-18) to python codecs. Messages are framed
+# and their headers read as bytes, so only ASCII compatible character sets
+# are included, not UTF-16 or UTF-32.
+CHARSETS = {
+    'ASCII': 'ascii',
+    '8859/1': 'iso8859-1',
+    '8859/2': 'iso8859-2',
+    '8859/3': 'iso8859-3',
+    '8859/4': 'iso8859-4',
+    '8859/5': 'iso8859-5',
+    '8859/6': 'iso8859-6',
+    '8859/7': 'iso8859-7',
+    '8859/8': 'iso8859-8',
+    '8859/9': 'iso8859-9',
+    '8859/15': 'iso8859-15',
+    'UNICODE UTF-8': 'utf-8',
+    'ISO IR6': 'ascii',
+    'ISO IR100': 'iso8859-1',
+    'ISO IR87': 'iso2022_jp',
+    'ISO IR159': 'iso2022_jp_2',
+    'GB 18030-2000': 'gb18030',
+    'KS X 1001': 'euc_kr',
+    'BIG-5': 'big5',
+}
+
+
+class MLLPCodec(object):
+    """Converts between the bytes on the wire and the unicode strings
+    receivers work with, using the receiver's declared codec.
+    """
+    # whether frames are decoded before they are parsed
+    decodes = True
+
+    def __init__(self, encoding=None, errors=None):
+        self.encoding = encoding or sys.getdefaultencoding()
+        self.errors = errors or 'strict'
+
+    @classmethod
+    def fromReceiver(cls, receiver):
+        """Create the codec from :py:meth:`txHL7.receiver.IHL7Receiver.getCodec`,
+        which may return a codec name, a tuple of codec name and error
+        handling scheme, or an :py:class:`txHL7.core.MLLPCodec` instance.
+        :py:class:`txHL7.receiver.IHL7BytesReceiver` receivers get a
+        :py:class:`txHL7.core.BytesCodec`.
+        """
+        if IHL7BytesReceiver.providedBy(receiver):
+            return BytesCodec()
+        encoding = receiver.getCodec()
+        if isinstance(encoding, MLLPCodec):
+            return encoding
+        if isinstance(encoding, tuple):
+            encoding, errors = encoding
+        else:
+            errors = None
+        return cls(encoding, errors)
+
+    def forMessage(self, raw_message):
+        """Return the codec for the raw message ``raw_message`` and its
+        response
+
+        :rtype: :py:class:`txHL7.core.MLLPCodec`
+        """
+        return self
+
+    def decode(self, value):
+        # turn value into unicode using the receiver's declared codec
+        if isinstance(value, bytes):
+            return value.decode(self.encoding, self.errors)
+        return str(value)
+
+    def encode(self, value):
+        # turn value into byte string using the receiver's declared codec
+        if isinstance(value, str):
+            return value.encode(self.encoding, self.errors)
+        return value
+
+
+class BytesCodec(MLLPCodec):
+    """Codec of :py:class:`txHL7.receiver.IHL7BytesReceiver` receivers, which
+    are given the frames undecoded. Responses that are bytestrings are written
+    as they are, while text is encoded as ``encoding``.
+    """
+    decodes = False
+
+    def __init__(self, encoding='ascii', errors='strict'):
+        super(BytesCodec, self).__init__(encoding, errors)
+
+    def decode(self, value):
+        return value
+
+
+class CharsetCodec(MLLPCodec):
+    """Chooses the codec of each message from its character set, MSH-18,
+    using :py:data:`txHL7.core.CHARSETS` updated with ``charsets``. Messages
+    without MSH-18, or with an unknown character set, use ``default`` (an
+    :py:class:`txHL7.core.MLLPCodec`). Responses are encoded like the message
+    they answer.
+
+    Receivers use it by returning it from
+    :py:meth:`txHL7.receiver.IHL7Receiver.getCodec`, or with
+    ``MLLPFactory(detect_charset=True)``.
+    """
+    def __init__(self, default=None, errors=None, charsets=None):
+        if default is None:
+            default = MLLPCodec(errors=errors)
+        super(CharsetCodec, self).__init__(default.encoding, default.errors)
+        self.default = default
+        self.charsets = dict(CHARSETS)
+        if charsets:
+            self.charsets.update(charsets)
+        # raw MSH-18 values to their codec
+        self._codecs = {}
+
+    def forMessage(self, raw_message):
+        charset = read_header(raw_message).field(18)
+        try:
+            return self._codecs[charset]
+        except KeyError:
+            pass
+        codec = self.default
+        name, repetition = charset, raw_message[5:6]
+        if isinstance(name, bytes):
+            name = name.decode('ascii', 'replace')
+            repetition = repetition.decode('ascii', 'replace')
+        if repetition:
+            # the first repetition is the default character set
+            name = name.split(repetition)[0]
+        encoding = self.charsets.get(name.strip().upper())
+        if encoding is not None:
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                pass
+            else:
+                codec = MLLPCodec(encoding, self.default.errors)
+        # MSH-18 holds one of a few values, so the cache stays small
+        if len(self._codecs) < 1000:
+            self._codecs[charset] = codec
+        return codec
+
+    def decode(self, value):
+        if isinstance(value, bytes):
+            return self.forMessage(value).decode(value)
+        return str(value)
+
+    def encode(self, value):
+        if isinstance(value, str):
+            return self.forMessage(value).encode(value)
+        return value
+
+
+class MLLPConnection(object):
+    """Transport independent state of one MLLP connection.
+
+    Frames found by :py:meth:`framesReceived` are queued and passed to
+    :py:meth:`processMessage` while fewer than ``max_in_flight`` messages are
+    outstanding, otherwise reading is paused until the queue drains.
+    Implementations call :py:meth:`beginMessage` when they start handling a
+    message and :py:meth:`completeMessage` with its response, which is
+    written once every earlier response has been.
+
+    Subclasses provide ``codec`` (a :py:class:`txHL7.core.MLLPCodec`),
+    ``max_frame_size``, ``max_in_flight`` and optionally ``metrics`` (a
+    :py:class:`txHL7.metrics.Metrics`), ``admission`` (a
+    :py:class:`txHL7.admission.AdmissionControl`) and ``tracer`` (a
+    :py:class:`txHL7.trace.Tracer`), and implement the hooks
+    :py:meth:`processMessage`, :py:meth:`writeData`, :py:meth:`pauseReading`,
+    :py:meth:`resumeReading` and :py:meth:`frameTooLarge`.
+    """
+    start_block = framing.START_BLOCK  # <VT>, vertical tab
+    end_block = framing.END_BLOCK  # <FS>, file separator
+    carriage_return = framing.CARRIAGE_RETURN  # <CR>, \r
+
+    codec = None
+    max_frame_size = None
+    max_in_flight = None
+    metrics = None
+    admission = None
+    tracer = None
+    # txHL7.capture.CaptureWriter recording received frames, and the id it
+    # gave the connection
+    capture = None
+    capture_id = None
+    # the trace of the frame being passed to processMessage
+    trace = None
+
+    def startConnection(self):
+        self.scanner = self.buildScanner()
+        # frames waiting for an in-flight slot. Most connections are idle
+        # most of the time, so the deque is only kept while it holds frames.
+        self.queue = ()
+        self.queued_bytes = 0
+        self.sequencer = ResponseSequencer(self.releaseMessage)
+        self.in_flight = 0
+        # reading is paused while max_in_flight is reached (paused), or while
+        # held by admission control
+        self.paused = False
+        self.held = False
+        self.reading = True
+        self._dispatching = False
+        if self.tracer is not None:
+            self.connection_id = self.tracer.connectionId()
+            # traces of queued frames, and of messages awaiting their write
+            self.queued_traces = collections.deque()
+            self.pending_traces = collections.deque()
+
+    def buildScanner(self):
+        return framing.MLLPFrameScanner(
+            max_frame_size=self.max_frame_size,
+            start_block=self.start_block,
+            end_block=self.end_block,
+        )
+
+    def framesReceived(self, data):
+        """Queue and dispatch the messages completed by ``data``"""
+        # find the complete message(s), the scanner keeps any partial message
+        # buffered until the rest of it arrives
+        metrics = self.metrics
+        tracer = self.tracer
+        if tracer is not None:
+            traced = tracer.clock()
+        try:
+            if metrics is None:
+                messages = self.scanner.feed(data)
+            else:
+                start = metrics.clock()
+                messages = self.scanner.feed(data)
+                metrics.observe('frame', start)
+                metrics.increment('bytes_received', len(data))
+                metrics.increment('messages', len(messages))
+        except framing.FrameTooLarge as e:
+            self.frameTooLarge(e)
+            return
+
+        if messages:
+            if self.capture is not None:
+                self.capture.framesReceived(self.capture_id, messages)
+            if self.queue:
+                self.queue.extend(messages)
+            else:
+                self.queue = collections.deque(messages)
+            self.queued_bytes += sum(map(len, messages))
+            if tracer is not None:
+                end = tracer.clock()
+                self.queued_traces.extend(
+                    tracer.begin(self.connection_id, message, traced, end)
+                    for message in messages
+                )
+        self.dispatchMessages()
+
+    def dispatchMessages(self):
+        """Pass queued messages to :py:meth:`processMessage` while there are
+        free in-flight slots. Once ``max_in_flight`` messages are outstanding,
+        stop reading so that TCP flow control pushes back on the sender, and
+        resume once the queue has drained.
+        """
+        if self._dispatching:
+            # a message completed synchronously, the outer loop continues
+            return
+        self._dispatching = True
+        try:
+            limit = self.max_in_flight
+            while self.queue and (limit is None or self.in_flight < limit):
+                frame = self.queue.popleft()
+                self.queued_bytes -= len(frame)
+                if self.tracer is not None:
+                    self.trace = self.queued_traces.popleft()
+                    self.pending_traces.append(self.trace)
+                self.processMessage(frame)
+                self.trace = None
+        finally:
+            self._dispatching = False
+        if not self.queue:
+            self.queue = ()
+        self.messagesDispatched()
+
+        if limit is not None and self.in_flight >= limit:
+            self.paused = True
+        elif not self.queue:
+            self.paused = False
+        if self.admission is not None:
+            self.admission.update(self)
+        self.updateReading()
+
+    def updateReading(self):
+        """Pause or resume reading, as flow control and admission control
+        require
+        """
+        pause = self.paused or self.held
+        if pause and self.reading:
+            self.reading = False
+            self.pauseReading()
+        elif not pause and not self.reading:
+            self.reading = True
+            self.resumeReading()
+
+    def beginMessage(self):
+        """Reserve the response slot of a message being processed, returning
+        the sequence number to pass to :py:meth:`completeMessage`
+
+        :rtype: int
+        """
+        # messages are handled concurrently, the sequencer writes their
+        # responses in order
+        self.in_flight += 1
+        return self.sequencer.reserve()
+
+    def completeMessage(self, seq, response):
+        """Record the ``response`` (or None for no response) of message ``seq``"""
+        self.sequencer.complete(seq, response)
+        self.dispatchMessages()
+
+    def releaseMessage(self, message):
+        # called by the sequencer once every earlier response is written
+        self.in_flight -= 1
+        tracer = self.tracer
+        if tracer is None:
+            self.writeMessage(message)
+            return
+        # responses are released in the order their frames were dispatched
+        trace = self.pending_traces.popleft()
+        start = tracer.clock()
+        self.writeMessage(message)
+        tracer.span(trace, 'write', start)
+        tracer.finish(trace)
+
+    def encodeResponse(self, response, codec):
+        """Encode ``response`` with ``codec``, the codec of the message it
+        answers, if that is not the connection's codec
+        """
+        if response is None or codec is self.codec:
+            return response
+        return framing.FramedMessage(self.encodeMessage(response, codec))
+
+    def writeMessage(self, message):
+        if message is None:
+            return
+        metrics = self.metrics
+        if metrics is None:
+            self.writeData(self.encodeMessage(message))
+            return
+        start = metrics.clock()
+        data = self.encodeMessage(message)
+        metrics.observe('ack', start)
+        start = metrics.clock()
+        self.writeData(data)
+        metrics.observe('write', start)
+        metrics.increment('bytes_sent', len(data))
+
+    def encodeMessage(self, message, codec=None):
+        """Encode and wrap a response for writing, with ``codec`` or the
+        connection's codec
+
+        :rtype: bytes
+        """
+        if isinstance(message, framing.FramedMessage):
+            # already encoded and wrapped, e.g. by txHL7.ack.ACKBuilder
+            return message
+        # convert back to a byte string
+        message = (codec or self.codec).encode(message)
+        # wrap message in payload container
+        return self.start_block + message + self.end_block + self.carriage_return
+
+    def messagesDispatched(self):
+        """Called after each round of :py:meth:`dispatchMessages`"""
+
+    def processMessage(self, raw_message):
+        """Start handling the frame ``raw_message``"""
+        raise NotImplementedError
+
+    def writeData(self, data):
+        """Write bytes to the transport"""
+        raise NotImplementedError
+
+    def pauseReading(self):
+        raise NotImplementedError
+
+    def resumeReading(self):
+        raise NotImplementedError
+
+    def frameTooLarge(self, err):
+        """Handle :py:class:`txHL7.framing.FrameTooLarge`, which leaves the
+        connection unusable.
+        """
+        raise NotImplementedError
@@ -0,0 +1,125 @@
+"""Suppression of retransmitted messages.
+
+Senders that time out waiting for an ACK send the message again, often while
+the first copy is still being handled. :py:class:`txHL7.dedup.DuplicateCache`,
+passed to :py:class:`txHL7.mllp.MLLPFactory` as ``duplicates``, recognises a
+message by its sending facility (MSH-4) and control ID (MSH-10), read from the
+raw frame before it is decoded or parsed. A copy of a message that was
+accepted is answered with the ACK sent for the original, and a copy of a
+message still being handled waits for the original's response.
+
+Only accepting ACKs (MSA-1 of AA or CA) are cached, so a message that was
+rejected is handled again when it is retransmitted.
+"""
+import collections
+
+from twisted.internet import defer
+
+from txHL7 import framing
+from txHL7.view import HL7MessageView, read_header
+
+ACCEPT_CODES = (b'AA', b'CA')
+
+
+class DuplicateCache(object):
+    """Bounded LRU cache of the ACKs sent for recent messages.
+
+    At most ``max_entries`` ACKs are kept, each for at most ``ttl`` seconds.
+    An entry holds the key and the framed ACK, typically 300-500 bytes, so
+    the default of 100,000 entries stays below about 50 MB however many
+    control IDs are seen. Statistics:
+
+    * ``hits`` -- duplicates answered from the cache
+    * ``waits`` -- duplicates that arrived while the original was being handled
+    * ``misses`` -- messages handled normally
+    * ``evictions`` -- entries dropped to stay within ``max_entries``
+    * ``expirations`` -- entries dropped after ``ttl``
+    """
+    def __init__(self, max_entries=100000, ttl=3600, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        # key to (expiry time, FramedMessage), least recently used first
+        self._entries = collections.OrderedDict()
+        # key to the Deferreds of duplicates waiting for the original
+        self._pending = {}
+        self.hits = 0
+        self.waits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(frame):
+        """Return the ``(MSH-4, MSH-10)`` of the raw ``frame``, or None if it
+        has no control ID
+
+        :rtype: tuple of bytes
+        """
+        header = read_header(frame)
+        control_id = header.field(10)
+        if not control_id:
+            return None
+        return header.field(4), control_id
+
+    def begin(self, key):
+        """Start handling the message ``key``. Returns None if it is not a
+        duplicate, in which case :py:meth:`finish` must be called with its
+        response, otherwise a Deferred firing with the response to send.
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred` or None
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expiry, ack = entry
+            if expiry > self.clock.seconds():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return defer.succeed(ack)
+            del self._entries[key]
+            self.expirations += 1
+        if key in self._pending:
+            self.waits += 1
+            d = defer.Deferred()
+            self._pending[key].append(d)
+            return d
+        self.misses += 1
+        self._pending[key] = []
+        return None
+
+    def finish(self, key, ack):
+        """Record the encoded, framed response ``ack`` (or None) to the message
+        ``key``, answering any duplicates waiting for it, and return it.
+        """
+        if ack is not None and self.accepted(ack):
+            self.store(key, ack)
+        for d in self._pending.pop(key, ()):
+            d.callback(ack)
+        return ack
+
+    def accepted(self, ack):
+        try:
+            return HL7MessageView(ack[1:-2]).field(b'MSA', 1) in ACCEPT_CODES
+        except KeyError:
+            return False
+
+    def store(self, key, ack):
+        now = self.clock.seconds()
+        entries = self._entries
+        entries[key] = (now + self.ttl, framing.FramedMessage(ack))
+        entries.move_to_end(key)
+        # drop expired entries from the least recently used end
+        while entries:
+            oldest = next(iter(entries))
+            if entries[oldest][0] > now:
+                break
+            del entries[oldest]
+            self.expirations += 1
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,142 @@
+"""Incremental MLLP framing.
+
+MLLP frames take the form ``<VT>[HL7 Message]<FS><CR>``.
+:py:class:`txHL7.framing.MLLPFrameScanner` accumulates received bytes in a
+single growable buffer and remembers how far it has already searched, so each
+received chunk is only scanned once regardless of how many reads a large
+frame spans.
+"""
+
+START_BLOCK = b'\x0b'  # <VT>, vertical tab
+END_BLOCK = b'\x1c'  # <FS>, file separator
+CARRIAGE_RETURN = b'\x0d'  # <CR>, \r
+
+# bytes that may precede the start block of a frame: the <CR> trailer of the
+# previous frame, plus stray line feeds from lenient senders
+_FRAME_PADDING = frozenset(b'\x0b\x0d\x0a')
+
+
+class FramedMessage(bytes):
+    """A message that has already been encoded and wrapped in the MLLP
+    ``<VT>`` / ``<FS><CR>`` block, and is written to the transport as is.
+    """
+
+
+def frame(payload, start_block=START_BLOCK, end_block=END_BLOCK,
+          carriage_return=CARRIAGE_RETURN):
+    """Wrap the encoded ``payload`` in an MLLP block
+
+    :rtype: :py:class:`txHL7.framing.FramedMessage`
+    """
+    return FramedMessage(b''.join((start_block, payload, end_block, carriage_return)))
+
+
+class MLLPError(Exception):
+    """Base class for MLLP framing errors"""
+
+
+class FrameTooLarge(MLLPError):
+    """Raised when a frame exceeds the configured maximum frame size, either
+    once complete or while still unterminated.
+    """
+    def __init__(self, size, max_frame_size):
+        super(FrameTooLarge, self).__init__(
+            'MLLP frame of at least {0} bytes exceeds maximum of {1} bytes'.format(
+                size, max_frame_size
+            )
+        )
+        self.size = size
+        self.max_frame_size = max_frame_size
+
+
+class MLLPFrameScanner(object):
+    """Splits a byte stream into MLLP frames.
+
+    Received data is appended to a :py:class:`bytearray`. Only the bytes that
+    arrived since the last call to :py:meth:`feed` are searched for the end
+    block, and consumed frames are released from the front of the buffer in a
+    single operation per call, so the total work is linear in the number of
+    bytes received.
+
+    ``max_frame_size``, if not None, is the largest frame payload (in bytes)
+    that will be accepted. :py:class:`txHL7.framing.FrameTooLarge` is raised
+    as soon as a frame is known to exceed it, without waiting for the end
+    block. After the error, the scanner is reset and should be discarded
+    along with the connection.
+    """
+    # one scanner per connection
+    __slots__ = ('max_frame_size', 'start_block', 'end_block', '_buffer', '_scan_offset')
+
+    def __init__(self, max_frame_size=None, start_block=START_BLOCK,
+                 end_block=END_BLOCK):
+        self.max_frame_size = max_frame_size
+        self.start_block = start_block
+        self.end_block = end_block
+        self._buffer = bytearray()
+        # position in _buffer from which the next end block search starts
+        self._scan_offset = 0
+
+    def __len__(self):
+        """Number of bytes buffered for a frame that is not yet complete."""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Append ``data`` and return a list of the frames it completed, as
+        bytestrings without the MLLP ``<VT>`` / ``<FS><CR>`` wrapping. Empty
+        frames are dropped.
+
+        :rtype: list of bytes
+        """
+        buf = self._buffer
+        buf += data
+        end_block = self.end_block
+        frames = []
+        start = 0
+        offset = self._scan_offset
+        view = memoryview(buf)
+        try:
+            while True:
+                end = buf.find(end_block, offset)
+                if end == -1:
+                    break
+                message = self._extract(view, start, end)
+                if message:
+                    frames.append(message)
+                start = offset = end + len(end_block)
+        finally:
+            view.release()
+
+        if start:
+            # release every consumed frame in one move, so a partial frame is
+            # shifted at most once per feed
+            del buf[:start]
+        self._scan_offset = len(buf)
+
+        if self.max_frame_size is not None and self._pending_size() > self.max_frame_size:
+            size = self._pending_size()
+            self.reset()
+            raise FrameTooLarge(size, self.max_frame_size)
+        return frames
+
+    def reset(self):
+        """Discard any partially received frame."""
+        self._buffer = bytearray()
+        self._scan_offset = 0
+
+    def _extract(self, view, start, end):
+        # skip the <CR> trailer of the previous frame and the <VT> start block
+        while start < end and view[start] in _FRAME_PADDING:
+            start += 1
+        size = end - start
+        if self.max_frame_size is not None and size > self.max_frame_size:
+            self.reset()
+            raise FrameTooLarge(size, self.max_frame_size)
+        return view[start:end].tobytes()
+
+    def _pending_size(self):
+        buf = self._buffer
+        start = 0
+        # a few bytes of padding at most, never the payload itself
+        while start < len(buf) and buf[start] in _FRAME_PADDING:
+            start += 1
+        return len(buf) - start
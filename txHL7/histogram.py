@@ -0,0 +1,172 @@
+"""Compact latency histogram.
+
+:py:class:`txHL7.histogram.Histogram` uses the bucketing scheme of HdrHistogram:
+values below ``2 ** precision`` are counted exactly, and larger values in
+buckets whose width is a fixed fraction of their magnitude, so percentiles
+keep about three significant digits across the whole range while only
+occupied buckets use memory.
+
+:py:class:`txHL7.histogram.BusyTimer` measures the fraction of time a fixed
+number of workers, such as threads or lanes, spend busy.
+"""
+import math
+import time
+
+
+class Histogram(object):
+    """Records non-negative integer values, such as latencies in microseconds.
+
+    ``precision`` is the number of bits of each value that are kept. The
+    default of 11 keeps values accurate to within 0.1%.
+    """
+    def __init__(self, precision=11):
+        self.precision = precision
+        self._sub_buckets = 1 << precision
+        self._half = self._sub_buckets >> 1
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, value):
+        if value < self._sub_buckets:
+            return value
+        shift = value.bit_length() - self.precision
+        return self._sub_buckets + (shift - 1) * self._half + ((value >> shift) - self._half)
+
+    def _highest(self, index):
+        # the largest value counted in bucket ``index``
+        if index < self._sub_buckets:
+            return index
+        shift, offset = divmod(index - self._sub_buckets, self._half)
+        shift += 1
+        return ((self._half + offset + 1) << shift) - 1
+
+    def record(self, value, count=1, expected_interval=None):
+        """Record ``value`` ``count`` times.
+
+        If ``expected_interval`` is given, and ``value`` is larger, the values
+        that would have been recorded had the measurement not stalled are
+        added too (``value - expected_interval``, ``value - 2 *
+        expected_interval``, ...), correcting for coordinated omission like
+        HdrHistogram's ``recordValueWithExpectedInterval``.
+        """
+        value = int(value)
+        if value < 0:
+            raise ValueError('Histogram values must not be negative')
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if expected_interval:
+            missing = value - expected_interval
+            while missing >= expected_interval:
+                self.record(missing, count)
+                missing -= expected_interval
+
+    def merge(self, other):
+        """Add the values recorded by ``other``"""
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percentile):
+        """Return the value at ``percentile`` (0-100), as the highest value
+        equivalent to the bucket it falls in, or 0 if nothing was recorded.
+        """
+        if not self.count:
+            return 0
+        target = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest(index), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 99, 99.9)):
+        """Return a dict of count, min, mean, max and the given percentiles"""
+        result = {
+            'count': self.count,
+            'min': self.min or 0,
+            'mean': self.mean(),
+            'max': self.max or 0,
+        }
+        for p in percentiles:
+            result['p{0:g}'.format(p)] = self.percentile(p)
+        return result
+
+    def summaryLine(self, scale=1e3):
+        """Return the median, 99th and 99.9th percentiles, maximum and mean,
+        divided by ``scale``, on one line; by default microseconds as
+        milliseconds
+
+        :rtype: str
+        """
+        summary = self.summary()
+        return 'p50 {0:.3f}  p99 {1:.3f}  p99.9 {2:.3f}  max {3:.3f}  mean {4:.3f}'.format(
+            summary['p50'] / scale, summary['p99'] / scale, summary['p99.9'] / scale,
+            summary['max'] / scale, summary['mean'] / scale)
+
+
+class BusyTimer(object):
+    """Tracks the time ``slots`` concurrent workers spend busy, as read from
+    the monotonic clock ``now``. Each piece of work calls :py:meth:`begin`,
+    and :py:meth:`end` with the start time it returned.
+    """
+    def __init__(self, slots, now=time.monotonic):
+        self.slots = slots
+        self.now = now
+        self.busy_time = 0.0
+        self.started = None
+        self.running = 0
+        # sum of the start times of the running work
+        self._running_since = 0.0
+
+    def start(self):
+        """Start measuring utilization"""
+        self.started = self.now()
+
+    def begin(self):
+        """Record the start of a piece of work, returning its start time
+
+        :rtype: float
+        """
+        start = self.now()
+        self.running += 1
+        self._running_since += start
+        return start
+
+    def end(self, start):
+        """Record the end of the piece of work started at ``start``"""
+        self.running -= 1
+        self._running_since -= start
+        self.busy_time += self.now() - start
+
+    @property
+    def utilization(self):
+        """The fraction of the workers' time spent busy since :py:meth:`start`"""
+        if self.started is None:
+            return 0.0
+        now = self.now()
+        elapsed = (now - self.started) * self.slots
+        if not elapsed:
+            return 0.0
+        busy = self.busy_time + self.running * now - self._running_since
+        return busy / elapsed
@@ -0,0 +1,111 @@
+"""Idle timeouts shared by many connections.
+
+:py:class:`twisted.protocols.policies.TimeoutMixin` gives each connection its
+own delayed call, which is moved in the reactor's timer heap on every read.
+:py:class:`txHL7.idle.IdleTimer` instead only records when a connection was
+last active, and checks all of them from a single timer.
+
+Connections are filed in a wheel of slots ``resolution`` seconds wide by the
+time they would time out. When a slot comes due, connections that have been
+active since they were filed are moved to the slot of their new expiry, so a
+busy connection is looked at about once per timeout instead of once per
+read. A connection times out between ``timeout`` and ``timeout +
+resolution`` seconds after its last activity.
+"""
+import math
+
+
+class IdleTimer(object):
+    """Closes connections that have been idle for ``timeout`` seconds, in
+    batches of those expiring within the same ``resolution`` seconds, using
+    ``clock`` (an :py:class:`twisted.internet.interfaces.IReactorTime`, by
+    default the reactor).
+
+    Connections are added with :py:meth:`add` and call :py:meth:`touch` when
+    they receive data. The timer keeps their ``last_activity`` and
+    ``idle_slot`` attributes, and calls ``timeoutConnection()`` on those that
+    expire. ``expired`` counts them.
+    """
+    def __init__(self, timeout, resolution=1.0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.timeout = timeout
+        if timeout > 0:
+            resolution = min(resolution, timeout)
+        self.resolution = resolution
+        self.clock = clock
+        # slot number to the connections expiring in it
+        self.slots = {}
+        self.expired = 0
+        self._count = 0
+        self._call = None
+
+    def __len__(self):
+        """Number of connections being timed"""
+        return self._count
+
+    def add(self, connection):
+        """Start timing ``connection``, as if it had just been active"""
+        now = self.clock.seconds()
+        connection.last_activity = now
+        self._count += 1
+        self._file(connection, now + self.timeout)
+
+    def touch(self, connection):
+        """Record activity on ``connection``"""
+        connection.last_activity = self.clock.seconds()
+
+    def remove(self, connection):
+        """Stop timing ``connection``, e.g. once it is closed"""
+        number = getattr(connection, 'idle_slot', None)
+        slot = self.slots.get(number)
+        if slot is None or connection not in slot:
+            return
+        slot.discard(connection)
+        if not slot:
+            del self.slots[number]
+        connection.idle_slot = None
+        self._count -= 1
+        if not self._count:
+            self.stop()
+
+    def stop(self):
+        """Cancel the pending sweep"""
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _file(self, connection, deadline):
+        number = int(math.ceil(deadline / self.resolution))
+        connection.idle_slot = number
+        slot = self.slots.get(number)
+        if slot is None:
+            slot = self.slots[number] = set()
+        slot.add(connection)
+        if self._call is None:
+            self._schedule()
+
+    def _schedule(self):
+        # sweep when the earliest slot ends. Connections filed later expire
+        # no earlier, as their last activity is no earlier.
+        delay = min(self.slots) * self.resolution - self.clock.seconds()
+        self._call = self.clock.callLater(max(delay, 0), self.sweep)
+
+    def sweep(self):
+        """Time out the connections whose slots are due, and move the rest"""
+        self._call = None
+        now = self.clock.seconds()
+        # allow for rounding when the sweep runs exactly at a slot's end
+        current = now / self.resolution + 1e-9
+        for number in [n for n in self.slots if n <= current]:
+            for connection in self.slots.pop(number):
+                deadline = connection.last_activity + self.timeout
+                if deadline <= now:
+                    connection.idle_slot = None
+                    self._count -= 1
+                    self.expired += 1
+                    connection.timeoutConnection()
+                else:
+                    self._file(connection, deadline)
+        if self.slots and self._call is None:
+            self._schedule()
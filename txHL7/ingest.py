@@ -0,0 +1,526 @@
+"""Offline ingestion of HL7 files.
+
+Backfills HL7 batch files and MLLP capture dumps straight into an
+:py:class:`txHL7.receiver.IHL7Receiver`, without a server or sockets::
+
+    python -m txHL7.ingest --receiver myreceiver.Receiver \\
+        --concurrency 200 --workers 4 --progress 10 archive/*.hl7
+
+Files are memory-mapped and split by :py:func:`txHL7.ingest.iter_messages`:
+files starting with an MLLP start block are split on their frames, others,
+including FHS/BHS batch files, on their MSH segments. Each message is decoded
+with the receiver's codec and passed to ``parseMessage`` and ``handleMessage``
+as if it had been received by :py:class:`txHL7.mllp.MLLPFactory`, with at most
+``concurrency`` ``handleMessage`` calls outstanding.
+
+With ``--workers``, :py:func:`txHL7.ingest.shard` divides the files into byte
+ranges of about the same size, each ingested by its own process. A message
+belongs to the range holding its first byte, so ranges need not fall on
+message boundaries.
+"""
+import mmap
+import os
+import re
+import sys
+import time
+
+from twisted.internet import defer, protocol, task
+from twisted.python import log, reflect, usage
+from zope.interface.verify import verifyObject
+
+from txHL7 import framing
+from txHL7.core import BytesCodec, CharsetCodec, MLLPCodec
+from txHL7.histogram import Histogram
+from txHL7.receiver import IHL7Receiver
+from txHL7.view import HL7MessageView
+
+# segments of FHS/BHS batch files that are not part of any message
+BATCH_SEGMENTS = (b'FHS', b'BHS', b'BTS', b'FTS')
+
+# prefix of the line with which worker processes report their totals
+RESULT = 'txhl7-ingest-result'
+
+_FRAMED = re.compile(br'[ \t\r\n]*\x0b')
+_SEGMENT_MSH = re.compile(br'[\r\n]MSH')
+
+
+def iter_messages(data, start=0, end=None):
+    """Yield ``(offset, message)`` for each message in ``data``, a bytestring
+    or :py:class:`mmap.mmap`, whose first byte is in ``data[start:end]``.
+    MLLP framed data is split on its frames, other data on its MSH segments,
+    with ``\\n`` or ``\\r\\n`` line endings converted to ``\\r`` and batch
+    header and trailer segments dropped.
+    """
+    if end is None:
+        end = len(data)
+    if _FRAMED.match(data):
+        return _iter_framed(data, start, end)
+    return _iter_segmented(data, start, end)
+
+
+def _iter_framed(data, start, end):
+    terminator = framing.END_BLOCK + framing.CARRIAGE_RETURN
+    offset = data.find(framing.START_BLOCK, start, end)
+    while offset != -1:
+        stop = data.find(terminator, offset + 1)
+        if stop == -1:
+            log.msg('Discarding unterminated frame at offset {0}'.format(offset))
+            return
+        yield offset, data[offset + 1:stop]
+        offset = data.find(framing.START_BLOCK, stop + len(terminator), end)
+
+
+def _msh_offsets(data, start):
+    if start == 0 and data[:3] == b'MSH':
+        yield 0
+    for match in _SEGMENT_MSH.finditer(data, max(start - 1, 0)):
+        yield match.start() + 1
+
+
+def _segments(raw):
+    segments = raw.replace(b'\r\n', b'\r').replace(b'\n', b'\r').split(b'\r')
+    segments = [segment.strip() for segment in segments]
+    segments = [s for s in segments if s and s[:3] not in BATCH_SEGMENTS]
+    if segments:
+        return b'\r'.join(segments) + b'\r'
+    return None
+
+
+def _iter_segmented(data, start, end):
+    previous = None
+    for offset in _msh_offsets(data, start):
+        if previous is not None:
+            message = _segments(data[previous:offset])
+            if message is not None:
+                yield previous, message
+        if offset >= end:
+            return
+        previous = offset
+    if previous is not None:
+        message = _segments(data[previous:])
+        if message is not None:
+            yield previous, message
+
+
+def split_messages(data):
+    """Split the contents of an HL7 file into messages, as
+    :py:func:`txHL7.ingest.iter_messages`
+
+    :rtype: list of bytes
+    """
+    return [message for offset, message in iter_messages(data)]
+
+
+def shard(paths, shards):
+    """Divide the files at ``paths`` into at most ``shards`` lists of
+    ``(path, start, end)`` byte ranges holding about the same number of bytes
+
+    :rtype: list of lists
+    """
+    sizes = [(path, os.path.getsize(path)) for path in paths]
+    total = sum(size for path, size in sizes)
+    share = max(-(-total // shards), 1)
+    result = [[]]
+    room = share
+    for path, size in sizes:
+        offset = 0
+        while offset < size:
+            if not room:
+                result.append([])
+                room = share
+            length = min(room, size - offset)
+            result[-1].append((path, offset, offset + length))
+            offset += length
+            room -= length
+    return [ranges for ranges in result if ranges]
+
+
+class IngestTotals(object):
+    """Counts shared by :py:class:`txHL7.ingest.Ingester` and
+    :py:class:`txHL7.ingest.ShardedIngester`:
+
+    * ``messages`` -- messages handled or failing to parse
+    * ``rejected`` -- responses whose MSA-1 was not AA or CA
+    * ``errors`` -- messages that failed to parse, or whose ``handleMessage`` failed
+    * ``bytes`` / ``total_bytes`` -- bytes of the input read so far, and in all
+    * ``elapsed`` -- seconds since ingestion started
+    """
+    def __init__(self):
+        self.messages = 0
+        self.rejected = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """Messages per second"""
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    def report(self, out):
+        """Write a summary of the results to the file ``out``"""
+        out.write('messages {0}, rejected {1}, errors {2}\n'.format(
+            self.messages, self.rejected, self.errors))
+        out.write('throughput {0:.1f} messages/s, {1:.1f} MB/s over {2:.3f}s\n'.format(
+            self.throughput,
+            self.bytes / self.elapsed / 1e6 if self.elapsed else 0.0,
+            self.elapsed))
+
+
+class Ingester(IngestTotals):
+    """Hands the messages of HL7 files to ``receiver``, with at most
+    ``concurrency`` calls to ``handleMessage`` outstanding. With
+    ``detect_charset``, messages are decoded with the character set named in
+    their MSH-18, as by :py:class:`txHL7.core.CharsetCodec`.
+
+    If ``progress`` is given, a line reporting the progress is written to
+    ``out`` every ``progress`` seconds. Besides the counts of
+    :py:class:`txHL7.ingest.IngestTotals`, ``histogram`` holds the time from
+    decoding each message until ``handleMessage`` finished, in microseconds.
+    """
+    def __init__(self, receiver, concurrency=100, detect_charset=False,
+                 progress=None, out=None, reactor=None, now=time.monotonic):
+        super(Ingester, self).__init__()
+        verifyObject(IHL7Receiver, receiver)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.receiver = receiver
+        self.codec = MLLPCodec.fromReceiver(receiver)
+        if detect_charset and not isinstance(self.codec, (BytesCodec, CharsetCodec)):
+            self.codec = CharsetCodec(default=self.codec)
+        self.concurrency = concurrency
+        self.progress_interval = progress
+        self.out = sys.stdout if out is None else out
+        self.reactor = reactor
+        self.now = now
+        self.histogram = Histogram()
+        self.outstanding = 0
+        self.start = None
+
+    def ingest(self, paths):
+        """Ingest the files at ``paths``, returning a Deferred firing with
+        this ingester once every message has been handled
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        return self.run([(path, 0, None) for path in paths])
+
+    @defer.inlineCallbacks
+    def run(self, ranges):
+        """Ingest the messages starting in each ``(path, start, end)`` range,
+        where ``end`` may be None for the end of the file
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        self.total_bytes += sum(
+            (os.path.getsize(path) if end is None else end) - start
+            for path, start, end in ranges
+        )
+        work = self._work(ranges)
+        cooperator = task.Cooperator(
+            scheduler=lambda call: self.reactor.callLater(0, call)
+        )
+        loop = None
+        self.start = self.now()
+        if self.progress_interval:
+            loop = task.LoopingCall(self.progress, self.out)
+            loop.clock = self.reactor
+            loop.start(self.progress_interval, now=False)
+        try:
+            # the workers share one iterator, each pausing on the Deferred of
+            # the message it is handling
+            yield defer.DeferredList(
+                [cooperator.coiterate(work) for i in range(self.concurrency)],
+                fireOnOneErrback=True, consumeErrors=True,
+            )
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+        finally:
+            if loop is not None and loop.running:
+                loop.stop()
+            cooperator.stop()
+            self.elapsed = self.now() - self.start
+        return self
+
+    def _work(self, ranges):
+        for path, offset, message in self._messages(ranges):
+            d = self.handle(message, path, offset)
+            if d is not None:
+                yield d
+
+    def _messages(self, ranges):
+        for path, start, end in ranges:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if end is None:
+                    end = size
+                if size == 0 or start >= end:
+                    continue
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            done = self.bytes
+            try:
+                advice = getattr(mmap, 'MADV_SEQUENTIAL', None)
+                if advice is not None and hasattr(data, 'madvise'):
+                    data.madvise(advice)
+                for offset, message in iter_messages(data, start, end):
+                    self.bytes = done + offset - start
+                    yield path, offset, message
+            finally:
+                data.close()
+            self.bytes = done + end - start
+
+    def handle(self, raw_message, path=None, offset=None):
+        """Decode, parse and handle the message ``raw_message``, returning a
+        Deferred firing once it has been handled, or None if it could not be
+        parsed
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        self.messages += 1
+        start = self.now()
+        try:
+            codec = self.codec.forMessage(raw_message)
+            container = self.receiver.parseMessage(codec.decode(raw_message))
+        except Exception:
+            self.errors += 1
+            log.err(None, 'Unable to parse the message at {0}:{1}'.format(path, offset))
+            return None
+        self.outstanding += 1
+        d = defer.maybeDeferred(self.receiver.handleMessage, container)
+        d.addErrback(self._failed, container)
+        d.addCallback(self._handled, start)
+        return d
+
+    def _failed(self, failure, container):
+        self.errors += 1
+        log.err(failure)
+        return container.err(failure)
+
+    def _handled(self, response, start):
+        self.outstanding -= 1
+        self.histogram.record((self.now() - start) * 1e6)
+        if response is not None and ack_code(response) not in (b'AA', b'CA'):
+            self.rejected += 1
+
+    def progress(self, out):
+        """Write a line reporting the progress to the file ``out``"""
+        elapsed = self.now() - self.start
+        out.write('{0:.1f}% of {1} bytes, {2} messages, {3:.1f} messages/s\n'.format(
+            100.0 * self.bytes / self.total_bytes if self.total_bytes else 100.0,
+            self.total_bytes, self.messages,
+            self.messages / elapsed if elapsed else 0.0,
+        ))
+        out.flush()
+
+    def report(self, out):
+        super(Ingester, self).report(out)
+        out.write('handle ms: {0}\n'.format(self.histogram.summaryLine()))
+
+    def result(self):
+        """Return the line a worker process reports its totals with
+
+        :rtype: str
+        """
+        return '{0} messages={1} rejected={2} errors={3} bytes={4}'.format(
+            RESULT, self.messages, self.rejected, self.errors, self.bytes)
+
+
+def ack_code(response):
+    """Return MSA-1 of the ``response`` returned by ``handleMessage``, which
+    may be text, bytes or a :py:class:`txHL7.framing.FramedMessage`
+
+    :rtype: bytes
+    """
+    if isinstance(response, framing.FramedMessage):
+        response = response[1:-2]
+    elif not isinstance(response, bytes):
+        response = response.encode('utf-8')
+    try:
+        return HL7MessageView(response).field(b'MSA', 1)
+    except KeyError:
+        return None
+
+
+class ShardProcessProtocol(protocol.ProcessProtocol):
+    """Relays the output of a :py:class:`txHL7.ingest.ShardedIngester` worker
+    line by line and reports its exit
+    """
+    def __init__(self, ingester, number):
+        self.ingester = ingester
+        self.number = number
+        self.ended = defer.Deferred()
+        self._buffers = {1: b'', 2: b''}
+
+    def childDataReceived(self, fd, data):
+        lines = (self._buffers.get(fd, b'') + data).split(b'\n')
+        self._buffers[fd] = lines.pop()
+        for line in lines:
+            self.ingester.lineReceived(self, fd, line.rstrip(b'\r').decode('utf-8', 'replace'))
+
+    def processEnded(self, reason):
+        for fd, line in sorted(self._buffers.items()):
+            if line:
+                self.ingester.lineReceived(self, fd, line.decode('utf-8', 'replace'))
+        self.ingester.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class ShardedIngester(IngestTotals):
+    """Ingests the files at ``paths`` with ``workers`` processes, each
+    ingesting one :py:func:`txHL7.ingest.shard` of the files, started as
+    ``python -m txHL7.ingest`` with the arguments ``args`` (such as
+    ``--receiver``). Their output is written to ``out`` and ``err``, and
+    their totals added up. ``failed`` counts workers that exited with an error.
+    """
+    def __init__(self, paths, args, workers, out=None, err=None, reactor=None,
+                 now=time.monotonic):
+        super(ShardedIngester, self).__init__()
+        if reactor is None:
+            from twisted.internet import reactor
+        self.paths = list(paths)
+        self.args = list(args)
+        self.workers = workers
+        self.out = sys.stdout if out is None else out
+        self.err = sys.stderr if err is None else err
+        self.reactor = reactor
+        self.now = now
+        self.failed = 0
+        self.processes = []
+
+    @defer.inlineCallbacks
+    def run(self):
+        """Start the workers, firing with this ingester once they have all
+        exited
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        from txHL7.workers import worker_environment
+
+        shards = shard(self.paths, self.workers)
+        self.total_bytes = sum(end - start for ranges in shards for path, start, end in ranges)
+        start = self.now()
+        for number, ranges in enumerate(shards):
+            args = [sys.executable, '-m', 'txHL7.ingest'] + self.args
+            for path, first, last in ranges:
+                args += ['--shard', '{0}:{1}:{2}'.format(first, last, path)]
+            process = ShardProcessProtocol(self, number)
+            self.processes.append(process)
+            self.reactor.spawnProcess(
+                process, sys.executable, args, env=worker_environment(),
+                childFDs={0: 'w', 1: 'r', 2: 'r'},
+            )
+        yield defer.DeferredList([process.ended for process in self.processes])
+        self.elapsed = self.now() - start
+        return self
+
+    def lineReceived(self, process, fd, line):
+        if fd == 1 and line.startswith(RESULT + ' '):
+            for item in line.split()[1:]:
+                name, _, value = item.partition('=')
+                setattr(self, name, getattr(self, name) + int(value))
+            return
+        out = self.out if fd == 1 else self.err
+        out.write('[worker {0}] {1}\n'.format(process.number, line))
+        out.flush()
+
+    def workerEnded(self, process, reason):
+        if reason.value.exitCode:
+            self.failed += 1
+            self.err.write('[worker {0}] exited with status {1}\n'.format(
+                process.number, reason.value.exitCode))
+
+    def report(self, out):
+        out.write('{0} workers, {1} failed\n'.format(len(self.processes), self.failed))
+        super(ShardedIngester, self).report(out)
+
+
+class Options(usage.Options):
+    synopsis = '[options] file [file ...]'
+    optParameters = [
+        ['receiver', 'r', 'txHL7.receiver.LoggingReceiver', 'A txHL7.receiver.IHL7Receiver subclass to handle messages.'],
+        ['concurrency', 'c', 100, 'Maximum messages handled concurrently (per worker).', int],
+        ['workers', 'w', None, 'Divide the files between this many worker processes.', int],
+        ['progress', 'p', None, 'Report the progress every this many seconds.', float],
+    ]
+
+    optFlags = [
+        ['detect-charset', None, 'Decode each message with the character set named in its MSH-18.'],
+    ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['shards'] = []
+
+    def opt_shard(self, spec):
+        """Ingest only the messages starting in a byte range of a file,
+        START:END:PATH. May be repeated; used by worker processes.
+        """
+        start, _, rest = spec.partition(':')
+        end, _, path = rest.partition(':')
+        try:
+            self['shards'].append((path, int(start), int(end)))
+        except ValueError:
+            raise usage.UsageError('--shard must be START:END:PATH, not {0!r}'.format(spec))
+
+    def parseArgs(self, *files):
+        if not files and not self['shards']:
+            raise usage.UsageError('At least one file is required')
+        self['files'] = files
+
+    def postOptions(self):
+        if self['workers'] is not None and self['workers'] < 1:
+            raise usage.UsageError('--workers must be at least 1')
+        if self['concurrency'] < 1:
+            raise usage.UsageError('--concurrency must be at least 1')
+
+    def workerArgs(self):
+        """The arguments worker processes are started with, besides their shards"""
+        args = ['--receiver', self['receiver'], '--concurrency', str(self['concurrency'])]
+        if self['progress']:
+            args += ['--progress', str(self['progress'])]
+        if self['detect-charset']:
+            args.append('--detect-charset')
+        return args
+
+
+def main(argv=None):
+    """Command line entry point"""
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        sys.exit('{0}\n{1}'.format(options, e))
+
+    @defer.inlineCallbacks
+    def run(reactor):
+        log.startLogging(sys.stderr, setStdout=False)
+        if options['workers'] and not options['shards']:
+            ingester = ShardedIngester(
+                options['files'], options.workerArgs(), options['workers'],
+                reactor=reactor,
+            )
+            yield ingester.run()
+            ingester.report(sys.stdout)
+            if ingester.failed:
+                raise SystemExit(1)
+            return
+        ingester = Ingester(
+            reflect.namedClass(options['receiver'])(),
+            concurrency=options['concurrency'],
+            detect_charset=options['detect-charset'],
+            progress=options['progress'], reactor=reactor,
+        )
+        if options['shards']:
+            yield ingester.run(options['shards'])
+        else:
+            yield ingester.ingest(options['files'])
+        ingester.report(sys.stdout)
+        if options['shards']:
+            sys.stdout.write(ingester.result() + '\n')
+
+    task.react(run)
+
+
+if __name__ == '__main__':
+    main()
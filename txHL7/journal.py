@@ -0,0 +1,465 @@
+"""Durable store-and-forward of received messages.
+
+:py:class:`txHL7.journal.JournalingReceiver` wraps an
+:py:class:`txHL7.receiver.IHL7Receiver`. Rather than waiting for the wrapped
+receiver to handle a message, it appends the message to a
+:py:class:`txHL7.journal.Journal` on local disk and ACKs it as soon as the
+record is durable. A :py:class:`txHL7.journal.JournalConsumer` delivers the
+journaled messages to the wrapped receiver in order, recording its progress
+in a checkpoint, so after a crash delivery resumes from the last checkpoint.
+
+Records are made durable by group commit: while one ``fsync`` runs in a
+thread, messages from every connection are appended behind it and are all
+covered by the next ``fsync``. The ACK latency is bounded by about two
+``fsync`` calls, however many messages arrive and however slow the receiver.
+
+Delivery is at least once: messages handled after the last checkpoint are
+delivered again after a restart, so the wrapped receiver should tolerate
+duplicates.
+"""
+import os
+import struct
+import zlib
+
+from twisted.internet import defer, task, threads
+from twisted.python import failure, log
+from zope.interface import implementer
+from zope.interface.verify import verifyObject
+
+from txHL7.core import MLLPCodec
+from txHL7.receiver import IHL7Receiver
+
+SEGMENT_SUFFIX = '.log'
+CHECKPOINT = 'checkpoint'
+
+
+class JournalError(Exception):
+    """A journal segment is corrupt"""
+
+
+class SegmentLog(object):
+    """Append-only log of records, split into segment files of roughly
+    ``segment_size`` bytes named after the sequence number of their first
+    record.
+
+    Each record is a header of sequence number, length and CRC-32, followed
+    by the payload. When opened, a torn record at the end of the last segment,
+    left by a crash during a write, is truncated.
+    """
+    header = struct.Struct('>QII')
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # first sequence number of each segment, in order
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        # files written since the last sync, and whether a segment was created
+        self._unsynced = []
+        self._created = False
+        if self.segments:
+            self._recover()
+        else:
+            self.next_seq = 1
+            self._open(1)
+
+    def path(self, first_seq):
+        return os.path.join(self.directory, '{0:020d}{1}'.format(first_seq, SEGMENT_SUFFIX))
+
+    def _recover(self):
+        first_seq = self.segments[-1]
+        path = self.path(first_seq)
+        self.next_seq = first_seq
+        end = 0
+        with open(path, 'rb') as f:
+            for seq, payload, end in self.scan(f):
+                self.next_seq = seq + 1
+        if end < os.path.getsize(path):
+            log.msg('Truncating torn journal record in {0} at {1}'.format(path, end))
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+        self._file = open(path, 'ab', buffering=0)
+        self._size = end
+
+    def scan(self, f, strict=False):
+        """Yield ``(seq, payload, end offset)`` for the records of the segment
+        file ``f`` from its current position, stopping at a torn record, or
+        raising :py:class:`txHL7.journal.JournalError` if ``strict``.
+        """
+        header = self.header
+        while True:
+            start = f.tell()
+            data = f.read(header.size)
+            if not data:
+                return
+            if len(data) == header.size:
+                seq, length, crc = header.unpack(data)
+                payload = f.read(length)
+                if len(payload) == length and zlib.crc32(payload) & 0xffffffff == crc:
+                    yield seq, payload, f.tell()
+                    continue
+            if strict:
+                raise JournalError('Corrupt record in {0} at {1}'.format(f.name, start))
+            return
+
+    def _open(self, first_seq):
+        self.segments.append(first_seq)
+        self._created = True
+        self._file = open(self.path(first_seq), 'wb', buffering=0)
+        self._size = 0
+
+    def append(self, payload):
+        """Write ``payload`` to the current segment, not yet durably,
+        returning its sequence number
+
+        :rtype: int
+        """
+        if self._size >= self.segment_size:
+            # keep the full segment open until the next sync covers it
+            self._unsynced.append(self._file)
+            self._open(self.next_seq)
+        seq = self.next_seq
+        self.next_seq += 1
+        record = self.header.pack(seq, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        self._file.write(record)
+        self._size += len(record)
+        return seq
+
+    def syncTargets(self):
+        """Return the files whose appended records the next :py:meth:`sync`
+        must make durable. Called on the thread appending.
+        """
+        targets = (self._unsynced + [self._file], self._created)
+        self._unsynced = []
+        self._created = False
+        return targets
+
+    def sync(self, targets):
+        """``fsync`` the files from :py:meth:`syncTargets`, which may be done
+        in another thread while appends continue
+        """
+        files, created = targets
+        for f in files:
+            os.fsync(f.fileno())
+        if created:
+            # make the new segment's directory entry durable too
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for f in files[:-1]:
+            f.close()
+
+    def removeBefore(self, seq):
+        """Delete the segments holding only records up to ``seq``"""
+        while len(self.segments) > 1 and self.segments[1] <= seq + 1:
+            os.remove(self.path(self.segments.pop(0)))
+
+    def close(self):
+        self._file.close()
+
+
+class SegmentReader(object):
+    """Reads the records of a :py:class:`txHL7.journal.SegmentLog` in order,
+    starting after sequence number ``after``.
+    """
+    def __init__(self, segment_log, after=0):
+        self.log = segment_log
+        self.position = after
+        first = [s for s in segment_log.segments if s <= after + 1]
+        self._segment = first[-1] if first else segment_log.segments[0]
+        self._file = open(segment_log.path(self._segment), 'rb')
+
+    def read(self, upto):
+        """Return the ``(seq, payload)`` records after the last one read, up
+        to and including sequence number ``upto``
+
+        :rtype: list
+        """
+        records = []
+        while self.position < upto:
+            offset = self._file.tell()
+            for seq, payload, end in self.log.scan(self._file, strict=True):
+                if seq > upto:
+                    self._file.seek(offset)
+                    return records
+                offset = end
+                if seq > self.position:
+                    self.position = seq
+                    records.append((seq, payload))
+                    if seq == upto:
+                        return records
+            later = [s for s in self.log.segments if s > self._segment]
+            if not later:
+                break
+            self._file.close()
+            self._segment = later[0]
+            self._file = open(self.log.path(self._segment), 'rb')
+        return records
+
+    def close(self):
+        self._file.close()
+
+
+class Journal(object):
+    """:py:class:`txHL7.journal.SegmentLog` with group commit and a
+    checkpoint of the records delivered.
+
+    ``fsync`` runs in the reactor's thread pool, one at a time; the records
+    appended meanwhile wait for the next one. Statistics: ``commits``, the
+    number of ``fsync`` rounds, and ``records``, the records they covered.
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.directory = directory
+        self.log = SegmentLog(directory, segment_size)
+        # highest sequence number known to be durable
+        self.durable = self.log.next_seq - 1
+        self.commits = 0
+        self.records = 0
+        self.listeners = []
+        self._waiting = []
+        self._syncing = False
+
+    def append(self, payload):
+        """Append ``payload``, returning a Deferred that fires with its
+        sequence number once it is durable
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        d = defer.Deferred()
+        self._waiting.append((self.log.append(payload), d))
+        self._commit()
+        return d
+
+    def _commit(self):
+        if self._syncing or not self._waiting:
+            return
+        self._syncing = True
+        batch, self._waiting = self._waiting, []
+        d = threads.deferToThreadPool(
+            self.reactor, self.reactor.getThreadPool(),
+            self.log.sync, self.log.syncTargets(),
+        )
+        d.addBoth(self._committed, batch)
+
+    def _committed(self, result, batch):
+        self._syncing = False
+        self.commits += 1
+        self.records += len(batch)
+        if isinstance(result, failure.Failure):
+            log.err(result, 'Unable to sync journal')
+            for seq, d in batch:
+                d.errback(result)
+        else:
+            self.durable = batch[-1][0]
+            for seq, d in batch:
+                d.callback(seq)
+            for listener in self.listeners:
+                listener()
+        self._commit()
+
+    def reader(self, after):
+        return SegmentReader(self.log, after)
+
+    def readCheckpoint(self):
+        """Return the sequence number of the last delivered record
+
+        :rtype: int
+        """
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def writeCheckpoint(self, seq):
+        """Durably record that the records up to ``seq`` have been delivered,
+        and delete the segments holding only delivered records. Blocking, see
+        :py:meth:`checkpoint`.
+        """
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    def checkpoint(self, seq):
+        """Call :py:meth:`writeCheckpoint` in a thread
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        d = threads.deferToThreadPool(
+            self.reactor, self.reactor.getThreadPool(), self.writeCheckpoint, seq
+        )
+        d.addCallback(lambda ignored: self.log.removeBefore(seq))
+        return d
+
+    def close(self):
+        self.log.close()
+
+
+class JournalConsumer(object):
+    """Delivers the records of a :py:class:`txHL7.journal.Journal` to
+    ``receiver`` one at a time, in order, after decoding them with ``codec``.
+
+    A message whose ``parseMessage`` or ``handleMessage`` fails is retried
+    after ``retry_delay`` seconds, doubling up to ``max_retry_delay``. The
+    checkpoint is written after ``checkpoint_every`` messages, and whenever
+    the consumer catches up.
+    """
+    def __init__(self, journal, receiver, codec, retry_delay=1.0,
+                 max_retry_delay=60.0, checkpoint_every=100):
+        self.journal = journal
+        self.receiver = receiver
+        self.codec = codec
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.checkpoint_every = checkpoint_every
+        self.position = 0
+        self.delivered = 0
+        self.retries = 0
+        self.running = False
+        self._wake = None
+        self._sleep = None
+        self._done = None
+
+    @property
+    def lag(self):
+        """Durable records not yet delivered"""
+        return self.journal.durable - self.position
+
+    def start(self):
+        self.running = True
+        self.position = self.journal.readCheckpoint()
+        self.reader = self.journal.reader(self.position)
+        self.journal.listeners.append(self.wake)
+        self._done = self._run()
+        self._done.addErrback(log.err, 'Journal consumer failed')
+
+    def stop(self):
+        """Stop after the current delivery, writing the checkpoint
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        self.running = False
+        self.wake()
+        if self._sleep is not None:
+            self._sleep.cancel()
+        if self.wake in self.journal.listeners:
+            self.journal.listeners.remove(self.wake)
+        return self._done
+
+    def wake(self):
+        if self._wake is not None:
+            d, self._wake = self._wake, None
+            d.callback(None)
+
+    @defer.inlineCallbacks
+    def _run(self):
+        checkpointed = self.position
+        try:
+            while self.running:
+                records = self.reader.read(self.journal.durable)
+                if not records:
+                    if checkpointed != self.position:
+                        yield self.journal.checkpoint(self.position)
+                        checkpointed = self.position
+                    if self.running and self.journal.durable == self.position:
+                        self._wake = defer.Deferred()
+                        yield self._wake
+                    continue
+                for seq, payload in records:
+                    delivered = yield self.deliver(payload)
+                    if not delivered:
+                        return
+                    self.position = seq
+                    self.delivered += 1
+                    if self.position - checkpointed >= self.checkpoint_every:
+                        yield self.journal.checkpoint(self.position)
+                        checkpointed = self.position
+        finally:
+            if checkpointed != self.position:
+                yield self.journal.checkpoint(self.position)
+            self.reader.close()
+
+    @defer.inlineCallbacks
+    def deliver(self, payload):
+        """Deliver one record, retrying until it succeeds or the consumer is
+        stopped. Fires with True if it was delivered.
+        """
+        delay = self.retry_delay
+        while True:
+            try:
+                container = self.receiver.parseMessage(self.codec.decode(payload))
+                yield defer.maybeDeferred(self.receiver.handleMessage, container)
+                return True
+            except Exception:
+                log.err(None, 'Delivering journaled message failed, retrying in {0}s'.format(delay))
+            if not self.running:
+                return False
+            self.retries += 1
+            self._sleep = task.deferLater(self.journal.reactor, delay, lambda: None)
+            try:
+                yield self._sleep
+            except defer.CancelledError:
+                return False
+            finally:
+                self._sleep = None
+            delay = min(delay * 2, self.max_retry_delay)
+
+
+@implementer(IHL7Receiver)
+class JournalingReceiver(object):
+    """Journals messages for ``receiver`` in ``directory``, ACKing them once
+    durable, and delivers them with a :py:class:`txHL7.journal.JournalConsumer`
+    between :py:meth:`start` and :py:meth:`stop`.
+
+    Messages are parsed with ``receiver.parseMessage`` to build their ACK,
+    and again when delivered; a receiver with a cheap ``parseMessage``, such
+    as one using :py:class:`txHL7.receiver.LazyHL7MessageContainer`, keeps
+    the ingest path fast. Messages are journaled re-encoded with the
+    receiver's codec.
+    """
+    def __init__(self, receiver, directory, segment_size=64 * 1024 * 1024,
+                 reactor=None, **consumer_kwargs):
+        verifyObject(IHL7Receiver, receiver)
+        self.receiver = receiver
+        self.codec = MLLPCodec.fromReceiver(receiver)
+        self.journal = Journal(directory, segment_size, reactor=reactor)
+        self.consumer = JournalConsumer(self.journal, receiver, self.codec, **consumer_kwargs)
+
+    def start(self):
+        self.consumer.start()
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """Stop delivering and close the journal
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        yield self.consumer.stop()
+        self.journal.close()
+
+    def parseMessage(self, raw_message):
+        return self.receiver.parseMessage(raw_message)
+
+    def handleMessage(self, message_container):
+        d = self.journal.append(self.codec.encode(message_container.raw_message))
+        d.addCallback(lambda seq: message_container.ack())
+        return d
+
+    def getCodec(self):
+        return self.receiver.getCodec()
+
+    def getTimeout(self):
+        return self.receiver.getTimeout()
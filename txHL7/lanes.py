@@ -0,0 +1,206 @@
+"""Concurrent handling of messages, in order per patient.
+
+Messages about one patient must be handled in the order they were sent, so a
+feed is usually handled one message at a time (``--max-in-flight 1``), and a
+busy feed is limited to what one message at a time can achieve, however many
+patients it carries.
+
+:py:class:`txHL7.lanes.KeyedReceiver` instead reads an ordering key from each
+raw message, by default the patient identifier in PID-3, and hands messages
+to the wrapped receiver on up to ``lanes`` lanes at once. Messages with the
+same key, from any connection, are handled one at a time in the order they
+arrived; messages with different keys run concurrently::
+
+    receiver = KeyedReceiver(DatabaseReceiver(), lanes=16)
+    factory = MLLPFactory(receiver)
+
+Throughput then grows with the number of patients being sent rather than the
+number of connections. ``key_skew`` and :py:meth:`KeyedReceiver.hotKeys`
+show when a few busy keys hold it back.
+"""
+import collections
+import heapq
+import time
+
+from twisted.internet import defer
+from twisted.python import failure, log
+from zope.interface import implementer
+from zope.interface.verify import verifyObject
+
+from txHL7.histogram import BusyTimer
+from txHL7.receiver import IHL7Receiver
+from txHL7.view import SegmentView
+
+
+def patient_key(raw_message):
+    """Return the ID number of the first patient identifier in PID-3 of
+    ``raw_message``, or None if it has no ``PID`` segment or the field is
+    empty. Only the ``PID`` segment is split into fields.
+
+    Identifiers from different assigning authorities may share an ID number;
+    their messages are then ordered together, which is safe if slower.
+    """
+    if isinstance(raw_message, bytes):
+        segment_separator, marker = b'\r', b'\rPID'
+    else:
+        segment_separator, marker = u'\r', u'\rPID'
+    separator = raw_message[3:4]
+    start = raw_message.find(marker + separator)
+    if start == -1:
+        return None
+    start += 1
+    end = raw_message.find(segment_separator, start)
+    if end == -1:
+        end = len(raw_message)
+    return SegmentView(raw_message, start, end, separator).component(3, 1) or None
+
+
+@implementer(IHL7Receiver)
+class KeyedReceiver(object):
+    """Hands messages to ``receiver`` on up to ``lanes`` lanes at once, one
+    message per ``key`` at a time. ``key`` is a callable taking the raw
+    message, as decoded by the receiver's codec, and returning a hashable
+    ordering key; messages for which it returns None are ordered together.
+    ``parseMessage``, ``getCodec`` and ``getTimeout`` are the receiver's.
+
+    Once every lane is busy, waiting keys take the next free lane oldest
+    first, and a key with more messages waiting goes to the back of the
+    line, so a busy key does not hold back the others. Statistics:
+
+    * ``busy`` -- lanes handling a message
+    * ``waiting`` -- messages waiting for their key or a lane
+    * ``keys`` -- keys with a message running or waiting
+    * ``received`` / ``handled`` -- messages received and handled
+    * ``key_waits`` -- messages that waited behind an earlier message with
+      the same key
+    * ``lane_waits`` -- messages that waited for a free lane
+    * ``occupancy`` -- the fraction of lane time spent handling messages
+      since the receiver was created
+    * ``key_skew`` -- the fraction of messages that waited for their key
+    """
+    def __init__(self, receiver, lanes=8, key=patient_key, now=time.monotonic):
+        verifyObject(IHL7Receiver, receiver)
+        if lanes < 1:
+            raise ValueError('At least one lane is required')
+        self.receiver = receiver
+        self.lanes = lanes
+        self.key = key
+        self.received = 0
+        self.handled = 0
+        self.key_waits = 0
+        self.lane_waits = 0
+        self._timer = BusyTimer(lanes, now)
+        self._timer.start()
+        # key to its waiting (message_container, Deferred) pairs; a key is
+        # present while it has a message running or waiting
+        self._keys = {}
+        # keys with messages waiting and none running, oldest first
+        self._ready = collections.deque()
+        self._waiting = 0
+        # whether _fill is running, so that messages completing
+        # synchronously are dispatched by its loop instead of recursively
+        self._filling = False
+
+    @property
+    def busy(self):
+        return self._timer.running
+
+    @property
+    def waiting(self):
+        return self._waiting
+
+    @property
+    def keys(self):
+        return len(self._keys)
+
+    @property
+    def occupancy(self):
+        return self._timer.utilization
+
+    @property
+    def key_skew(self):
+        return self.key_waits / float(self.received) if self.received else 0.0
+
+    def hotKeys(self, count=10):
+        """The ``count`` keys with the most messages waiting, as a list of
+        ``(key, waiting)`` tuples
+
+        :rtype: list of tuples
+        """
+        return heapq.nlargest(
+            count, ((key, len(waiting)) for key, waiting in self._keys.items() if waiting),
+            key=lambda item: item[1],
+        )
+
+    def parseMessage(self, raw_message):
+        return self.receiver.parseMessage(raw_message)
+
+    def handleMessage(self, message_container):
+        self.received += 1
+        key = self.key(message_container.raw_message)
+        waiting = self._keys.get(key)
+        if waiting is None:
+            waiting = self._keys[key] = collections.deque()
+            if self._timer.running < self.lanes:
+                return self._dispatch(key, message_container)
+            self.lane_waits += 1
+            self._ready.append(key)
+        else:
+            self.key_waits += 1
+        d = defer.Deferred()
+        waiting.append((message_container, d))
+        self._waiting += 1
+        return d
+
+    def _dispatch(self, key, message_container):
+        start = self._timer.begin()
+        d = defer.maybeDeferred(self.receiver.handleMessage, message_container)
+        d.addBoth(self._done, key, start)
+        return d
+
+    def _done(self, result, key, start):
+        self._timer.end(start)
+        self.handled += 1
+        if self._keys[key]:
+            self._ready.append(key)
+        else:
+            del self._keys[key]
+        self._fill()
+        return result
+
+    def _fill(self):
+        if self._filling:
+            return
+        self._filling = True
+        try:
+            while self._ready and self._timer.running < self.lanes:
+                key = self._ready.popleft()
+                waiting = self._keys[key]
+                # skip messages whose Deferred was cancelled while they waited
+                while waiting and waiting[0][1].called:
+                    waiting.popleft()
+                    self._waiting -= 1
+                if not waiting:
+                    del self._keys[key]
+                    continue
+                message_container, d = waiting.popleft()
+                self._waiting -= 1
+                self._dispatch(key, message_container).addBoth(self._deliver, d)
+        finally:
+            self._filling = False
+
+    def _deliver(self, result, d):
+        if d.called:
+            # cancelled while running
+            if isinstance(result, failure.Failure):
+                log.err(result, 'Cancelled message failed')
+        elif isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def getCodec(self):
+        return self.receiver.getCodec()
+
+    def getTimeout(self):
+        return self.receiver.getTimeout()
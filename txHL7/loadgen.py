@@ -0,0 +1,310 @@
+"""MLLP load generator.
+
+Replays a corpus of HL7 messages against any MLLP server, such as one run with
+``twistd mllp``, over many concurrent connections and reports throughput and
+the ACK latency distribution::
+
+    python -m txHL7.loadgen --endpoint tcp:host=localhost:port=2575 \\
+        --connections 1000 --rate 5000 --duration 60 corpus/*.hl7
+
+It runs in one of two modes:
+
+* closed loop (the default) -- each connection keeps ``window`` messages
+  outstanding, sending the next as soon as an ACK arrives. This finds the
+  maximum throughput at a fixed concurrency, but as the generator slows down
+  along with the server, its latencies understate what senders would see.
+* open loop (``--rate``) -- messages are sent on a fixed schedule, regardless
+  of how many are outstanding, and latency is measured from the time each
+  message was scheduled to be sent. Stalls in the server, or in the generator
+  itself, are included in the latencies instead of silently lowering the
+  arrival rate (coordinated omission).
+
+Latencies are recorded in microseconds in a
+:py:class:`txHL7.histogram.Histogram`.
+"""
+import collections
+import sys
+import time
+
+from twisted.internet import defer, endpoints, protocol, task
+from twisted.python import log, usage
+
+from txHL7 import framing
+from txHL7.histogram import Histogram
+from txHL7.ingest import split_messages
+from txHL7.view import HL7MessageView
+
+
+def load_corpus(paths):
+    """Read the messages in the HL7 files at ``paths``, split by
+    :py:func:`txHL7.ingest.split_messages`
+
+    :rtype: list of bytes
+    """
+    messages = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            messages.extend(split_messages(f.read()))
+    return messages
+
+
+class LoadProtocol(protocol.Protocol):
+    """One connection of a :py:class:`txHL7.loadgen.LoadGenerator`.
+
+    MLLP servers answer in order, so each ACK belongs to the oldest
+    outstanding message.
+    """
+    def connectionMade(self):
+        self.scanner = framing.MLLPFrameScanner()
+        # the intended send times of outstanding messages
+        self.outstanding = collections.deque()
+
+    def send(self, message, intended):
+        self.outstanding.append(intended)
+        self.transport.write(message)
+
+    def dataReceived(self, data):
+        generator = self.factory.generator
+        for frame in self.scanner.feed(data):
+            if not self.outstanding:
+                log.msg('Discarding unexpected MLLP response: {0!r}'.format(frame))
+                continue
+            generator.ackReceived(self, frame, self.outstanding.popleft())
+
+    def connectionLost(self, reason):
+        self.factory.generator.connectionLost(self, reason)
+
+
+class LoadFactory(protocol.Factory):
+    protocol = LoadProtocol
+
+    def __init__(self, generator):
+        self.generator = generator
+
+
+class LoadGenerator(object):
+    """Sends the messages of ``corpus`` (bytestrings, without MLLP framing)
+    round robin over ``connections`` connections to ``endpoint_string``.
+
+    If ``rate`` is given, messages are sent open loop at that many per
+    second, otherwise closed loop with up to ``window`` outstanding per
+    connection. Sending stops after ``count`` messages or ``duration``
+    seconds, whichever comes first, and :py:meth:`run` fires once the
+    outstanding messages have been answered.
+
+    Results:
+
+    * ``histogram`` -- ACK latencies in microseconds
+    * ``acked`` / ``rejected`` -- ACKs received, and of those, ACKs whose
+      MSA-1 was not AA or CA
+    * ``failed`` -- messages outstanding on connections that were lost
+    * ``connect_errors`` -- connections that could not be established
+    * ``elapsed`` -- seconds from the first send to the last ACK
+    """
+    factory = LoadFactory
+    tick = 0.001
+
+    def __init__(self, endpoint_string, corpus, connections=1, rate=None,
+                 window=1, count=None, duration=None, reactor=None,
+                 now=time.monotonic):
+        if reactor is None:
+            from twisted.internet import reactor
+        if not corpus:
+            raise ValueError('The corpus contains no messages')
+        if count is None and duration is None:
+            count = len(corpus)
+        self.reactor = reactor
+        self.endpoint_string = endpoint_string
+        self.corpus = [framing.frame(message) for message in corpus]
+        self.connections = connections
+        self.rate = rate
+        self.window = window
+        self.count = count
+        self.duration = duration
+        self.now = now
+
+        self.histogram = Histogram()
+        self.sent = 0
+        self.acked = 0
+        self.rejected = 0
+        self.failed = 0
+        self.connect_errors = 0
+        self.elapsed = 0.0
+        self.start = None
+        self.active = []
+        self._sending = False
+        self._done = None
+        self._loop = None
+
+    @property
+    def outstanding(self):
+        return sum(len(connection.outstanding) for connection in self.active)
+
+    @property
+    def throughput(self):
+        """ACKs per second"""
+        return self.acked / self.elapsed if self.elapsed else 0.0
+
+    @defer.inlineCallbacks
+    def run(self):
+        """Connect, send the messages and wait for their ACKs, firing with
+        this generator
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        endpoint = endpoints.clientFromString(self.reactor, self.endpoint_string)
+        factory = self.factory(self)
+        results = yield defer.DeferredList(
+            [endpoint.connect(factory) for i in range(self.connections)],
+            consumeErrors=True,
+        )
+        for success, result in results:
+            if success:
+                self.active.append(result)
+            else:
+                self.connect_errors += 1
+                log.msg('Unable to connect: {0}'.format(result.getErrorMessage()))
+        if not self.active:
+            raise IOError('Unable to connect to {0}'.format(self.endpoint_string))
+
+        self._done = defer.Deferred()
+        self._sending = True
+        self.start = self.now()
+        if self.rate:
+            self._loop = task.LoopingCall(self._schedule)
+            self._loop.clock = self.reactor
+            self._loop.start(self.tick)
+        else:
+            for connection in list(self.active):
+                self._fill(connection)
+        yield self._done
+        return self
+
+    def _more(self, offset):
+        # whether to send a message ``offset`` seconds after the start
+        if self.count is not None and self.sent >= self.count:
+            return False
+        if self.duration is not None and offset >= self.duration:
+            return False
+        return True
+
+    def _send(self, connection, intended):
+        message = self.corpus[self.sent % len(self.corpus)]
+        self.sent += 1
+        connection.send(message, intended)
+
+    def _fill(self, connection):
+        # closed loop: latency is measured from the actual send
+        while self._sending and len(connection.outstanding) < self.window:
+            now = self.now()
+            if not self._more(now - self.start):
+                self._stopSending()
+                break
+            self._send(connection, now)
+
+    def _schedule(self):
+        # open loop: send every message whose time has come, timed from when
+        # it should have been sent even if this call is late
+        now = self.now()
+        while self._sending and self.active:
+            offset = self.sent / float(self.rate)
+            if not self._more(offset):
+                self._stopSending()
+                break
+            if self.start + offset > now:
+                break
+            connection = self.active[self.sent % len(self.active)]
+            self._send(connection, self.start + offset)
+
+    def _stopSending(self):
+        self._sending = False
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._maybeFinish()
+
+    def ackReceived(self, connection, ack, intended):
+        now = self.now()
+        self.histogram.record((now - intended) * 1e6)
+        self.acked += 1
+        self.elapsed = now - self.start
+        try:
+            code = HL7MessageView(ack).field(b'MSA', 1)
+        except KeyError:
+            code = None
+        if code not in (b'AA', b'CA'):
+            self.rejected += 1
+        if self._sending and not self.rate:
+            self._fill(connection)
+        self._maybeFinish()
+
+    def connectionLost(self, connection, reason):
+        if connection in self.active:
+            self.active.remove(connection)
+            self.failed += len(connection.outstanding)
+            connection.outstanding.clear()
+        if self._sending and not self.active:
+            log.msg('All connections lost: {0}'.format(reason.getErrorMessage()))
+            self._stopSending()
+        self._maybeFinish()
+
+    def _maybeFinish(self):
+        if self._sending or self._done is None or self.outstanding:
+            return
+        done, self._done = self._done, None
+        for connection in self.active:
+            connection.transport.loseConnection()
+        done.callback(None)
+
+    def report(self, out):
+        """Write a summary of the results to the file ``out``"""
+        mode = 'open loop at {0:g}/s'.format(self.rate) if self.rate else \
+            'closed loop, window {0}'.format(self.window)
+        out.write('{0} connections, {1}\n'.format(self.connections, mode))
+        out.write('sent {0}, acked {1}, rejected {2}, failed {3}, connect errors {4}\n'.format(
+            self.sent, self.acked, self.rejected, self.failed, self.connect_errors))
+        out.write('throughput {0:.1f} messages/s over {1:.3f}s\n'.format(
+            self.throughput, self.elapsed))
+        out.write('latency ms: {0}\n'.format(self.histogram.summaryLine()))
+
+
+class Options(usage.Options):
+    synopsis = '[options] corpus-file [corpus-file ...]'
+    optParameters = [
+        ['endpoint', 'e', 'tcp:host=localhost:port=2575', 'The client endpoint to send to.'],
+        ['connections', 'c', 1, 'Number of concurrent connections.', int],
+        ['rate', 'r', None, 'Send this many messages per second (open loop) instead of keeping --window outstanding per connection (closed loop).', float],
+        ['window', 'w', 1, 'Outstanding messages per connection in closed loop mode.', int],
+        ['count', 'n', None, 'Stop after sending this many messages.', int],
+        ['duration', 'd', None, 'Stop sending after this many seconds.', float],
+    ]
+
+    def parseArgs(self, *corpus):
+        if not corpus:
+            raise usage.UsageError('At least one corpus file is required')
+        self['corpus'] = corpus
+
+
+def main(argv=None):
+    """Command line entry point"""
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        sys.exit('{0}\n{1}'.format(options, e))
+
+    @defer.inlineCallbacks
+    def run(reactor):
+        generator = LoadGenerator(
+            options['endpoint'], load_corpus(options['corpus']),
+            connections=options['connections'], rate=options['rate'],
+            window=options['window'], count=options['count'],
+            duration=options['duration'], reactor=reactor,
+        )
+        yield generator.run()
+        generator.report(sys.stdout)
+
+    task.react(run)
+
+
+if __name__ == '__main__':
+    main()
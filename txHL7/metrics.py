@@ -0,0 +1,132 @@
+"""Per-stage latency and throughput instrumentation.
+
+Passing a :py:class:`txHL7.metrics.Metrics` to
+:py:class:`txHL7.mllp.MLLPFactory` records how long each message spends in
+each stage of the server:
+
+* ``frame`` -- finding frames in received data, per read
+* ``decode`` -- decoding a frame with the receiver's codec
+* ``parse`` -- ``parseMessage``, or the round trip through the
+  :py:class:`txHL7.offload.ParsePool` for offloaded frames
+* ``handle`` -- ``handleMessage`` until its Deferred fires, including any
+  ACK built by the receiver
+* ``ack`` -- encoding and framing the response
+* ``write`` -- ``transport.write`` of the response
+
+along with counters of messages, bytes, NAKs, timeouts and connections, and
+gauges of open connections, buffered bytes and in-flight messages. Other
+components register their own counters and gauges. Without
+one, as by default, the server only pays for checking that ``metrics`` is
+None.
+
+:py:class:`txHL7.metrics.MetricsResource` serves the values in the
+Prometheus text format, as ``twistd mllp --metrics-endpoint tcp:9102`` does.
+"""
+import time
+
+from twisted.web import resource
+
+from txHL7.histogram import Histogram
+
+STAGES = ('frame', 'decode', 'parse', 'handle', 'ack', 'write')
+
+COUNTERS = (
+    ('messages', 'Messages received.'),
+    ('bytes_received', 'Bytes received.'),
+    ('bytes_sent', 'Bytes of responses written.'),
+    ('naks', 'Messages rejected because handleMessage failed.'),
+    ('timeouts', 'Connections closed for being idle.'),
+    ('connections', 'Connections accepted.'),
+)
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Metrics(object):
+    """Stage histograms, in microseconds, counters and gauges of a server.
+
+    Gauges, and the counters of other components, are callables registered
+    with :py:meth:`gauge` and :py:meth:`counter`, evaluated when the metrics
+    are rendered.
+    """
+    def __init__(self, clock=time.perf_counter, prefix='txhl7'):
+        self.clock = clock
+        self.prefix = prefix
+        self.stages = dict((stage, Histogram()) for stage in STAGES)
+        self.counters = dict((name, 0) for name, description in COUNTERS)
+        self.gauges = {}
+        self.counter_values = {}
+
+    def observe(self, stage, start):
+        """Record the time since ``start``, a value of ``clock``, for ``stage``"""
+        self.stages[stage].record((self.clock() - start) * 1e6)
+
+    def increment(self, name, value=1):
+        self.counters[name] += value
+
+    def gauge(self, name, description, value):
+        """Register the callable ``value`` as gauge ``name``"""
+        self.gauges[name] = (description, value)
+
+    def counter(self, name, description, value):
+        """Register the callable ``value``, which only ever increases, as
+        counter ``name``, rendered as ``name_total``
+        """
+        self.counter_values[name] = (description, value)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format
+
+        :rtype: str
+        """
+        prefix = self.prefix
+        lines = [
+            '# HELP {0}_stage_seconds Time spent in each stage of handling a message.'.format(prefix),
+            '# TYPE {0}_stage_seconds summary'.format(prefix),
+        ]
+        for stage in STAGES:
+            histogram = self.stages[stage]
+            for quantile in QUANTILES:
+                lines.append('{0}_stage_seconds{{stage="{1}",quantile="{2:g}"}} {3!r}'.format(
+                    prefix, stage, quantile, histogram.percentile(quantile * 100) / 1e6))
+            lines.append('{0}_stage_seconds_sum{{stage="{1}"}} {2!r}'.format(
+                prefix, stage, histogram.total / 1e6))
+            lines.append('{0}_stage_seconds_count{{stage="{1}"}} {2}'.format(
+                prefix, stage, histogram.count))
+        for name, description in COUNTERS:
+            lines.extend([
+                '# HELP {0}_{1}_total {2}'.format(prefix, name, description),
+                '# TYPE {0}_{1}_total counter'.format(prefix, name),
+                '{0}_{1}_total {2}'.format(prefix, name, self.counters[name]),
+            ])
+        for name in sorted(self.counter_values):
+            description, value = self.counter_values[name]
+            lines.extend([
+                '# HELP {0}_{1}_total {2}'.format(prefix, name, description),
+                '# TYPE {0}_{1}_total counter'.format(prefix, name),
+                '{0}_{1}_total {2}'.format(prefix, name, value()),
+            ])
+        for name in sorted(self.gauges):
+            description, value = self.gauges[name]
+            lines.extend([
+                '# HELP {0}_{1} {2}'.format(prefix, name, description),
+                '# TYPE {0}_{1} gauge'.format(prefix, name),
+                '{0}_{1} {2}'.format(prefix, name, value()),
+            ])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+    """Serves a :py:class:`txHL7.metrics.Metrics` to Prometheus, at any path
+    but those of the children added with ``putChild``
+    """
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def getChild(self, path, request):
+        return self
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.metrics.render().encode('utf-8')
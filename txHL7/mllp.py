@@ -1,113 +1,434 @@
-import sys
-
 from twisted.internet import defer, protocol
-from twisted.protocols.policies import TimeoutMixin
+from twisted.python import log
 from zope.interface.verify import verifyObject
-import six
 
-from txHL7.receiver import IHL7Receiver
+from txHL7 import framing
+from txHL7.batch import MessageBatcher
+from txHL7.core import BytesCodec, CharsetCodec, MLLPCodec, MLLPConnection
+from txHL7.idle import IdleTimer
+from txHL7.receiver import (
+    IHL7BatchReceiver, IHL7Receiver, IHL7StreamingReceiver
+)
+from txHL7.spool import SpooledFrame, SpooledMessage, SpoolingFrameScanner
 
 
-class MinimalLowerLayerProtocol(protocol.Protocol, TimeoutMixin):
+class MinimalLowerLayerProtocol(protocol.Protocol, MLLPConnection):
     """
     Minimal Lower-Layer Protocol (MLLP) takes the form:
 
         <VT>[HL7 Message]<FS><CR>
 
+    The framing, flow control and ACK ordering are implemented by
+    :py:class:`txHL7.core.MLLPConnection`, configured by the factory. Idle
+    connections are closed by the factory's :py:class:`txHL7.idle.IdleTimer`,
+    and its :py:class:`txHL7.admission.AdmissionControl`, if any, may hold
+    reading across all connections. Received frames are recorded by the
+    factory's :py:class:`txHL7.capture.CaptureWriter`, if any.
+
     References:
 
     .. [1] http://www.hl7standards.com/blog/2007/05/02/hl7-mlp-minimum-layer-protocol-defined/
     .. [2] http://www.hl7standards.com/blog/2007/02/01/ack-message-original-mode-acknowledgement/
     """
 
-    _buffer = b''
-    start_block = b'\x0b'  # <VT>, vertical tab
-    end_block = b'\x1c'  # <FS>, file separator
-    carriage_return = b'\x0d'  # <CR>, \r
+    @property
+    def codec(self):
+        return self.factory.codec
+
+    @property
+    def max_in_flight(self):
+        return self.factory.max_in_flight
+
+    idle = None
 
     def connectionMade(self):
-        if self.factory.timeout is not None:
-            self.setTimeout(self.factory.timeout)
+        factory = self.factory
+        self.metrics = factory.metrics
+        self.admission = factory.admission
+        self.tracer = factory.tracer
+        self.idle = factory.idle
+        self.capture = factory.capture
+        if self.capture is not None:
+            peer = self.transport.getPeer()
+            self.capture_id = self.capture.connectionOpened(
+                '{0}:{1}'.format(peer.host, peer.port) if hasattr(peer, 'port') else str(peer)
+            )
+        self.startConnection()
+        factory.connectionMade(self)
+        if self.idle is not None:
+            self.idle.add(self)
+
+    def connectionLost(self, reason):
+        if self.idle is not None:
+            self.idle.remove(self)
+        if self.capture is not None:
+            self.capture.connectionClosed(self.capture_id)
+        # drop the partial frame and the queued ones, deleting their spool
+        # files now rather than once they are garbage collected
+        self.scanner.reset()
+        for frame in self.queue:
+            if isinstance(frame, SpooledFrame):
+                frame.close()
+        self.queue = ()
+        self.queued_bytes = 0
+        self.factory.connectionLost(self)
+
+    def timeoutConnection(self):
+        """Called when no data has been received for the receiver's timeout"""
+        if self.metrics is not None:
+            self.metrics.increment('timeouts')
+        self.transport.loseConnection()
+
+    def buildScanner(self):
+        return self.factory.buildScanner()
 
     def dataReceived(self, data):
-        self.resetTimeout()
-
-        # success callback
-        def onSuccess(message):
-            self.writeMessage(message)
-
-        # try to find a complete message(s) in the combined the buffer and data
-        messages = (self._buffer + data).split(self.end_block)
-        # whatever is in the last chunk is an uncompleted message, so put back
-        # into the buffer
-        self._buffer = messages.pop(-1)
-
-        for raw_message in messages:
-            # strip the rest of the MLLP shell from the HL7 message
-            raw_message = raw_message.strip(self.start_block)
-
-            # only pass messages with data
-            if len(raw_message) > 0:
-                # convert into unicode, parseMessage expects decoded string
-                raw_message = self.factory.decode(raw_message)
-
-                message_container = self.factory.parseMessage(raw_message)
-
-                # error callback (defined here, since error depends on
-                # current message).  rejects the message
-                def onError(err):
-                    reject = message_container.err(err)
-                    self.writeMessage(reject)
-                    return err
-
-                # have the factory create a deferred and pass the message
-                # to the approriate IHL7Receiver instance
+        if self.idle is not None:
+            self.idle.touch(self)
+        self.framesReceived(data)
+
+    def frameTooLarge(self, err):
+        # without a complete MSH we cannot NAK, so drop the connection
+        log.err(err, 'Rejecting oversized MLLP frame')
+        self.transport.loseConnection()
+
+    def messagesDispatched(self):
+        self.factory.flushMessages()
+
+    def pauseReading(self):
+        self.transport.pauseProducing()
+
+    def resumeReading(self):
+        self.transport.resumeProducing()
+
+    def writeData(self, data):
+        self.transport.write(data)
+
+    def processMessage(self, raw_message):
+        # error callback, rejects the message
+        def onError(err):
+            log.err(err)
+            if metrics is not None:
+                metrics.increment('naks')
+            return message_container.err(err)
+
+        def onParsed(container):
+            nonlocal message_container
+            message_container = container
+            # have the factory create a deferred and pass the message
+            # to the approriate IHL7Receiver instance
+            if metrics is None and trace is None:
                 d = self.factory.handleMessage(message_container)
-                d.addCallback(onSuccess)
-                d.addErrback(onError)
-
-    def writeMessage(self, message):
-        if message is None:
-            return
-        # convert back to a byte string
-        message = self.factory.encode(message)
-        # wrap message in payload container
-        self.transport.write(
-            self.start_block + message + self.end_block + self.carriage_return
-        )
+            else:
+                if metrics is not None:
+                    start = metrics.clock()
+                if trace is not None:
+                    traced = tracer.clock()
+                d = self.factory.handleMessage(message_container)
+                if metrics is not None:
+                    d.addBoth(observe, 'handle', start)
+                if trace is not None:
+                    d.addBoth(span, 'handle', traced)
+            if not self._dispatching:
+                # parsed after the dispatch round that flushes batches, by
+                # the parse pool
+                self.factory.flushMessagesSoon()
+            d.addErrback(onError)
+            return d
+
+        def onParseError(err):
+            # without a container there is no way to NAK, so drop the
+            # connection like any other protocol error
+            log.err(err, 'Unable to parse message')
+            self.transport.loseConnection()
+
+        def encode(response):
+            # encode like the message, if its codec is not the connection's
+            response = self.encodeResponse(response, codec)
+            if key is not None and response is not None:
+                # keep the ACK for retransmissions of this message
+                response = framing.FramedMessage(self.encodeMessage(response))
+            return response
+
+        def onFailed(err):
+            # rejecting the message or encoding its response failed; send
+            # nothing rather than hold back the responses after it
+            log.err(err, 'Unable to respond to message')
+            return None
+
+        def onComplete(response):
+            if key is not None:
+                # answers any retransmissions waiting for this message
+                response = duplicates.finish(key, response)
+            self.completeMessage(seq, response)
+
+        def observe(result, stage, start):
+            metrics.observe(stage, start)
+            return result
+
+        def span(result, stage, start):
+            tracer.span(trace, stage, start)
+            return result
+
+        def closeSpool(result):
+            raw_message.close()
+            return result
+
+        metrics = self.metrics
+        tracer = self.tracer
+        trace = self.trace
+        spooled = isinstance(raw_message, SpooledFrame)
+        message_container = None
+        seq = self.beginMessage()
+        key = None
+        duplicates = self.factory.duplicates
+        if duplicates is not None:
+            # answer retransmissions without decoding or parsing them again
+            key = duplicates.key(raw_message)
+            if key is not None:
+                d = duplicates.begin(key)
+                if d is not None:
+                    if spooled:
+                        raw_message.close()
+                    d.addCallback(lambda response: self.completeMessage(seq, response))
+                    return d
+        codec = self.codec.forMessage(raw_message)
+        if spooled:
+            # a large frame in a temporary file, read by the receiver itself
+            d = self.factory.parseSpooledFrame(raw_message, codec, trace)
+        else:
+            # decode into unicode and parse, possibly in another process
+            d = self.factory.parseFrame(raw_message, codec, trace)
+        d.addCallbacks(onParsed, onParseError)
+        if spooled:
+            d.addBoth(closeSpool)
+        d.addCallback(encode)
+        d.addErrback(onFailed)
+        d.addCallback(onComplete)
+        return d
 
 
 class MLLPFactory(protocol.ServerFactory):
     protocol = MinimalLowerLayerProtocol
 
-    def __init__(self, receiver):
+    def __init__(self, receiver, max_frame_size=None, max_in_flight=None,
+                 batch_size=None, batch_window=None, clock=None, parse_pool=None,
+                 metrics=None, duplicates=None, detect_charset=False,
+                 idle_resolution=1.0, admission=None, tracer=None,
+                 spool_threshold=None, spool_directory=None, capture=None):
         verifyObject(IHL7Receiver, receiver)
+        if spool_threshold is not None:
+            verifyObject(IHL7StreamingReceiver, receiver)
         self.receiver = receiver
-        encoding = receiver.getCodec()
-        if isinstance(encoding, tuple):
-            encoding, encoding_errors = encoding
-        else:
-            encoding_errors = None
-        self.encoding = encoding or sys.getdefaultencoding()
-        self.encoding_errors = encoding_errors or 'strict'
+        self.codec = MLLPCodec.fromReceiver(receiver)
+        if detect_charset and not isinstance(self.codec, (BytesCodec, CharsetCodec)):
+            # choose each message's codec from its MSH-18
+            self.codec = CharsetCodec(default=self.codec)
+        self.encoding = self.codec.encoding
+        self.encoding_errors = self.codec.errors
         self.timeout = receiver.getTimeout()
+        # closes connections idle for longer than the timeout, to within
+        # idle_resolution seconds, from a single timer
+        if self.timeout is not None:
+            self.idle = IdleTimer(self.timeout, idle_resolution, clock)
+        else:
+            self.idle = None
+        # largest accepted frame in bytes, None for no limit
+        self.max_frame_size = max_frame_size
+        # per-connection limit of messages being handled, None for no limit
+        self.max_in_flight = max_in_flight
+        # frames larger than spool_threshold bytes are written to temporary
+        # files in spool_directory as they arrive, None to keep them in memory
+        self.spool_threshold = spool_threshold
+        self.spool_directory = spool_directory
+        # txHL7.offload.ParsePool for parsing large frames in other processes
+        self.parse_pool = parse_pool
+        if parse_pool is not None:
+            parse_pool.setParser(receiver.parseMessage)
+        # txHL7.dedup.DuplicateCache answering retransmitted messages
+        self.duplicates = duplicates
+        # txHL7.admission.AdmissionControl budgeting all connections together
+        self.admission = admission
+        # txHL7.trace.Tracer reporting the spans of each message, None to disable
+        self.tracer = tracer
+        # txHL7.capture.CaptureWriter recording received frames for replay
+        self.capture = capture
+        # open connections
+        self.connections = set()
+        # txHL7.metrics.Metrics recording per-stage timings, None to disable
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.gauge('open_connections', 'Open connections.',
+                          lambda: len(self.connections))
+            metrics.gauge('buffered_bytes', 'Bytes received but not yet handled.',
+                          self.bufferedBytes)
+            metrics.gauge('in_flight_messages', 'Messages being handled.',
+                          lambda: sum(c.in_flight for c in self.connections))
+            if parse_pool is not None:
+                metrics.gauge('parse_pool_queue_depth', 'Frames waiting for or being parsed by the parse pool.',
+                              lambda: parse_pool.queue_depth)
+                metrics.counter('parse_pool_submitted', 'Frames sent to the parse pool.',
+                                lambda: parse_pool.submitted)
+                metrics.counter('parse_pool_unpicklable', 'Frames parsed inline because the parser could not be pickled.',
+                                lambda: parse_pool.unpicklable)
+                metrics.counter('parse_pool_serialize_seconds', 'Seconds spent pickling frames and containers for the parse pool.',
+                                lambda: parse_pool.serialize_time)
+                metrics.counter('parse_pool_parse_seconds', 'Seconds the parse pool workers spent decoding and parsing.',
+                                lambda: parse_pool.parse_time)
+            if duplicates is not None:
+                for name in ('hits', 'waits', 'misses', 'evictions', 'expirations'):
+                    metrics.counter('duplicate_' + name, 'Duplicate cache {0}.'.format(name),
+                                    lambda name=name: getattr(duplicates, name))
+                metrics.gauge('duplicate_entries', 'ACKs in the duplicate cache.',
+                              lambda: len(duplicates))
+            if admission is not None:
+                metrics.gauge('admission_held_connections', 'Connections held by admission control.',
+                              lambda: admission.held)
+                metrics.counter('admission_pauses', 'Times admission control held a priority tier.',
+                                lambda: admission.pauses)
+                metrics.gauge('admission_usage', 'Usage of the fuller admission budget, as a fraction of it.',
+                              admission.usage)
+                metrics.gauge('admission_listening', 'Whether new connections are being accepted.',
+                              lambda: int(admission.listening))
+            if capture is not None:
+                metrics.counter('capture_dropped_frames', 'Frames left out of the capture.',
+                                lambda: capture.dropped)
+                metrics.gauge('capture_buffered_bytes', 'Captured bytes not yet written.',
+                              lambda: capture.buffered)
+        if IHL7BatchReceiver.providedBy(receiver):
+            self.batcher = MessageBatcher(
+                receiver.handleMessages, max_size=batch_size,
+                window=batch_window, clock=clock,
+            )
+        else:
+            self.batcher = None
+
+    def connectionMade(self, connection):
+        self.connections.add(connection)
+        if self.metrics is not None:
+            self.metrics.increment('connections')
+        if self.admission is not None:
+            self.admission.add(connection)
+
+    def connectionLost(self, connection):
+        self.connections.discard(connection)
+        if self.admission is not None:
+            self.admission.remove(connection)
+
+    def bufferedBytes(self):
+        """Bytes of partial frames and queued messages on all connections"""
+        return sum(len(c.scanner) + c.queued_bytes for c in self.connections)
+
+    def buildScanner(self):
+        if self.spool_threshold is not None:
+            return SpoolingFrameScanner(
+                max_frame_size=self.max_frame_size,
+                spool_threshold=self.spool_threshold,
+                directory=self.spool_directory,
+                start_block=self.protocol.start_block,
+                end_block=self.protocol.end_block,
+            )
+        return framing.MLLPFrameScanner(
+            max_frame_size=self.max_frame_size,
+            start_block=self.protocol.start_block,
+            end_block=self.protocol.end_block,
+        )
+
+    def parseSpooledFrame(self, frame, codec, trace=None):
+        """Give the :py:class:`txHL7.spool.SpooledFrame` ``frame`` to the
+        receiver's ``parseSpooledMessage`` as a
+        :py:class:`txHL7.spool.SpooledMessage` decoded with ``codec``,
+        returning a Deferred that fires with the message container.
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        if trace is not None:
+            traced = self.tracer.clock()
+        d = defer.maybeDeferred(self.receiver.parseSpooledMessage, SpooledMessage(frame, codec))
+        if trace is not None:
+            d.addBoth(self._span, trace, 'parse', traced)
+        return d
+
+    def parseFrame(self, frame, codec=None, trace=None):
+        """Decode and parse an MLLP frame, with ``codec`` or the factory's
+        codec, returning a Deferred that fires with the message container.
+        Frames accepted by ``parse_pool`` are parsed in a worker process, the
+        rest on the reactor thread. The spans of ``trace``, a
+        :py:class:`txHL7.trace.TraceContext`, are reported to ``tracer``.
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        if codec is None:
+            codec = self.codec.forMessage(frame)
+        metrics = self.metrics
+        if self.parse_pool is not None and self.parse_pool.accepts(frame):
+            if metrics is not None:
+                start = metrics.clock()
+            if trace is not None:
+                traced = self.tracer.clock()
+            d = self.parse_pool.parse(frame, codec)
+            if metrics is not None:
+                d.addBoth(self._observe, 'parse', start)
+            if trace is not None:
+                d.addBoth(self._span, trace, 'parse', traced)
+            return d
+        if metrics is not None or trace is not None:
+            return defer.maybeDeferred(self._parseTimed, frame, codec, trace)
+        # convert into unicode, parseMessage expects decoded string
+        return defer.maybeDeferred(lambda: self.parseMessage(codec.decode(frame)))
+
+    def _parseTimed(self, frame, codec, trace=None):
+        metrics = self.metrics
+        tracer = self.tracer if trace is not None else None
+        if metrics is not None:
+            start = metrics.clock()
+        if tracer is not None:
+            traced = tracer.clock()
+        message_str = codec.decode(frame)
+        if metrics is not None:
+            metrics.observe('decode', start)
+            start = metrics.clock()
+        if tracer is not None:
+            tracer.span(trace, 'decode', traced)
+            traced = tracer.clock()
+        container = self.parseMessage(message_str)
+        if metrics is not None:
+            metrics.observe('parse', start)
+        if tracer is not None:
+            tracer.span(trace, 'parse', traced)
+        return container
+
+    def _observe(self, result, stage, start):
+        self.metrics.observe(stage, start)
+        return result
+
+    def _span(self, result, trace, stage, start):
+        self.tracer.span(trace, stage, start)
+        return result
 
     def parseMessage(self, message_str):
         return self.receiver.parseMessage(message_str)
 
     def handleMessage(self, message_container):
+        if self.batcher is not None:
+            return self.batcher.add(message_container)
         # IHL7Receiver allows implementations to return a Deferred or the
         # result, so ensure we return a Deferred here
         return defer.maybeDeferred(self.receiver.handleMessage, message_container)
 
+    def flushMessages(self):
+        # called once a connection has dispatched the messages of a read. A
+        # batch is collected from one read, unless a batch window is set.
+        if self.batcher is not None and self.batcher.window is None:
+            self.batcher.flush()
+
+    def flushMessagesSoon(self):
+        # called when a message was handed over outside a dispatch round
+        if self.batcher is not None and self.batcher.window is None:
+            self.batcher.flushSoon()
+
     def decode(self, value):
-        # turn value into unicode using the receiver's declared codec
-        if isinstance(value, six.binary_type):
-            return value.decode(self.encoding, self.encoding_errors)
-        return six.text_type(value)
+        return self.codec.decode(value)
 
     def encode(self, value):
-        # turn value into byte string using the receiver's declared codec
-        if isinstance(value, six.text_type):
-            return value.encode(self.encoding, self.encoding_errors)
-        return value
+        return self.codec.encode(value)
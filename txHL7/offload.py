@@ -0,0 +1,167 @@
+"""Parsing large messages in worker processes.
+
+Decoding and parsing a multi-megabyte message can hold the reactor thread for
+long enough to delay every other connection. :py:class:`txHL7.offload.ParsePool`
+moves decode and ``parseMessage`` for frames of at least ``threshold`` bytes
+into a :py:class:`concurrent.futures.ProcessPoolExecutor`, while smaller
+frames are still parsed inline by :py:class:`txHL7.mllp.MLLPFactory`.
+
+The receiver's ``parseMessage`` is pickled once and loaded by each worker
+process as it starts, so the receiver and the message containers it returns
+must be picklable, and the workers parse with a copy of the receiver as it
+was when the pool started. Only the frame is pickled per message. If
+``parseMessage`` cannot be pickled, frames are parsed on the reactor thread
+instead.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import os
+import pickle
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+
+# the parse callable of the worker process, loaded by _start_worker
+_parse = None
+
+
+def _start_worker(parser):
+    # runs in each worker process as it starts
+    global _parse
+    _parse = pickle.loads(parser)
+
+
+def _parse_payload(payload):
+    # runs in the worker process
+    start = time.time()
+    frame, encoding, errors = pickle.loads(payload)
+    loaded = time.time()
+    if encoding is not None:
+        frame = frame.decode(encoding, errors)
+    container = _parse(frame)
+    parsed = time.time()
+    result = pickle.dumps(container, pickle.HIGHEST_PROTOCOL)
+    return result, loaded - start, parsed - loaded, time.time() - parsed
+
+
+class ParsePool(object):
+    """Bounded process pool for decoding and parsing large frames.
+
+    At most ``max_workers * 2`` frames are submitted to the executor at a
+    time, the rest wait in a local queue. Frames are parsed with the
+    callable given to :py:meth:`setParser`, which
+    :py:class:`txHL7.mllp.MLLPFactory` sets to its receiver's
+    ``parseMessage``. Statistics:
+
+    * ``queue_depth`` -- frames waiting or being parsed
+    * ``submitted`` / ``completed`` -- frames sent to and returned from the pool
+    * ``unpicklable`` -- frames parsed inline because the parser could not
+      be pickled
+    * ``serialize_time`` -- seconds spent pickling and unpickling frames and
+      containers, in both processes
+    * ``parse_time`` -- seconds spent in decode and ``parseMessage`` by the workers
+    """
+    def __init__(self, threshold=1024 * 1024, max_workers=None, mp_context=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.threshold = threshold
+        self.max_workers = max_workers
+        self.mp_context = mp_context
+        self.reactor = reactor
+        self.submitted = 0
+        self.completed = 0
+        self.unpicklable = 0
+        self.serialize_time = 0.0
+        self.parse_time = 0.0
+        self.parser = None
+        # the pickled parser, None if it could not be pickled
+        self._parser = None
+        self._executor = None
+        self._running = 0
+        self._waiting = collections.deque()
+
+    @property
+    def queue_depth(self):
+        return self._running + len(self._waiting)
+
+    def accepts(self, frame):
+        """Return True if ``frame`` is large enough to be parsed in the pool"""
+        return len(frame) >= self.threshold
+
+    def setParser(self, parse):
+        """Parse frames with ``parse``, which is pickled once and loaded by
+        each worker process as it starts. Must be called before the first
+        frame is parsed.
+        """
+        if self._executor is not None:
+            raise RuntimeError('The parser cannot be changed once the pool has started')
+        self.parser = parse
+        try:
+            self._parser = pickle.dumps(parse, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            log.msg('Unable to pickle {0!r}, parsing inline: {1}'.format(parse, e))
+            self._parser = None
+
+    def parse(self, frame, codec):
+        """Decode ``frame`` with ``codec``, a :py:class:`txHL7.core.MLLPCodec`,
+        unless it does not decode, and parse the result in a worker process,
+        returning a Deferred firing with the parsed container.
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        if self._parser is None:
+            self.unpicklable += 1
+            return defer.maybeDeferred(lambda: self.parser(codec.decode(frame)))
+        # the workers decode by name, or not at all
+        encoding = codec.encoding if codec.decodes else None
+        start = time.time()
+        payload = pickle.dumps((bytes(frame), encoding, codec.errors), pickle.HIGHEST_PROTOCOL)
+        self.serialize_time += time.time() - start
+        d = defer.Deferred()
+        self._waiting.append((d, payload))
+        self._submit()
+        return d
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _start(self):
+        kwargs = {}
+        if self.mp_context is not None:
+            kwargs['mp_context'] = self.mp_context
+        self._executor = ProcessPoolExecutor(
+            self.max_workers, initializer=_start_worker, initargs=(self._parser,), **kwargs
+        )
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def _submit(self):
+        if self._executor is None:
+            self._start()
+        limit = (self.max_workers or os.cpu_count() or 1) * 2
+        while self._waiting and self._running < limit:
+            d, payload = self._waiting.popleft()
+            self._running += 1
+            self.submitted += 1
+            future = self._executor.submit(_parse_payload, payload)
+            future.add_done_callback(
+                lambda future, d=d: self.reactor.callFromThread(self._done, future, d)
+            )
+
+    def _done(self, future, d):
+        self._running -= 1
+        self.completed += 1
+        try:
+            result, load_time, parse_time, dump_time = future.result()
+            start = time.time()
+            container = pickle.loads(result)
+            self.serialize_time += load_time + dump_time + time.time() - start
+            self.parse_time += parse_time
+        except Exception:
+            d.errback()
+        else:
+            d.callback(container)
+        self._submit()
@@ -0,0 +1,231 @@
+"""A statistical profiler for live servers.
+
+:py:mod:`cProfile` slows every function call down, and has to be running
+from the start. :py:class:`txHL7.profiler.SamplingProfiler` instead samples
+the stack of the reactor thread from another thread every few milliseconds,
+for as long as it is asked to, so that the hot paths of a server under its
+real load can be found without restarting it. Stacks are written in the
+collapsed format read by flame graph tools such as ``flamegraph.pl`` and
+speedscope.
+
+``twistd mllp --profile-dir DIR`` profiles the reactor thread for
+``--profile-seconds`` when the server receives ``SIGUSR2``, and serves
+``/profile?seconds=N`` on the ``--metrics-endpoint``.
+"""
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+from twisted.internet import task
+from twisted.python import log
+from twisted.web import resource, server
+
+
+def _label(frame):
+    code = frame.f_code
+    return '{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """Samples the stack of the thread ``thread_id``, by default the one
+    calling :py:meth:`start`, every ``interval`` seconds until
+    :py:meth:`stop` is called.
+
+    ``samples`` maps stacks, tuples of frame labels from the outermost
+    frame, to the number of times they were seen.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.thread_id = None
+        self.started = None
+        self.elapsed = 0.0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, thread_id=None):
+        """Start sampling in a daemon thread"""
+        if self._thread is not None:
+            raise RuntimeError('Profiler already running')
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.started = time.monotonic()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='txHL7.profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling, waiting for the sampling thread to exit"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.elapsed += time.monotonic() - self.started
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.sample(frame)
+
+    def sample(self, frame):
+        """Record the stack ending at ``frame``"""
+        stack = []
+        while frame is not None:
+            stack.append(_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[tuple(stack)] += 1
+
+    def collapsed(self):
+        """The samples in the collapsed stack format, one ``frame;frame
+        count`` line per stack
+
+        :rtype: str
+        """
+        return ''.join(
+            '{0} {1}\n'.format(';'.join(stack), count)
+            for stack, count in sorted(self.samples.items())
+        )
+
+    def top(self, count=20):
+        """The functions the thread was most often found running, with the
+        number of samples each
+
+        :rtype: list of ``(label, samples)`` tuples
+        """
+        functions = collections.Counter()
+        for stack, samples in self.samples.items():
+            functions[stack[-1]] += samples
+        return functions.most_common(count)
+
+    def report(self, count=20):
+        """A summary of the functions seen most often
+
+        :rtype: str
+        """
+        total = sum(self.samples.values())
+        lines = ['{0} samples in {1:.1f} s'.format(total, self.elapsed)]
+        for label, samples in self.top(count):
+            lines.append('{0:6.1%} {1}'.format(samples / total, label))
+        return '\n'.join(lines)
+
+
+def profile(seconds, clock=None, interval=0.005):
+    """Profile the calling thread, normally the reactor's, for ``seconds``,
+    returning a Deferred that fires with the stopped profiler.
+
+    :rtype: :py:class:`twisted.internet.defer.Deferred`
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+
+    def stop():
+        profiler.stop()
+        return profiler
+
+    return task.deferLater(clock, seconds, stop)
+
+
+class ProfileTrigger(object):
+    """Profiles the reactor thread for ``seconds`` on ``signum``, writing
+    the collapsed stacks to ``directory`` and logging the functions seen
+    most often. Only one profile runs at a time.
+    """
+    def __init__(self, directory, seconds=10, signum=getattr(signal, 'SIGUSR2', None),
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.directory = directory
+        self.seconds = seconds
+        self.signum = signum
+        self.reactor = reactor
+        self.running = None
+
+    def install(self):
+        """Install the signal handler"""
+        signal.signal(self.signum, self._signalled)
+
+    def _signalled(self, signum, frame):
+        # signal handlers run between bytecodes, leave the rest to the reactor
+        self.reactor.callFromThread(self.trigger)
+
+    def trigger(self, seconds=None):
+        """Start profiling, unless a profile is running. Returns a Deferred
+        firing with the profiler once it is written, or None.
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        if self.running is not None:
+            log.msg('Profile already running')
+            return None
+        seconds = self.seconds if seconds is None else seconds
+        log.msg('Profiling the reactor thread for {0} s'.format(seconds))
+        self.running = d = profile(seconds, self.reactor)
+        d.addBoth(self._finished)
+        d.addCallback(self._write)
+        d.addErrback(log.err, 'Unable to write profile')
+        return d
+
+    def _finished(self, result):
+        self.running = None
+        return result
+
+    def _write(self, profiler):
+        path = os.path.join(
+            self.directory, 'txhl7-profile-{0}-{1}.txt'.format(os.getpid(), int(time.time())),
+        )
+        with open(path, 'w') as f:
+            f.write(profiler.collapsed())
+        log.msg('Profile written to {0}\n{1}'.format(path, profiler.report()))
+        return profiler
+
+
+class ProfileResource(resource.Resource):
+    """Profiles the reactor thread for ``?seconds=N`` (at most
+    ``max_seconds``) through a :py:class:`ProfileTrigger`, responding with
+    the collapsed stacks
+    """
+    isLeaf = True
+
+    def __init__(self, trigger, max_seconds=60):
+        resource.Resource.__init__(self)
+        self.trigger = trigger
+        self.max_seconds = max_seconds
+
+    def render_GET(self, request):
+        try:
+            seconds = float(request.args.get(b'seconds', [self.trigger.seconds])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return b'seconds must be a number\n'
+        seconds = min(max(seconds, 0), self.max_seconds)
+        d = self.trigger.trigger(seconds)
+        if d is None:
+            request.setResponseCode(409)
+            return b'A profile is already running\n'
+        request.setHeader(b'Content-Type', b'text/plain; charset=utf-8')
+
+        def respond(profiler):
+            if finished:
+                return
+            if profiler is None:
+                request.setResponseCode(500)
+                request.write(b'Profile failed\n')
+            else:
+                request.write(profiler.collapsed().encode('utf-8'))
+            request.finish()
+
+        finished = []
+        request.notifyFinish().addErrback(lambda _: finished.append(True))
+        d.addCallback(respond)
+        return server.NOT_DONE_YET
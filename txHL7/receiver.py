@@ -3,6 +3,9 @@ from twisted.python import log
 from zope.interface import Interface, implementer
 import hl7
 
+from txHL7.ack import build_ack, frame_ack
+from txHL7.view import HL7MessageView
+
 
 class MessageContainer(object):
     """Base class for messages returned from :py:meth:`txHL7.receiver.IHL7Receiver.parseMessage`
@@ -18,6 +21,8 @@ class MessageContainer(object):
 
     def ack(self, ack_code='AA'):
         """Return unicode acknowledgement message, or None for no ACK.
+        A :py:class:`txHL7.framing.FramedMessage` may also be returned, which
+        is written to the connection without being encoded or wrapped.
 
         ``ack_code`` options are one of `AA` (accept), `AR` (reject), `AE` (error)
 
@@ -50,6 +55,61 @@ class HL7MessageContainer(MessageContainer):
         return str(self.message.create_ack(ack_code))
 
 
+class LazyHL7MessageContainer(MessageContainer):
+    """Message implementation that indexes the raw message with
+    :py:class:`txHL7.view.HL7MessageView` instead of parsing it up front.
+    Fields are read through :py:attr:`view`, e.g.
+    ``container.view.field('PID', 3)``. The python-hl7 :py:class:`hl7.Message`
+    is only built when :py:attr:`message` is first accessed.
+    """
+    def __init__(self, raw_message):
+        super(LazyHL7MessageContainer, self).__init__(raw_message)
+        self.view = HL7MessageView(raw_message)
+        self._message = None
+
+    @property
+    def message(self):
+        """The fully parsed message, built on first access
+
+        :rtype: :py:class:`hl7.Message`
+        """
+        if self._message is None:
+            self._message = self.view.materialize()
+        return self._message
+
+    def ack(self, ack_code='AA'):
+        """Return HL7 ACK built from the source message's header by
+        :py:class:`txHL7.ack.ACKBuilder`, without parsing the message.
+        For a message held as bytes, the ACK is the framed bytestring.
+
+        :rtype: unicode or :py:class:`txHL7.framing.FramedMessage`
+        """
+        if isinstance(self.raw_message, bytes):
+            return frame_ack(self.raw_message, ack_code)
+        return build_ack(self.raw_message, ack_code)
+
+
+class SpooledMessageContainer(MessageContainer):
+    """Container of a message too large to be held in memory, given to
+    :py:class:`txHL7.receiver.IHL7StreamingReceiver` receivers. ``message``
+    is the :py:class:`txHL7.spool.SpooledMessage`, read a segment at a time,
+    and ``raw_message`` its decoded ``MSH`` segment.
+    """
+    def __init__(self, message):
+        super(SpooledMessageContainer, self).__init__(message.header)
+        self.message = message
+
+    def ack(self, ack_code='AA'):
+        """Return HL7 ACK built from the message header by
+        :py:class:`txHL7.ack.ACKBuilder`.
+
+        :rtype: unicode or :py:class:`txHL7.framing.FramedMessage`
+        """
+        if isinstance(self.raw_message, bytes):
+            return frame_ack(self.raw_message, ack_code)
+        return build_ack(self.raw_message, ack_code)
+
+
 class IHL7Receiver(Interface):
     """Interface that must be implemented by MLLP protocol receiver instances"""
 
@@ -70,13 +130,17 @@ class IHL7Receiver(Interface):
         involves any blocking code, the implementation must return the result as
         :py:class:`twisted.internet.defer.Deferred` (possibly by using
         :py:func:`twisted.internet.threads.deferToThread`), to prevent the event
-        loop from being blocked.
+        loop from being blocked. Alternatively, a blocking implementation can
+        be wrapped in a :py:class:`txHL7.threaded.ThreadedReceiver`, which
+        runs it in a dedicated, bounded thread pool.
         """
         pass
 
     def getCodec():
         """Clients should return the codec name [1]_ and error handling scheme [2]_,
-        used when decoding into unicode.
+        used when decoding into unicode. A :py:class:`txHL7.core.MLLPCodec`
+        may be returned instead, such as a :py:class:`txHL7.core.CharsetCodec`
+        choosing the codec of each message from its MSH-18.
 
         :rtype: tuple(codec, errors)
 
@@ -93,6 +157,55 @@ class IHL7Receiver(Interface):
         pass
 
 
+class IHL7BatchReceiver(IHL7Receiver):
+    """Optional interface for receivers that handle messages in bulk, e.g. to
+    write them to a database in a single statement. :py:class:`txHL7.mllp.MLLPFactory`
+    collects messages into batches with :py:class:`txHL7.batch.MessageBatcher`
+    and calls ``handleMessages`` instead of ``handleMessage``.
+    """
+
+    def handleMessages(message_containers):
+        """Handle a list of :py:class:`txHL7.receiver.MessageContainer`
+        instances, possibly from several connections. Return, directly or
+        within a :py:class:`twisted.internet.defer.Deferred`, a list holding
+        the ack/nack for each message in the same order. An item may be a
+        :py:class:`twisted.python.failure.Failure` or exception, to reject
+        just that message, while a failure of the whole call rejects every
+        message in the batch.
+
+        :rtype: list
+        """
+        pass
+
+
+class IHL7BytesReceiver(IHL7Receiver):
+    """Marker interface for receivers that work on the raw bytes of each
+    message. ``parseMessage`` is given the frame as a bytestring, without
+    decoding it, and responses that are bytestrings are written without
+    encoding them, so a receiver that forwards messages and builds its ACKs
+    with :py:class:`txHL7.ack.ACKBuilder` never converts to text.
+    ``getCodec`` is not used.
+    """
+
+
+class IHL7StreamingReceiver(IHL7Receiver):
+    """Optional interface for receivers of messages too large to hold in
+    memory. With ``MLLPFactory(spool_threshold=...)``, frames larger than the
+    threshold are written to a temporary file as they arrive, and passed to
+    ``parseSpooledMessage`` instead of being decoded and given to
+    ``parseMessage``.
+    """
+    def parseSpooledMessage(spooled_message):
+        """Return the :py:class:`txHL7.receiver.MessageContainer` for the
+        :py:class:`txHL7.spool.SpooledMessage` ``spooled_message``, passed to
+        ``handleMessage`` like any other. The spool file is deleted once
+        ``handleMessage`` has returned its response.
+
+        :rtype: :py:class:`txHL7.receiver.MessageContainer`
+        """
+        pass
+
+
 @implementer(IHL7Receiver)
 class AbstractReceiver(object):
     """Abstract base class implementation of :py:class:`txHL7.receiver.IHL7Receiver`"""
@@ -117,6 +230,38 @@ class AbstractHL7Receiver(AbstractReceiver):
     message_cls = HL7MessageContainer
 
 
+@implementer(IHL7BatchReceiver)
+class AbstractBatchReceiver(AbstractReceiver):
+    """Abstract base class implementation of :py:class:`txHL7.receiver.IHL7BatchReceiver`.
+    Subclasses implement ``handleMessages``, which also handles single messages.
+    """
+    def handleMessage(self, message_container):
+        d = defer.maybeDeferred(self.handleMessages, [message_container])
+        d.addCallback(lambda results: results[0])
+        return d
+
+
+@implementer(IHL7BytesReceiver)
+class AbstractBytesReceiver(AbstractReceiver):
+    """Abstract base class implementation of :py:class:`txHL7.receiver.IHL7BytesReceiver`.
+    Messages are :py:class:`txHL7.receiver.LazyHL7MessageContainer` instances
+    over the raw bytes, whose ``ack`` returns the framed bytestring.
+    """
+    message_cls = LazyHL7MessageContainer
+
+
+@implementer(IHL7StreamingReceiver)
+class AbstractStreamingReceiver(AbstractReceiver):
+    """Abstract base class implementation of :py:class:`txHL7.receiver.IHL7StreamingReceiver`.
+    Spooled messages are :py:class:`txHL7.receiver.SpooledMessageContainer`
+    instances.
+    """
+    spooled_message_cls = SpooledMessageContainer
+
+    def parseSpooledMessage(self, spooled_message):
+        return self.spooled_message_cls(spooled_message)
+
+
 class LoggingReceiver(AbstractHL7Receiver):
     """Simple MLLP receiver implementation that logs and ACKs messages."""
     def handleMessage(self, message_container):
@@ -0,0 +1,296 @@
+"""Replay of captured traffic.
+
+Sends the frames recorded by a :py:class:`txHL7.capture.CaptureWriter` to any
+MLLP server, over one connection per captured connection and in the order
+they were captured, and reports throughput and the ACK latency
+distribution::
+
+    python -m txHL7.replay --endpoint tcp:host=staging:port=2575 \\
+        --speed 4 captures/capture-*.cap
+
+It runs in one of two modes:
+
+* timed (the default) -- connections are opened, and frames sent, at the
+  offsets they were captured at, divided by ``speed``: at ``1`` the server
+  sees the captured load, bursts included, and at ``4`` the same traffic
+  four times as fast. Latency is measured from the time each frame should
+  have been sent, as with the open loop mode of :py:mod:`txHL7.loadgen`.
+* maximum speed (``--max-speed``) -- every connection is opened at once
+  and keeps ``window`` frames outstanding, finding the most the server can
+  take of the captured mix of messages.
+"""
+import sys
+import time
+
+from twisted.internet import defer, endpoints, task
+from twisted.python import log, usage
+
+from txHL7 import framing
+from txHL7.capture import CLOSE, FRAME, OPEN, read_capture
+from txHL7.histogram import Histogram
+from txHL7.loadgen import LoadFactory
+from txHL7.view import HL7MessageView
+
+
+class Session(object):
+    """A captured connection from ``peer``: opened ``opened`` seconds after
+    the start of the capture, with ``frames``, a list of ``(offset, frame)``
+    tuples whose frames are MLLP framed, and ``closed`` at that offset, or
+    None if the capture ends first.
+    """
+    def __init__(self, connection_id, peer, opened):
+        self.connection_id = connection_id
+        self.peer = peer
+        self.opened = opened
+        self.frames = []
+        self.closed = None
+        # while replaying: the connection, the next frame to send, the call
+        # that will send it and whether the connection is being closed
+        self.connection = None
+        self.position = 0
+        self.call = None
+        self.closing = False
+
+
+def load_sessions(paths):
+    """Read the capture files at ``paths``, in order, into the sessions
+    that sent at least one frame
+
+    :rtype: list of :py:class:`Session`
+    """
+    sessions = []
+    current = {}
+    base = None
+    for path in paths:
+        for kind, connection_id, timestamp, payload in read_capture(path):
+            if base is None:
+                base = timestamp
+            offset = timestamp - base
+            session = current.get(connection_id)
+            if kind == OPEN or session is None:
+                # a connection opened before the oldest capture file
+                # starts when it is first seen
+                peer = payload.decode('utf-8', 'replace') if kind == OPEN else ''
+                session = current[connection_id] = Session(connection_id, peer, offset)
+                sessions.append(session)
+            if kind == FRAME:
+                session.frames.append((offset, framing.frame(payload)))
+            elif kind == CLOSE:
+                session.closed = offset
+                del current[connection_id]
+    return [session for session in sessions if session.frames]
+
+
+class Replayer(object):
+    """Replays ``sessions`` against ``endpoint_string``, at ``speed`` times
+    the captured rate, or as fast as the server answers with up to
+    ``window`` frames outstanding per connection if ``speed`` is None.
+    :py:meth:`run` fires once every frame has been answered or lost.
+
+    Results:
+
+    * ``histogram`` -- ACK latencies in microseconds
+    * ``sent`` / ``acked`` / ``rejected`` -- frames sent, ACKs received,
+      and of those, ACKs whose MSA-1 was not AA or CA
+    * ``failed`` -- frames not answered because their connection was lost
+      or could not be established
+    * ``connect_errors`` -- connections that could not be established
+    * ``elapsed`` -- seconds from the start to the last ACK
+    """
+    factory = LoadFactory
+
+    def __init__(self, endpoint_string, sessions, speed=1.0, window=1,
+                 reactor=None, now=time.monotonic):
+        if reactor is None:
+            from twisted.internet import reactor
+        if not sessions:
+            raise ValueError('The capture contains no frames')
+        if speed is not None and speed <= 0:
+            raise ValueError('The speed must be positive')
+        self.reactor = reactor
+        self.endpoint_string = endpoint_string
+        self.sessions = sessions
+        self.speed = speed
+        self.window = window
+        self.now = now
+
+        self.histogram = Histogram()
+        self.sent = 0
+        self.acked = 0
+        self.rejected = 0
+        self.failed = 0
+        self.connect_errors = 0
+        self.elapsed = 0.0
+        self.start = None
+        self._endpoint = None
+        self._factory = None
+        self._remaining = 0
+        self._done = None
+
+    @property
+    def frames(self):
+        """Frames in the capture"""
+        return sum(len(session.frames) for session in self.sessions)
+
+    @property
+    def throughput(self):
+        """ACKs per second"""
+        return self.acked / self.elapsed if self.elapsed else 0.0
+
+    def run(self):
+        """Replay the sessions, firing with this replayer once done
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        self._endpoint = endpoints.clientFromString(self.reactor, self.endpoint_string)
+        self._factory = self.factory(self)
+        self._remaining = len(self.sessions)
+        self._done = defer.Deferred()
+        self.start = self.now()
+        for session in self.sessions:
+            if self.speed is None:
+                self._connect(session)
+            else:
+                session.call = self.reactor.callLater(session.opened / self.speed, self._connect, session)
+        return self._done.addCallback(lambda ignored: self)
+
+    def _connect(self, session):
+        session.call = None
+        d = self._endpoint.connect(self._factory)
+        d.addCallbacks(
+            self._connected, self._connectFailed,
+            callbackArgs=(session,), errbackArgs=(session,),
+        )
+
+    def _connected(self, connection, session):
+        connection.session = session
+        session.connection = connection
+        self._advance(session)
+
+    def _connectFailed(self, reason, session):
+        self.connect_errors += 1
+        self.failed += len(session.frames)
+        log.msg('Unable to connect: {0}'.format(reason.getErrorMessage()))
+        self._finish()
+
+    def _advance(self, session):
+        # send the frames of ``session`` that are due, in order
+        session.call = None
+        connection = session.connection
+        frames = session.frames
+        while session.position < len(frames):
+            offset, frame = frames[session.position]
+            if self.speed is None:
+                if len(connection.outstanding) >= self.window:
+                    return
+                intended = self.now()
+            else:
+                intended = self.start + offset / self.speed
+                delay = intended - self.now()
+                if delay > 0:
+                    session.call = self.reactor.callLater(delay, self._advance, session)
+                    return
+            session.position += 1
+            self.sent += 1
+            connection.send(frame, intended)
+        self._maybeClose(session)
+
+    def _maybeClose(self, session):
+        if session.position < len(session.frames) or session.connection.outstanding:
+            return
+        if not session.closing:
+            session.closing = True
+            session.connection.transport.loseConnection()
+
+    def ackReceived(self, connection, ack, intended):
+        now = self.now()
+        self.histogram.record((now - intended) * 1e6)
+        self.acked += 1
+        self.elapsed = now - self.start
+        try:
+            code = HL7MessageView(ack).field(b'MSA', 1)
+        except KeyError:
+            code = None
+        if code not in (b'AA', b'CA'):
+            self.rejected += 1
+        if self.speed is None:
+            self._advance(connection.session)
+        else:
+            self._maybeClose(connection.session)
+
+    def connectionLost(self, connection, reason):
+        session = connection.session
+        if session.call is not None and session.call.active():
+            session.call.cancel()
+        session.call = None
+        lost = len(connection.outstanding) + len(session.frames) - session.position
+        if lost:
+            log.msg('Connection {0} lost with {1} frames unanswered: {2}'.format(
+                session.connection_id, lost, reason.getErrorMessage()))
+            self.failed += lost
+            connection.outstanding.clear()
+        self._finish()
+
+    def _finish(self):
+        self._remaining -= 1
+        if not self._remaining:
+            done, self._done = self._done, None
+            done.callback(None)
+
+    def report(self, out):
+        """Write a summary of the results to the file ``out``"""
+        mode = 'at {0:g}x'.format(self.speed) if self.speed is not None else \
+            'at maximum speed, window {0}'.format(self.window)
+        out.write('{0} connections, {1} frames, replayed {2}\n'.format(
+            len(self.sessions), self.frames, mode))
+        out.write('sent {0}, acked {1}, rejected {2}, failed {3}, connect errors {4}\n'.format(
+            self.sent, self.acked, self.rejected, self.failed, self.connect_errors))
+        out.write('throughput {0:.1f} messages/s over {1:.3f}s\n'.format(
+            self.throughput, self.elapsed))
+        out.write('latency ms: {0}\n'.format(self.histogram.summaryLine()))
+
+
+class Options(usage.Options):
+    synopsis = '[options] capture-file [capture-file ...]'
+    optParameters = [
+        ['endpoint', 'e', 'tcp:host=localhost:port=2575', 'The client endpoint to send to.'],
+        ['speed', 's', 1.0, 'Replay this many times faster than captured.', float],
+        ['window', 'w', 1, 'Outstanding frames per connection with --max-speed.', int],
+    ]
+    optFlags = [
+        ['max-speed', 'm', 'Send as fast as the server answers, ignoring the captured timing.'],
+    ]
+
+    def parseArgs(self, *captures):
+        if not captures:
+            raise usage.UsageError('At least one capture file is required')
+        self['captures'] = captures
+
+    def postOptions(self):
+        if self['speed'] <= 0:
+            raise usage.UsageError('--speed must be positive')
+
+
+def main(argv=None):
+    """Command line entry point"""
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        sys.exit('{0}\n{1}'.format(options, e))
+
+    @defer.inlineCallbacks
+    def run(reactor):
+        replayer = Replayer(
+            options['endpoint'], load_sessions(options['captures']),
+            speed=None if options['max-speed'] else options['speed'],
+            window=options['window'], reactor=reactor,
+        )
+        yield replayer.run()
+        replayer.report(sys.stdout)
+
+    task.react(run)
+
+
+if __name__ == '__main__':
+    main()
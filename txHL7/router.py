@@ -0,0 +1,218 @@
+"""Routing messages to receivers by their header.
+
+:py:class:`txHL7.router.Router` is an :py:class:`txHL7.receiver.IHL7Receiver`
+that reads the sending application (MSH-3), sending facility (MSH-4) and
+message type (MSH-9) from the raw message, without parsing the rest of it,
+and hands the message to the receiver of the first matching rule::
+
+    router = Router([
+        ('ADT^*', Route(AdtReceiver())),
+        ('LAB|*|ORU^R01', Route(LabReceiver(), codec='cp1252', timeout=5)),
+        ('*^*', Route(AcceptReceiver())),
+    ], fallback=Route(DefaultReceiver()))
+    factory = MLLPFactory(router)
+
+A rule's pattern is either a message type, or sending application, sending
+facility and message type separated by ``|``. Each part may use
+:py:mod:`fnmatch` wildcards. The message type is matched as its message code
+and trigger event, e.g. ``ORU^R01``, whatever the message structure.
+
+The route for each combination of header values seen is remembered, so
+after the first message a lookup is a single dictionary access.
+
+Each :py:class:`txHL7.router.Route` has its own codec, by default its
+receiver's :py:meth:`txHL7.receiver.IHL7Receiver.getCodec`. The router
+itself decodes frames as ISO-8859-1, which maps every byte to one character,
+so a route can restore the original bytes and decode them with its codec.
+"""
+import fnmatch
+
+from twisted.internet import defer
+from twisted.python import log
+from zope.interface import implementer
+from zope.interface.verify import verifyObject
+
+from txHL7.ack import ACKBuilder
+from txHL7.core import MLLPCodec
+from txHL7.framing import FramedMessage, frame
+from txHL7.receiver import (
+    AbstractReceiver, IHL7Receiver, LazyHL7MessageContainer, MessageContainer
+)
+from txHL7.view import read_header
+
+# decodes every byte to the character with the same code point, and back
+PASSTHROUGH = 'latin-1'
+
+_ack_builder = ACKBuilder(encoding=PASSTHROUGH)
+
+
+class AcceptReceiver(AbstractReceiver):
+    """Receiver that ACKs every message without handling it, for routes
+    whose messages are to be dropped
+    """
+    message_cls = LazyHL7MessageContainer
+
+    def handleMessage(self, message_container):
+        return message_container.ack()
+
+
+class Route(object):
+    """A destination of a :py:class:`txHL7.router.Router`: ``receiver``, the
+    codec its messages are decoded with, and ``timeout``, the seconds after
+    which a ``handleMessage`` that has not finished is rejected.
+    """
+    def __init__(self, receiver, codec=None, timeout=None, reactor=None):
+        verifyObject(IHL7Receiver, receiver)
+        self.receiver = receiver
+        if codec is None:
+            self.codec = MLLPCodec.fromReceiver(receiver)
+        elif isinstance(codec, tuple):
+            self.codec = MLLPCodec(*codec)
+        else:
+            self.codec = MLLPCodec(codec)
+        self.timeout = timeout
+        self.reactor = reactor
+
+    def handle(self, raw_message):
+        """Decode the passthrough-decoded ``raw_message`` with this route's
+        codec and hand it to the receiver, returning a Deferred firing with
+        the framed, encoded response
+
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        raw_message = raw_message.encode(PASSTHROUGH)
+        codec = self.codec.forMessage(raw_message)
+        container = self.receiver.parseMessage(codec.decode(raw_message))
+        d = defer.maybeDeferred(self.receiver.handleMessage, container)
+        if self.timeout is not None:
+            if self.reactor is None:
+                from twisted.internet import reactor
+                self.reactor = reactor
+            d.addTimeout(self.timeout, self.reactor)
+
+        def onError(err):
+            log.err(err)
+            return container.err(err)
+
+        d.addErrback(onError)
+        d.addCallback(self.encode, codec)
+        return d
+
+    def encode(self, response, codec=None):
+        if response is None or isinstance(response, FramedMessage):
+            return response
+        return frame((codec or self.codec).encode(response))
+
+
+class RoutedMessage(MessageContainer):
+    """Message container of a :py:class:`txHL7.router.Router`, holding the
+    passthrough-decoded message and its ``route``. Rejections are built from
+    the header, as the message has not been parsed.
+    """
+    def __init__(self, raw_message, route):
+        super(RoutedMessage, self).__init__(raw_message)
+        self.route = route
+
+    def ack(self, ack_code='AA'):
+        return _ack_builder.frame(self.raw_message, ack_code)
+
+
+def _compile(pattern):
+    parts = pattern.split('|')
+    if len(parts) == 1:
+        parts = ['*', '*'] + parts
+    if len(parts) != 3:
+        raise ValueError('Route pattern must be TYPE or APPLICATION|FACILITY|TYPE: {0!r}'.format(pattern))
+    return tuple(parts)
+
+
+@implementer(IHL7Receiver)
+class Router(object):
+    """Routes messages by MSH-3, MSH-4 and MSH-9 according to ``rules``, a
+    list of ``(pattern, route)`` tried in order, where ``route`` is a
+    :py:class:`txHL7.router.Route` or a receiver. Messages matching no rule
+    go to ``fallback``, or are rejected if it is None. ``timeout`` is the
+    connection idle timeout.
+
+    Up to ``table_size`` header combinations are remembered in the dispatch
+    table ``table``.
+    """
+    def __init__(self, rules=(), fallback=None, timeout=None, table_size=10000):
+        self.rules = [(_compile(pattern), self._route(route)) for pattern, route in rules]
+        self.fallback = self._route(fallback)
+        self.timeout = timeout
+        self.table_size = table_size
+        self.table = {}
+
+    @staticmethod
+    def _route(route):
+        if route is None or isinstance(route, Route):
+            return route
+        return Route(route)
+
+    def lookup(self, application, facility, message_type):
+        """Return the :py:class:`txHL7.router.Route` for the header values,
+        or None
+
+        :rtype: :py:class:`txHL7.router.Route`
+        """
+        key = (application, facility, message_type)
+        try:
+            return self.table[key]
+        except KeyError:
+            pass
+        route = self.fallback
+        for patterns, candidate in self.rules:
+            if all(fnmatch.fnmatchcase(value, pattern)
+                   for value, pattern in zip(key, patterns)):
+                route = candidate
+                break
+        if len(self.table) < self.table_size:
+            self.table[key] = route
+        return route
+
+    def parseMessage(self, raw_message):
+        header = read_header(raw_message)
+        # message code and trigger event, without the message structure
+        message_type = u'^'.join((header.component(9, 1), header.component(9, 2)))
+        route = self.lookup(header.field(3), header.field(4), message_type)
+        return RoutedMessage(raw_message, route)
+
+    def handleMessage(self, message_container):
+        route = message_container.route
+        if route is None:
+            log.msg('No route for message, rejecting')
+            return message_container.ack('AR')
+        return route.handle(message_container.raw_message)
+
+    def getCodec(self):
+        return PASSTHROUGH, 'strict'
+
+    def getTimeout(self):
+        return self.timeout
+
+
+def parse_route(spec):
+    """Parse a ``--route`` option, ``PATTERN=RECEIVER[,codec=CODEC][,timeout=SECONDS]``
+    where ``RECEIVER`` is the fully qualified name of an
+    :py:class:`txHL7.receiver.IHL7Receiver` class
+
+    :rtype: tuple of the pattern and a :py:class:`txHL7.router.Route`
+    """
+    from twisted.python import reflect
+
+    head, _, extra = spec.partition(',')
+    pattern, sep, target = head.rpartition('=')
+    options = {}
+    for option in filter(None, extra.split(',')):
+        name, _, value = option.partition('=')
+        options[name.strip()] = value.strip()
+    if not sep or not pattern or not target:
+        raise ValueError('Route must be PATTERN=RECEIVER[,codec=CODEC][,timeout=SECONDS]: {0!r}'.format(spec))
+    unknown = set(options) - set(['codec', 'timeout'])
+    if unknown:
+        raise ValueError('Unknown route options: {0}'.format(', '.join(sorted(unknown))))
+    _compile(pattern)
+    receiver = reflect.namedClass(target.strip())()
+    timeout = float(options['timeout']) if 'timeout' in options else None
+    return pattern, Route(receiver, codec=options.get('codec'), timeout=timeout)
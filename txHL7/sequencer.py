@@ -0,0 +1,63 @@
+class ResponseSequencer(object):
+    """Releases responses in the order their messages arrived.
+
+    MLLP senders match ACKs to messages by position, so although the messages
+    of one connection may be handled concurrently, their responses must be
+    written in arrival order. Each message reserves a sequence number with
+    :py:meth:`reserve` and hands its response to :py:meth:`complete`, which
+    calls ``release`` for every response that is now at the head of the line.
+
+    Head-of-line blocking is tracked by:
+
+    * ``blocked`` -- responses that completed before an earlier message and
+      had to wait
+    * ``max_buffered`` -- the most responses waiting at any one time
+    """
+    # one sequencer per connection
+    __slots__ = ('release', 'blocked', 'max_buffered', '_next_reserved',
+                 '_next_released', '_completed')
+
+    def __init__(self, release):
+        self.release = release
+        self.blocked = 0
+        self.max_buffered = 0
+        self._next_reserved = 0
+        self._next_released = 0
+        # completed responses waiting on an earlier message, by sequence
+        self._completed = {}
+
+    def __len__(self):
+        """Number of messages reserved but not yet released."""
+        return self._next_reserved - self._next_released
+
+    @property
+    def buffered(self):
+        """Number of completed responses waiting on an earlier message."""
+        return len(self._completed)
+
+    def reserve(self):
+        """Return the sequence number of the next message.
+
+        :rtype: int
+        """
+        seq = self._next_reserved
+        self._next_reserved += 1
+        return seq
+
+    def complete(self, seq, response):
+        """Record the ``response`` for message ``seq``, releasing it along
+        with any responses it was holding back.
+        """
+        if seq != self._next_released:
+            self._completed[seq] = response
+            self.blocked += 1
+            self.max_buffered = max(self.max_buffered, len(self._completed))
+            return
+
+        self._next_released += 1
+        self.release(response)
+        completed = self._completed
+        while self._next_released in completed:
+            response = completed.pop(self._next_released)
+            self._next_released += 1
+            self.release(response)
@@ -0,0 +1,202 @@
+"""Streaming delivery of large messages through temporary files.
+
+A frame normally sits whole in the scanner's buffer, then again as decoded
+text, and again as a parsed message, before a receiver sees it. For results
+carrying large base64 attachments that triples the memory of the largest
+message. :py:class:`txHL7.spool.SpoolingFrameScanner` instead moves frames
+larger than ``spool_threshold`` bytes to a temporary file as they arrive.
+Receivers providing :py:class:`txHL7.receiver.IHL7StreamingReceiver` are
+given such frames as a :py:class:`txHL7.spool.SpooledMessage`, whose
+segments are read from the file one at a time::
+
+    class ResultReceiver(AbstractStreamingReceiver):
+        def handleMessage(self, message_container):
+            if isinstance(message_container, SpooledMessageContainer):
+                for segment in message_container.message.segments():
+                    if segment.startswith('OBX|'):
+                        store_observation(segment)
+            ...
+            return message_container.ack()
+
+    factory = MLLPFactory(ResultReceiver(), spool_threshold=16 * 1024 * 1024)
+
+The ACK is built from the ``MSH`` segment, which is kept in memory.
+"""
+import mmap
+import tempfile
+
+from txHL7 import framing
+
+# bytes read at a time when looking for the end of the MSH segment, and the
+# most that is kept of a malformed one
+HEADER_CHUNK = 4096
+MAX_HEADER = 64 * 1024
+
+
+class SpooledFrame(bytes):
+    """A frame spooled to ``file``, a temporary file that is deleted once
+    closed. The bytestring itself is the frame's ``MSH`` segment, so headers
+    are read as from any other frame; ``size`` is the size of the whole
+    frame.
+    """
+    def __new__(cls, file, size):
+        file.seek(0)
+        header = bytearray()
+        while True:
+            chunk = file.read(HEADER_CHUNK)
+            end = chunk.find(b'\r')
+            if end != -1:
+                header += chunk[:end]
+                break
+            header += chunk
+            if len(chunk) < HEADER_CHUNK or len(header) >= MAX_HEADER:
+                break
+        self = super(SpooledFrame, cls).__new__(cls, bytes(header))
+        self.file = file
+        self.size = size
+        self._mmap = None
+        return self
+
+    def mmap(self):
+        """Map the frame into memory, read only. Pages are read from the
+        file as they are accessed, and may be dropped again under memory
+        pressure.
+
+        :rtype: :py:class:`mmap.mmap`
+        """
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self._mmap, 'madvise'):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        return self._mmap
+
+    def raw_segments(self):
+        """Yield each segment of the frame as a bytestring
+
+        :rtype: iterator of bytes
+        """
+        if not self.size:
+            return
+        data = self.mmap()
+        start = 0
+        while start < self.size:
+            end = data.find(b'\r', start)
+            if end == -1:
+                end = self.size
+            if end > start:
+                yield data[start:end]
+            start = end + 1
+
+    def close(self):
+        """Unmap and delete the file"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self.file.close()
+
+
+class SpooledMessage(object):
+    """The message of a :py:class:`SpooledFrame`, decoded with ``codec``, a
+    :py:class:`txHL7.core.MLLPCodec`, a segment at a time.
+
+    ``header`` is the decoded ``MSH`` segment and ``size`` the size of the
+    frame in bytes. The spool file is closed, and deleted, once
+    ``handleMessage`` has returned its response.
+    """
+    def __init__(self, frame, codec):
+        self.frame = frame
+        self.codec = codec
+        self.header = codec.decode(bytes(frame))
+        self.size = frame.size
+
+    @property
+    def file(self):
+        """The spool file, for reading the raw frame as a stream"""
+        return self.frame.file
+
+    def mmap(self):
+        """The raw frame, mapped into memory
+
+        :rtype: :py:class:`mmap.mmap`
+        """
+        return self.frame.mmap()
+
+    def segments(self):
+        """Yield each segment of the message, decoded
+
+        :rtype: iterator of unicode
+        """
+        decode = self.codec.decode
+        for segment in self.frame.raw_segments():
+            yield decode(segment)
+
+    def close(self):
+        self.frame.close()
+
+
+class SpoolingFrameScanner(framing.MLLPFrameScanner):
+    """An :py:class:`txHL7.framing.MLLPFrameScanner` that writes frames of
+    more than ``spool_threshold`` bytes to a temporary file in ``directory``
+    (by default the system's), returning them as a
+    :py:class:`SpooledFrame`. Only the bytes of the frame received before it
+    crossed the threshold are held in memory, and only until they are
+    written out.
+
+    ``len()`` is the number of bytes held in memory; ``spooled`` the number
+    written to the file of the frame being received.
+    """
+    __slots__ = ('spool_threshold', 'directory', '_spool', 'spooled')
+
+    def __init__(self, max_frame_size=None, spool_threshold=1024 * 1024, directory=None,
+                 start_block=framing.START_BLOCK, end_block=framing.END_BLOCK):
+        super(SpoolingFrameScanner, self).__init__(max_frame_size, start_block, end_block)
+        self.spool_threshold = spool_threshold
+        self.directory = directory
+        self._spool = None
+        self.spooled = 0
+
+    def feed(self, data):
+        if self._spool is None:
+            frames = super(SpoolingFrameScanner, self).feed(data)
+            if len(self._buffer) > self.spool_threshold:
+                self._startSpool()
+            return frames
+        end = data.find(self.end_block)
+        if end == -1:
+            self._write(data)
+            return []
+        self._write(data[:end])
+        spool, size = self._spool, self.spooled
+        self._spool = None
+        self.spooled = 0
+        frames = [SpooledFrame(spool, size)]
+        frames.extend(self.feed(data[end + len(self.end_block):]))
+        return frames
+
+    def reset(self):
+        super(SpoolingFrameScanner, self).reset()
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self.spooled = 0
+
+    def _startSpool(self):
+        buf = self._buffer
+        start = 0
+        while start < len(buf) and buf[start] in framing._FRAME_PADDING:
+            start += 1
+        if start == len(buf):
+            # only padding so far, no frame to spool
+            return
+        self._spool = tempfile.TemporaryFile(prefix='txhl7-spool-', dir=self.directory)
+        with memoryview(buf) as view:
+            self._write(view[start:])
+        super(SpoolingFrameScanner, self).reset()
+
+    def _write(self, data):
+        self._spool.write(data)
+        self.spooled += len(data)
+        if self.max_frame_size is not None and self.spooled > self.max_frame_size:
+            size = self.spooled
+            self.reset()
+            raise framing.FrameTooLarge(size, self.max_frame_size)
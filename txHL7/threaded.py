@@ -0,0 +1,141 @@
+"""Blocking receivers on a dedicated thread pool.
+
+:py:func:`twisted.internet.threads.deferToThread` runs blocking code in the
+reactor's shared thread pool, whose queue is unbounded and which name
+resolution and every other user of the reactor compete for. Under overload,
+messages wait there for ever longer, until senders time out and retransmit.
+
+:py:class:`txHL7.threaded.ThreadedReceiver` runs the ``handleMessage`` of a
+blocking receiver in a pool of its own, with a bounded queue. Once the queue
+is full, messages are answered at once with a negative acknowledgement, so
+the latency of the messages that are accepted stays predictable::
+
+    receiver = ThreadedReceiver(DatabaseReceiver(), threads=8, queue_size=32)
+    factory = MLLPFactory(receiver)
+"""
+import collections
+import time
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+from zope.interface import implementer
+from zope.interface.verify import verifyObject
+
+from txHL7.histogram import BusyTimer, Histogram
+from txHL7.receiver import IHL7Receiver
+
+
+@implementer(IHL7Receiver)
+class ThreadedReceiver(object):
+    """Runs the ``handleMessage`` of ``receiver``, which may block, in a
+    dedicated pool of ``threads`` threads, returning its result directly
+    rather than in a Deferred. ``parseMessage``, ``getCodec`` and
+    ``getTimeout`` are the receiver's.
+
+    At most ``queue_size`` messages wait for a thread. Beyond that, messages
+    are answered immediately with ``message_container.ack(overload_code)``,
+    AE by default, or AR to tell the sender not to retry. Statistics:
+
+    * ``queue_depth`` -- messages waiting for a thread
+    * ``busy`` -- threads handling a message
+    * ``completed`` -- messages handled
+    * ``overloaded`` -- messages answered with ``overload_code``
+    * ``queue_wait`` -- :py:class:`txHL7.histogram.Histogram` of the
+      microseconds messages waited for a thread
+    * ``utilization`` -- the fraction of the pool's thread time spent in
+      ``handleMessage`` since it started
+    """
+    def __init__(self, receiver, threads=10, queue_size=100, overload_code='AE',
+                 name='txHL7.threaded', reactor=None, now=time.monotonic):
+        verifyObject(IHL7Receiver, receiver)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.receiver = receiver
+        self.threads = threads
+        self.queue_size = queue_size
+        self.overload_code = overload_code
+        self.name = name
+        self.reactor = reactor
+        self.now = now
+        self.pool = None
+        self._shutdown = None
+        self.completed = 0
+        self.overloaded = 0
+        self.queue_wait = Histogram()
+        self._timer = BusyTimer(threads, now)
+        self._waiting = collections.deque()
+
+    @property
+    def queue_depth(self):
+        return len(self._waiting)
+
+    @property
+    def busy(self):
+        return self._timer.running
+
+    @property
+    def utilization(self):
+        return self._timer.utilization
+
+    def start(self):
+        """Start the thread pool, stopped when the reactor shuts down. Called
+        on the first message if need be.
+        """
+        if self.pool is not None:
+            return
+        self.pool = ThreadPool(minthreads=0, maxthreads=self.threads, name=self.name)
+        self.pool.start()
+        self._timer.start()
+        self._shutdown = self.reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """Stop the thread pool, waiting for the running messages to finish"""
+        if self.pool is None:
+            return
+        pool, self.pool = self.pool, None
+        try:
+            self.reactor.removeSystemEventTrigger(self._shutdown)
+        except ValueError:
+            # called by the trigger
+            pass
+        pool.stop()
+
+    def parseMessage(self, raw_message):
+        return self.receiver.parseMessage(raw_message)
+
+    def handleMessage(self, message_container):
+        if self.pool is None:
+            self.start()
+        if self._timer.running < self.threads:
+            return self._dispatch(message_container, self.now())
+        if len(self._waiting) >= self.queue_size:
+            self.overloaded += 1
+            log.msg('Thread pool queue full, answering with {0}'.format(self.overload_code))
+            return message_container.ack(self.overload_code)
+        d = defer.Deferred()
+        self._waiting.append((d, message_container, self.now()))
+        return d
+
+    def _dispatch(self, message_container, queued):
+        start = self._timer.begin()
+        self.queue_wait.record((start - queued) * 1e6)
+        d = threads.deferToThreadPool(
+            self.reactor, self.pool, self.receiver.handleMessage, message_container
+        )
+        d.addBoth(self._done, start)
+        return d
+
+    def _done(self, result, start):
+        self._timer.end(start)
+        self.completed += 1
+        while self._waiting and self._timer.running < self.threads:
+            d, message_container, queued = self._waiting.popleft()
+            self._dispatch(message_container, queued).chainDeferred(d)
+        return result
+
+    def getCodec(self):
+        return self.receiver.getCodec()
+
+    def getTimeout(self):
+        return self.receiver.getTimeout()
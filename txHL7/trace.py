@@ -0,0 +1,139 @@
+"""Per-message tracing.
+
+:py:class:`txHL7.metrics.Metrics` shows that latency went up, but not which
+messages were slow or where they spent their time. Passing a
+:py:class:`txHL7.trace.Tracer` to :py:class:`txHL7.mllp.MLLPFactory` gives
+every frame a :py:class:`txHL7.trace.TraceContext`, and reports spans for
+each stage it goes through:
+
+* ``frame`` -- the read that completed the frame, shared by the frames it
+  completed
+* ``decode`` -- decoding the frame
+* ``parse`` -- ``parseMessage``, or the round trip through the
+  :py:class:`txHL7.offload.ParsePool`
+* ``handle`` -- ``handleMessage`` until its Deferred fires
+* ``write`` -- encoding and writing the response, once every earlier
+  response has been written
+
+to the tracer's hooks, callables taking the context, the stage, and the
+start and end of the span. Messages taking longer than ``slow_threshold``
+seconds, from the start of the read to the write of their response, are
+logged with the duration of each span::
+
+    def export(trace, stage, start, end):
+        statsd.timing('hl7.' + stage, (end - start) * 1000)
+
+    factory = MLLPFactory(receiver, tracer=Tracer(hooks=[export], slow_threshold=1.0))
+"""
+import itertools
+import time
+
+from twisted.python import log
+
+from txHL7.view import read_header
+
+STAGES = ('frame', 'decode', 'parse', 'handle', 'write')
+
+
+class TraceContext(object):
+    """What is known of a frame as it is handled:
+
+    * ``connection_id`` -- the tracer's number for the connection
+    * ``control_id`` -- MSH-10 of the raw frame, as bytes
+    * ``size`` -- the size of the frame in bytes
+    * ``arrival`` -- the time the frame was received, in seconds since the
+      epoch
+    * ``spans`` -- a list of ``(stage, start, end)`` tuples, in the
+      tracer's ``clock``
+    """
+    __slots__ = ('connection_id', 'control_id', 'size', 'arrival', 'spans')
+
+    def __init__(self, connection_id, control_id, size, arrival):
+        self.connection_id = connection_id
+        self.control_id = control_id
+        self.size = size
+        self.arrival = arrival
+        self.spans = []
+
+    @property
+    def duration(self):
+        """Seconds from the start of the first span to the end of the last
+
+        :rtype: float
+        """
+        if not self.spans:
+            return 0.0
+        return self.spans[-1][2] - self.spans[0][1]
+
+    def describe(self):
+        """A one-line summary of the message and its spans
+
+        :rtype: str
+        """
+        return 'connection {0} control ID {1} ({2} bytes) took {3:.1f} ms: {4}'.format(
+            self.connection_id,
+            self.control_id.decode('ascii', 'replace') if self.control_id else '-',
+            self.size,
+            self.duration * 1e3,
+            ', '.join(
+                '{0} {1:.1f} ms'.format(stage, (end - start) * 1e3)
+                for stage, start, end in self.spans
+            ),
+        )
+
+
+class Tracer(object):
+    """Creates a :py:class:`TraceContext` per frame and passes each span to
+    ``hooks``, callables taking ``(trace, stage, start, end)``, with times
+    from ``clock``. Messages taking at least ``slow_threshold`` seconds are
+    logged; ``slow`` counts them.
+
+    Hooks run on the reactor thread, and should be quick.
+    """
+    def __init__(self, hooks=(), slow_threshold=None, clock=time.perf_counter, now=time.time):
+        self.hooks = list(hooks)
+        self.slow_threshold = slow_threshold
+        self.clock = clock
+        self.now = now
+        self.traced = 0
+        self.slow = 0
+        self._connection_ids = itertools.count(1)
+
+    def connectionId(self):
+        """Number a new connection
+
+        :rtype: int
+        """
+        return next(self._connection_ids)
+
+    def begin(self, connection_id, frame, start, end):
+        """Start tracing ``frame``, completed by a read from ``start`` to ``end``
+
+        :rtype: :py:class:`TraceContext`
+        """
+        # spooled frames are only their MSH segment in memory
+        size = getattr(frame, 'size', None) or len(frame)
+        trace = TraceContext(connection_id, read_header(frame).field(10) or None, size, self.now())
+        self.span(trace, 'frame', start, end)
+        return trace
+
+    def span(self, trace, stage, start, end=None):
+        """Record that ``trace`` spent from ``start`` to ``end``, by default
+        now, in ``stage``
+        """
+        if end is None:
+            end = self.clock()
+        trace.spans.append((stage, start, end))
+        for hook in self.hooks:
+            try:
+                hook(trace, stage, start, end)
+            except Exception:
+                log.err(None, 'Trace hook failed')
+
+    def finish(self, trace):
+        """Called once the response to ``trace`` is written"""
+        self.traced += 1
+        threshold = self.slow_threshold
+        if threshold is not None and trace.duration >= threshold:
+            self.slow += 1
+            log.msg('Slow message: ' + trace.describe())
@@ -0,0 +1,185 @@
+"""Lazy, offset-indexed access to raw HL7 messages.
+
+:py:class:`txHL7.view.HL7MessageView` scans a raw message once for segment
+boundaries and stores them as offsets in compact arrays. Fields are only
+sliced out of the raw message when they are read, so a receiver that looks at
+a handful of fields never pays for building the complete
+:py:class:`hl7.Message` tree.
+
+Views work on unicode strings as well as bytestrings, allowing headers to be
+read before a message is decoded.
+"""
+from array import array
+
+import hl7
+
+
+def _separators(raw_message):
+    # the segment separator and field separator, of the same type as the message
+    if isinstance(raw_message, bytes):
+        return b'\r', raw_message[3:4]
+    return u'\r', raw_message[3:4]
+
+
+class SegmentView(object):
+    """A single segment of a :py:class:`txHL7.view.HL7MessageView`.
+
+    Field numbers follow HL7 conventions, and match those of
+    :py:class:`hl7.Segment`: for ``MSH``, field 1 is the field separator and
+    field 2 the encoding characters.
+    """
+    __slots__ = ('raw_message', 'start', 'end', 'separator', '_fields')
+
+    def __init__(self, raw_message, start, end, separator):
+        self.raw_message = raw_message
+        self.start = start
+        self.end = end
+        self.separator = separator
+        # offsets of the field separators, scanned on first field access
+        self._fields = None
+
+    @property
+    def raw(self):
+        """The unparsed segment"""
+        return self.raw_message[self.start:self.end]
+
+    def __len__(self):
+        """Number of fields, including the segment ID (field 0)"""
+        return len(self._field_offsets()) - 1
+
+    @property
+    def segment_id(self):
+        return self.raw_message[self.start:self.start + 3]
+
+    def _field_offsets(self):
+        if self._fields is None:
+            raw = self.raw_message
+            separator = self.separator
+            # offsets of the position before each field
+            offsets = array('l', [self.start - 1])
+            pos = raw.find(separator, self.start, self.end)
+            while pos != -1:
+                offsets.append(pos)
+                pos = raw.find(separator, pos + 1, self.end)
+            offsets.append(self.end)
+            self._fields = offsets
+        return self._fields
+
+    def field(self, index):
+        """Return field ``index`` as an unparsed string, or an empty string if
+        the segment has fewer fields.
+        """
+        if self.segment_id in ('MSH', b'MSH'):
+            if index == 1:
+                return self.separator
+            if index > 1:
+                index -= 1
+        offsets = self._field_offsets()
+        if index + 1 >= len(offsets):
+            return self.raw_message[0:0]
+        return self.raw_message[offsets[index] + 1:offsets[index + 1]]
+
+    __getitem__ = field
+
+    def component(self, index, component, separator=None):
+        """Return ``component`` (1-based) of the first repetition of field
+        ``index``. ``separator`` defaults to the message's component
+        separator.
+        """
+        if separator is None:
+            # MSH-2 holds the encoding characters: component then repetition
+            separator = self.raw_message[4:5]
+        value = self.field(index)
+        repetition = self.raw_message[5:6]
+        if repetition and repetition in value:
+            value = value[:value.index(repetition)]
+        parts = value.split(separator)
+        if component > len(parts):
+            return value[0:0]
+        return parts[component - 1]
+
+
+def read_header(raw_message):
+    """Return the ``MSH`` segment of ``raw_message`` without scanning the
+    rest of the message.
+
+    :rtype: :py:class:`txHL7.view.SegmentView`
+    """
+    segment_separator, separator = _separators(raw_message)
+    end = raw_message.find(segment_separator)
+    if end == -1:
+        end = len(raw_message)
+    return SegmentView(raw_message, 0, end, separator)
+
+
+class HL7MessageView(object):
+    """Offset index over the segments of a raw HL7 message.
+
+    Segment boundaries are scanned when the view is created. Field boundaries
+    are scanned per segment, the first time one of its fields is read. The
+    complete :py:class:`hl7.Message` can still be built with
+    :py:meth:`materialize`.
+    """
+    def __init__(self, raw_message):
+        self.raw_message = raw_message
+        segment_separator, self.separator = _separators(raw_message)
+        self._starts = array('l')
+        self._ends = array('l')
+        # segment ID to segment numbers, built on first lookup
+        self._ids = None
+
+        start = 0
+        size = len(raw_message)
+        while start < size:
+            end = raw_message.find(segment_separator, start)
+            if end == -1:
+                end = size
+            if end > start:
+                self._starts.append(start)
+                self._ends.append(end)
+            start = end + 1
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        return SegmentView(self.raw_message, self._starts[index],
+                           self._ends[index], self.separator)
+
+    def _index(self):
+        if self._ids is None:
+            ids = {}
+            raw = self.raw_message
+            for number, start in enumerate(self._starts):
+                ids.setdefault(raw[start:start + 3], []).append(number)
+            self._ids = ids
+        return self._ids
+
+    def segments(self, segment_id):
+        """Return a list of all the segments with ``segment_id``
+
+        :rtype: list of :py:class:`txHL7.view.SegmentView`
+        """
+        return [self[number] for number in self._index().get(segment_id, ())]
+
+    def segment(self, segment_id):
+        """Return the first segment with ``segment_id``, raising
+        :py:exc:`KeyError` if there is none, like :py:meth:`hl7.Message.segment`
+
+        :rtype: :py:class:`txHL7.view.SegmentView`
+        """
+        numbers = self._index().get(segment_id)
+        if not numbers:
+            raise KeyError(segment_id)
+        return self[numbers[0]]
+
+    def field(self, segment_id, index):
+        """Return field ``index`` of the first ``segment_id`` segment"""
+        return self.segment(segment_id).field(index)
+
+    def materialize(self):
+        """Parse the complete message with python-hl7
+
+        :rtype: :py:class:`hl7.Message`
+        """
+        return hl7.parse(self.raw_message)
@@ -0,0 +1,233 @@
+"""Multi-process MLLP server.
+
+:py:class:`txHL7.workers.WorkerPoolService` creates the listening socket in
+the parent process and starts worker processes that inherit it. Each worker
+adopts the socket with
+:py:meth:`twisted.internet.interfaces.IReactorSocket.adoptStreamPort` and runs
+its own :py:class:`txHL7.mllp.MLLPFactory` and receiver, so the kernel spreads
+incoming connections across the workers. The parent only supervises,
+restarting workers that exit.
+
+Workers are started as ``python -m txHL7.workers --inherit-fd FD [mllp options]``.
+"""
+import os
+import re
+import signal
+import socket
+import sys
+
+from twisted.application import service
+from twisted.internet import defer, protocol
+from twisted.python import log
+
+
+def listen_socket(description, backlog=50):
+    """Create a non-blocking listening socket from a ``tcp:`` or ``tcp6:``
+    server endpoint string, such as ``tcp:2575:interface=127.0.0.1``.
+
+    :rtype: :py:class:`socket.socket`
+    """
+    parts = [p.replace('\\:', ':') for p in re.split(r'(?<!\\):', description)]
+    kind, args = parts[0], parts[1:]
+    families = {'tcp': socket.AF_INET, 'tcp6': socket.AF_INET6}
+    if kind not in families:
+        raise ValueError(
+            'Worker processes require a tcp or tcp6 endpoint, not {0!r}'.format(description)
+        )
+    positional = [a for a in args if '=' not in a]
+    kwargs = dict(a.split('=', 1) for a in args if '=' in a)
+    port = int(kwargs.get('port', positional[0] if positional else 0))
+    interface = kwargs.get('interface', positional[1] if len(positional) > 1 else '')
+    backlog = int(kwargs.get('backlog', positional[2] if len(positional) > 2 else backlog))
+
+    sock = socket.socket(families[kind], socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+    except Exception:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    return sock
+
+
+def worker_environment():
+    """The environment of worker processes: the parent's, with a
+    ``PYTHONPATH`` letting workers import everything the parent can, such as
+    a receiver found relative to the working directory
+
+    :rtype: dict
+    """
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(os.path.abspath(p) for p in sys.path if p)
+    return env
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """Relays a worker's output to the parent's log and reports its exit"""
+    def __init__(self, pool, number):
+        self.pool = pool
+        self.number = number
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        for line in data.splitlines():
+            log.msg(u'[worker {0}] {1}'.format(self.number, line.decode('utf-8', 'replace')))
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerPoolService(service.Service):
+    """Listens on ``endpoint`` and runs ``workers`` worker processes, each
+    started with the ``mllp`` plugin arguments ``args``.
+
+    A worker that exits while the service is running is restarted after
+    ``restart_delay`` seconds. The delay doubles, up to
+    ``max_restart_delay``, each time a worker exits within ``min_uptime``
+    seconds of starting.
+    """
+    restart_delay = 1.0
+    max_restart_delay = 60.0
+    min_uptime = 60.0
+    # seconds to wait for workers to exit on SIGTERM before killing them
+    stop_timeout = 10.0
+
+    def __init__(self, endpoint, args, workers, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.endpoint = endpoint
+        self.args = list(args)
+        self.workers = workers
+        self.reactor = reactor
+        self.socket = None
+        self.processes = {}
+        self.restarts = 0
+        self._delays = {}
+        self._started = {}
+        self._pending = {}
+
+    @property
+    def port(self):
+        """The bound port number, useful when listening on port 0"""
+        return self.socket.getsockname()[1]
+
+    def startService(self):
+        service.Service.startService(self)
+        self.socket = listen_socket(self.endpoint)
+        for number in range(self.workers):
+            self.startWorker(number)
+
+    def workerCommand(self):
+        return [
+            sys.executable, '-m', 'txHL7.workers',
+            '--inherit-fd', str(self.socket.fileno()),
+        ] + self.args
+
+    def workerEnvironment(self):
+        return worker_environment()
+
+    def startWorker(self, number):
+        self._pending.pop(number, None)
+        fd = self.socket.fileno()
+        process = WorkerProcessProtocol(self, number)
+        self.processes[number] = process
+        self._started[number] = self.reactor.seconds()
+        self.reactor.spawnProcess(
+            process, sys.executable, self.workerCommand(),
+            env=self.workerEnvironment(), childFDs={0: 'w', 1: 'r', 2: 'r', fd: fd},
+        )
+
+    def workerEnded(self, process, reason):
+        number = process.number
+        if self.processes.get(number) is process:
+            del self.processes[number]
+        if not self.running:
+            return
+        uptime = self.reactor.seconds() - self._started[number]
+        if uptime < self.min_uptime:
+            delay = min(self._delays.get(number, self.restart_delay / 2) * 2,
+                        self.max_restart_delay)
+        else:
+            delay = self.restart_delay
+        self._delays[number] = delay
+        self.restarts += 1
+        log.msg(u'Worker {0} exited ({1}), restarting in {2}s'.format(
+            number, reason.value, delay
+        ))
+        self._pending[number] = self.reactor.callLater(delay, self.startWorker, number)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for call in self._pending.values():
+            call.cancel()
+        self._pending.clear()
+        processes = list(self.processes.values())
+        for process in processes:
+            self._signal(process, signal.SIGTERM)
+        kill = self.reactor.callLater(self.stop_timeout, self._killAll)
+
+        def stopped(_):
+            if kill.active():
+                kill.cancel()
+            self.socket.close()
+
+        d = defer.DeferredList([p.ended for p in processes])
+        d.addCallback(stopped)
+        return d
+
+    def _killAll(self):
+        for process in list(self.processes.values()):
+            self._signal(process, signal.SIGKILL)
+
+    def _signal(self, process, signum):
+        try:
+            process.transport.signalProcess(signum)
+        except Exception:
+            # already exited
+            pass
+
+
+class _ParentWatcher(protocol.Protocol):
+    """Stops the worker when the parent closes its stdin, e.g. by exiting"""
+    def connectionLost(self, reason):
+        from twisted.internet import reactor
+        if reactor.running:
+            reactor.stop()
+
+
+def main(argv=None):
+    """Worker process entry point"""
+    from twisted.internet import reactor, stdio
+    from twisted.plugins.mllp_plugin import Options, serviceMaker
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) < 2 or argv[0] != '--inherit-fd':
+        sys.exit('usage: python -m txHL7.workers --inherit-fd FD [mllp options]')
+    fd = int(argv[1])
+    options = Options()
+    options.parseOptions(argv[2:])
+
+    log.startLogging(sys.stdout, setStdout=False)
+    sock = socket.socket(fileno=fd)
+    family = sock.family
+    sock.detach()
+    factory = serviceMaker.makeFactory(options)
+    port = reactor.adoptStreamPort(fd, family, factory)
+    if factory.admission is not None:
+        # each worker stops accepting while its own budgets are exceeded
+        factory.admission.addPort(port)
+    if options['profile-dir'] is not None:
+        serviceMaker.profileTrigger(options)
+    stdio.StandardIO(_ParentWatcher())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()